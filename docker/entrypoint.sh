@@ -16,6 +16,7 @@ LOAD_DEMODATA=${LOAD_DEMODATA:=false}
 CREATE_GROUPS=${CREATE_GROUPS:=true}
 CREATE_DUMMY_ADMIN=${CREATE_DUMMY_ADMIN:=false}
 CREATE_DUMMY_USERS=${CREATE_DUMMY_USERS:=false}
+MAIL_WORKER=${MAIL_WORKER:=true}
 
 python manage.py wait_for_db
 python manage.py createcachetable
@@ -79,6 +80,12 @@ if [ "${TEST,,}" = true ]; then
   coverage combine
   coverage report --show-missing
 fi
+if [ "${MAIL_WORKER,,}" = true ]; then
+  # Renders receipts and sends the notification mails queued by the web
+  # application, next to the main process, and is restarted if it exits
+  echo 'starting mail worker'
+  (while true; do python manage.py mail_worker || true; sleep 5; done) &
+fi
 if [ $ECHO_INTERFACE ]; then
     echo "Interface: $ECHO_INTERFACE"
 fi
@@ -11,16 +11,21 @@ from havneafgifter.models import (
     DisembarkmentSite,
     DisembarkmentTaxRate,
     HarborDuesForm,
+    InvoiceOutboxItem,
+    MailJob,
+    MailJobStatus,
     PassengersByCountry,
     Port,
     PortAuthority,
     PortTaxRate,
+    PrismeDebitor,
     ShippingAgent,
     ShipType,
     TaxRates,
     User,
     Vessel,
 )
+from havneafgifter.recalculation import recalculate_taxes
 from havneafgifter.tables import UserExportTable, VesselExportTable
 
 
@@ -53,10 +58,12 @@ class HarborDuesFormAdmin(SimpleHistoryAdmin):
     actions = [
         "calculate_tax",
         "send_email",
+        "release_invoice_claim",
     ]
 
     readonly_fields = [
         "status",
+        "invoice_claimed_at",
     ]
 
     @admin.display(description=_("Port authority"))
@@ -68,14 +75,24 @@ class HarborDuesFormAdmin(SimpleHistoryAdmin):
 
     @admin.action(description=_("Calculate tax"))
     def calculate_tax(self, request, queryset):
-        for obj in queryset:
-            obj.calculate_tax(save=True)
+        report = recalculate_taxes(queryset)
+        self.message_user(
+            request,
+            _("Recalculated tax for %(forms)d forms, %(changed)d changed")
+            % {"forms": report.forms, "changed": report.changed_forms},
+        )
 
     @admin.action(description=_("Send email"))
     def send_email(self, request, queryset):
         for obj in queryset:
             obj.send_email()
 
+    @admin.action(description=_("Release invoice claim"))
+    def release_invoice_claim(self, request, queryset):
+        # For forms whose invoice is known not to have been accepted by Prisme
+        # (see `havneafgifter.invoicing`), so it is sent again
+        queryset.update(invoice_claimed_at=None)
+
     def get_queryset(self, request):
         qs = super().get_queryset(request)
         return qs.exclude(vessel_type=ShipType.CRUISE)
@@ -323,3 +340,64 @@ class VesselAdmin(admin.ModelAdmin):
         table = VesselExportTable(data=queryset)
         export = TableExport(export_format="xlsx", table=table)
         return export.response("vessels.xlsx")
+
+
+@admin.register(InvoiceOutboxItem)
+class InvoiceOutboxItemAdmin(admin.ModelAdmin):
+    list_display = (
+        "form",
+        "attempts",
+        "last_attempt_at",
+        "next_attempt_at",
+        "permanent_failure",
+        "last_error",
+    )
+    list_filter = ("permanent_failure",)
+    search_fields = ("form__vessel_name", "form__vessel_imo", "last_error")
+    readonly_fields = ("form", "attempts", "last_error", "last_attempt_at")
+
+    actions = [
+        "retry_now",
+    ]
+
+    @admin.action(description=_("Retry now"))
+    def retry_now(self, request, queryset):
+        for obj in queryset:
+            obj.retry_now()
+
+
+@admin.register(PrismeDebitor)
+class PrismeDebitorAdmin(admin.ModelAdmin):
+    list_display = ("cvr", "account_num", "updated")
+    search_fields = ("cvr",)
+
+
+@admin.register(MailJob)
+class MailJobAdmin(admin.ModelAdmin):
+    list_display = (
+        "form",
+        "mail_class",
+        "user",
+        "status",
+        "attempts",
+        "next_attempt_at",
+        "created",
+        "finished",
+        "error",
+    )
+    list_filter = ("status", "mail_class")
+    search_fields = ("form__vessel_name", "form__vessel_imo", "error")
+    readonly_fields = ("form", "user", "mail_class", "attempts", "error")
+
+    actions = [
+        "retry_now",
+    ]
+
+    @admin.action(description=_("Retry now"))
+    def retry_now(self, request, queryset):
+        queryset.exclude(status=MailJobStatus.RUNNING).update(
+            status=MailJobStatus.PENDING,
+            attempts=0,
+            next_attempt_at=None,
+            reported=False,
+        )
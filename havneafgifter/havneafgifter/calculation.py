@@ -0,0 +1,315 @@
+from __future__ import annotations
+
+import dataclasses
+import hashlib
+from dataclasses import dataclass, field
+from datetime import UTC, date, datetime, time
+from decimal import Decimal
+from typing import List, Sequence, Tuple
+from uuid import UUID
+
+from django.utils import timezone
+
+from havneafgifter.data import DateTimeRange, overlap_periods
+from havneafgifter.models import DisembarkmentTaxRate, PortTaxRate, ShipType
+from havneafgifter.tariffs import TariffIndex, TariffPeriod
+
+# Tax calculation without database access.
+#
+# The functions in this module compute the harbour, passenger and disembarkment
+# taxes of a form from plain input values and a tariff snapshot (a `TariffIndex`).
+# They do no I/O, so they can be used (and tested) without model instances, and
+# give the same result for the same input every time.
+#
+# The calculation methods on the models (`HarborDuesForm.calculate_harbour_tax`,
+# `CruiseTaxForm.calculate_passenger_tax` and
+# `Disembarkment.calculate_disembarkment_tax_and_rate`) build the input from the
+# model instance, and pass it on to this module.
+
+# Vessel types paying harbour tax per started week instead of per started day
+WEEKLY_VESSEL_TYPES = (ShipType.FREIGHTER, ShipType.OTHER)
+
+
+def _as_utc(value: datetime | None) -> datetime | None:
+    if value is None or timezone.is_naive(value):
+        return value
+    return value.astimezone(UTC)
+
+
+@dataclass(frozen=True)
+class DisembarkmentInput:
+    disembarkment_site_id: int
+    municipality: int
+    number_of_passengers: int
+
+
+@dataclass(frozen=True)
+class TaxInput:
+    vessel_type: str | None = None
+    port_of_call_id: int | None = None
+    gross_tonnage: int | None = None
+    datetime_of_arrival: datetime | None = None
+    datetime_of_departure: datetime | None = None
+    # Used for disembarkments if the arrival is not known
+    form_date: date | None = None
+    # Only relevant for cruise ships
+    number_of_passengers: int | None = None
+    disembarkments: Tuple[DisembarkmentInput, ...] = ()
+
+    @property
+    def has_port_of_call(self) -> bool:
+        # Cruise ships may skip the port of call, other vessels always have one
+        return self.vessel_type != ShipType.CRUISE or self.port_of_call_id is not None
+
+    def get_fingerprint(self, tariff_version: UUID | None = None) -> str:
+        """Return a hash of this input and the given tariff version, which only
+        changes if the calculated taxes might change.
+        """
+        # Compare points in time, regardless of their time zone
+        normalized = dataclasses.replace(
+            self,
+            datetime_of_arrival=_as_utc(self.datetime_of_arrival),
+            datetime_of_departure=_as_utc(self.datetime_of_departure),
+        )
+        return hashlib.sha256(
+            repr((normalized, tariff_version)).encode("utf-8")
+        ).hexdigest()
+
+    @property
+    def disembarkment_datetime(self) -> datetime | None:
+        # The date of a disembarkment is the arrival (or form) date of its form.
+        # A form date is converted the same way Django converts a date (or naive
+        # datetime) when filtering on a datetime field.
+        value = self.datetime_of_arrival or self.form_date
+        if value is None:
+            return None
+        if not isinstance(value, datetime):
+            value = datetime.combine(value, time())
+        if timezone.is_naive(value):
+            value = timezone.make_aware(value)
+        return value
+
+
+@dataclass(frozen=True)
+class HarbourTaxLine:
+    # The port tax rate applied within one tariff period (if any)
+    port_tax_rate: PortTaxRate | None
+    date_range: DateTimeRange
+    harbour_tax: Decimal
+
+
+@dataclass(frozen=True)
+class DisembarkmentTaxLine:
+    disembarkment: DisembarkmentInput
+    date: datetime | None
+    disembarkment_tax_rate: DisembarkmentTaxRate | None
+    tax: Decimal
+
+    @property
+    def rate(self) -> Decimal:
+        if self.disembarkment_tax_rate is None:
+            return Decimal(0)
+        return self.disembarkment_tax_rate.disembarkment_tax_rate
+
+
+@dataclass(frozen=True)
+class TaxResult:
+    # `None` if the input is insufficient to calculate the tax
+    harbour_tax: Decimal | None = None
+    harbour_tax_lines: List[HarbourTaxLine] = field(default_factory=list)
+    passenger_tax: Decimal | None = None
+    passenger_tax_rate: Decimal = Decimal(0)
+    disembarkment_tax: Decimal = Decimal(0)
+    disembarkment_tax_lines: List[DisembarkmentTaxLine] = field(default_factory=list)
+
+    @property
+    def total_tax(self) -> Decimal:
+        return (
+            (self.harbour_tax or Decimal(0))
+            + (self.passenger_tax or Decimal(0))
+            + self.disembarkment_tax
+        )
+
+
+def _overlap(period: TariffPeriod, start: datetime, end: datetime) -> DateTimeRange:
+    # Same as `TaxRates.get_overlap`
+    if period.end_datetime is not None and period.end_datetime < end:
+        end = period.end_datetime
+    if period.start_datetime is not None and period.start_datetime > start:
+        start = period.start_datetime
+    return DateTimeRange(start, end)
+
+
+def _has_harbour_tax(tax_input: TaxInput) -> bool:
+    return (
+        tax_input.has_port_of_call
+        and tax_input.datetime_of_arrival is not None
+        and tax_input.datetime_of_departure is not None
+        and tax_input.gross_tonnage is not None
+    )
+
+
+def _harbour_tax(
+    vessel_type: str | None,
+    gross_tonnage: int,
+    port_tax_rate: PortTaxRate,
+    started_days: int,
+    started_weeks: int,
+) -> Decimal:
+    if vessel_type in WEEKLY_VESSEL_TYPES:
+        payments = started_weeks
+    else:
+        payments = started_days
+    return (
+        payments
+        * port_tax_rate.port_tax_rate
+        * max(gross_tonnage, port_tax_rate.round_gross_ton_up_to)
+    )
+
+
+def calculate_harbour_tax(
+    tax_input: TaxInput, tariffs: TariffIndex
+) -> Tuple[Decimal | None, List[HarbourTaxLine]]:
+    """Return the harbour tax, and one line per tariff period overlapping the
+    stay.
+
+    The harbour tax is `None` if the vessel has no port of call, or if the
+    arrival, departure or gross tonnage is not known.
+    """
+    if not _has_harbour_tax(tax_input):
+        return None, []
+    arrival: datetime = tax_input.datetime_of_arrival  # type: ignore[assignment]
+    departure: datetime = tax_input.datetime_of_departure  # type: ignore[assignment]
+    gross_tonnage: int = tax_input.gross_tonnage  # type: ignore[assignment]
+
+    harbour_tax = Decimal(0)
+    lines: List[HarbourTaxLine] = []
+    for period in tariffs.get_periods(arrival, departure):
+        date_range = _overlap(period, arrival, departure)
+        port_tax_rate = period.get_port_tax_rate(
+            port_id=tax_input.port_of_call_id,
+            vessel_type=tax_input.vessel_type,
+            gross_ton=gross_tonnage,
+        )
+        range_harbour_tax = Decimal(0)
+        if port_tax_rate is not None:
+            range_harbour_tax = _harbour_tax(
+                tax_input.vessel_type,
+                gross_tonnage,
+                port_tax_rate,
+                date_range.started_days,
+                date_range.started_weeks,
+            )
+            harbour_tax += range_harbour_tax
+        lines.append(HarbourTaxLine(port_tax_rate, date_range, range_harbour_tax))
+    return harbour_tax, lines
+
+
+def calculate_harbour_taxes(
+    tax_inputs: Sequence[TaxInput], tariffs: TariffIndex
+) -> List[Decimal | None]:
+    """Return the harbour tax of each of `tax_inputs`, like
+    `calculate_harbour_tax`, but without the lines.
+
+    The overlaps of all stays with the tariff periods are computed in one batch,
+    without creating a `DateTimeRange` per stay and period.
+    """
+    harbour_taxes: List[Decimal | None] = [None] * len(tax_inputs)
+    rows = [
+        row for row, tax_input in enumerate(tax_inputs) if _has_harbour_tax(tax_input)
+    ]
+    for row in rows:
+        harbour_taxes[row] = Decimal(0)
+    overlaps = overlap_periods(
+        [tax_inputs[row].datetime_of_arrival for row in rows],  # type: ignore[misc]
+        [tax_inputs[row].datetime_of_departure for row in rows],  # type: ignore[misc]
+        [period.start_datetime for period in tariffs.periods],
+        [period.end_datetime for period in tariffs.periods],
+    )
+    for range_index, period_index, days, weeks in zip(
+        overlaps.range_index,
+        overlaps.period_index,
+        overlaps.started_days,
+        overlaps.started_weeks,
+    ):
+        row = rows[range_index]
+        tax_input = tax_inputs[row]
+        gross_tonnage: int = tax_input.gross_tonnage  # type: ignore[assignment]
+        port_tax_rate = tariffs.periods[period_index].get_port_tax_rate(
+            port_id=tax_input.port_of_call_id,
+            vessel_type=tax_input.vessel_type,
+            gross_ton=gross_tonnage,
+        )
+        if port_tax_rate is not None:
+            harbour_taxes[row] += _harbour_tax(  # type: ignore[operator]
+                tax_input.vessel_type, gross_tonnage, port_tax_rate, days, weeks
+            )
+    return harbour_taxes
+
+
+def calculate_passenger_tax(
+    tax_input: TaxInput, tariffs: TariffIndex
+) -> Tuple[Decimal | None, Decimal]:
+    """Return the passenger tax and the rate per passenger.
+
+    The passenger tax is `None` if the number of passengers, the arrival or the
+    departure is not known.
+    """
+    if (
+        tax_input.number_of_passengers is None
+        or tax_input.datetime_of_arrival is None
+        or tax_input.datetime_of_departure is None
+    ):
+        return None, Decimal(0)
+    period = tariffs.get_period(tax_input.datetime_of_arrival)
+    rate = (period and period.tax_rates.pax_tax_rate) or Decimal(0)
+    return tax_input.number_of_passengers * rate, rate
+
+
+def calculate_disembarkment_tax_line(
+    disembarkment: DisembarkmentInput,
+    moment: datetime | None,
+    tariffs: TariffIndex,
+) -> DisembarkmentTaxLine:
+    """Return the tax of a single disembarkment taking place at `moment`."""
+    rate = None
+    period = tariffs.get_period(moment) if moment is not None else None
+    if period is not None:
+        rate = period.get_disembarkment_tax_rate(
+            disembarkment.disembarkment_site_id, disembarkment.municipality
+        )
+    tax = (
+        disembarkment.number_of_passengers * rate.disembarkment_tax_rate
+        if rate is not None
+        else Decimal(0)
+    )
+    return DisembarkmentTaxLine(disembarkment, moment, rate, tax)
+
+
+def calculate_disembarkment_tax(
+    tax_input: TaxInput, tariffs: TariffIndex
+) -> Tuple[Decimal, List[DisembarkmentTaxLine]]:
+    """Return the total disembarkment tax, and one line per disembarkment."""
+    moment = tax_input.disembarkment_datetime
+    lines = [
+        calculate_disembarkment_tax_line(disembarkment, moment, tariffs)
+        for disembarkment in tax_input.disembarkments
+    ]
+    return sum((line.tax for line in lines), Decimal(0)), lines
+
+
+def calculate_taxes(tax_input: TaxInput, tariffs: TariffIndex) -> TaxResult:
+    """Calculate all taxes of `tax_input` using the tariff snapshot `tariffs`."""
+    harbour_tax, harbour_tax_lines = calculate_harbour_tax(tax_input, tariffs)
+    passenger_tax, passenger_tax_rate = calculate_passenger_tax(tax_input, tariffs)
+    disembarkment_tax, disembarkment_tax_lines = calculate_disembarkment_tax(
+        tax_input, tariffs
+    )
+    return TaxResult(
+        harbour_tax=harbour_tax,
+        harbour_tax_lines=harbour_tax_lines,
+        passenger_tax=passenger_tax,
+        passenger_tax_rate=passenger_tax_rate,
+        disembarkment_tax=disembarkment_tax,
+        disembarkment_tax_lines=disembarkment_tax_lines,
+    )
@@ -1,4 +1,7 @@
+import logging
 import os
+import threading
+import time
 from datetime import date, datetime
 from decimal import Decimal
 from typing import Any, Dict, List
@@ -9,6 +12,13 @@ from prisme.client import Prisme
 from prisme.file import File as InvoiceFile
 from prisme.invoice import InvoiceLine, InvoiceRequest, InvoiceResponse
 from prisme.request import ResponseType
+from requests import Session
+from requests.adapters import HTTPAdapter
+from zeep import Client
+from zeep.cache import SqliteCache
+from zeep.transports import Transport
+
+logger = logging.getLogger(__name__)
 
 
 class HavneafgiftInvoiceLine(InvoiceLine):
@@ -133,10 +143,19 @@ class HavneafgiftInvoiceResponse(InvoiceResponse):
             self.invoice_id = self.data["CustInvoiceTable"]["InvoiceId"]
 
 
+def first_response(response: Any) -> Any:
+    # The Prisme client returns a list of responses, one per request XML, while
+    # the mock returns a single response
+    if isinstance(response, list):
+        return response[0] if response else None
+    return response
+
+
 class PrismeClient(Prisme):
 
     mock_recid_counter = 0
     instance = None
+    _client: Client | None
 
     def __init__(
         self,
@@ -144,9 +163,97 @@ class PrismeClient(Prisme):
         auth: Dict[str, str],
         proxy: Dict[str, str] | None = None,
         mock=False,
+        wsdl_cache: Dict[str, Any] | None = None,
+        pool_size: int = 10,
     ):
         super().__init__(wsdl_file, auth, proxy)
         self.mock = mock
+        # Cache of the WSDL (and imported schemas) on disk, shared between
+        # processes, with `path` and `timeout` (validity in seconds)
+        self.wsdl_cache = wsdl_cache
+        # Connections kept alive for reuse, e.g. by dispatcher threads
+        self.pool_size = pool_size
+        # Seconds taken to construct the zeep client, and whether the WSDL was
+        # found in the cache, once constructed
+        self.startup_time: float | None = None
+        self.wsdl_cached: bool | None = None
+        self._client_lock = threading.Lock()
+
+    @property
+    def client(self) -> Client:
+        # Like `Prisme.client`, with a pooled session and cached WSDL, and
+        # constructed only once when used by several threads
+        with self._client_lock:
+            if self._client is None:
+                start = time.perf_counter()
+                cache = self.create_cache()
+                self.wsdl_cached = cache is not None and (
+                    cache.get(self.wsdl_file) is not None
+                )
+                try:
+                    client = Client(
+                        wsdl=self.wsdl_file,
+                        transport=Transport(
+                            session=self.create_session(),
+                            timeout=3600,
+                            operation_timeout=3600,
+                            cache=cache,
+                        ),
+                    )
+                except Exception as e:
+                    logger.error("Failed connecting to prisme: %s" % str(e))
+                    raise e
+                client.set_ns_prefix(
+                    "tns",
+                    "http://schemas.datacontract.org/2004/07/Dynamics.Ax.Application",
+                )
+                self._client = client
+                self.startup_time = time.perf_counter() - start
+                logger.info(
+                    "Prisme client constructed in %.3f s (WSDL %s)",
+                    self.startup_time,
+                    "cached" if self.wsdl_cached else "fetched",
+                )
+        assert self._client is not None
+        return self._client
+
+    def create_cache(self) -> SqliteCache | None:
+        if not self.wsdl_cache or not self.wsdl_cache.get("path"):
+            return None
+        return SqliteCache(
+            path=self.wsdl_cache["path"], timeout=self.wsdl_cache.get("timeout")
+        )
+
+    def create_session(self) -> Session:
+        session = Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        if self.proxy:
+            socks = self.proxy.get("socks")
+            if socks:
+                proxy = f"socks5://{socks}"
+                session.proxies = {"http": proxy, "https": proxy}
+        if self.auth and "basic" in self.auth:
+            basic_settings: Dict[str, str] = self.auth["basic"]  # type: ignore
+            session.auth = (
+                f'{basic_settings["username"]}@{basic_settings["domain"]}',
+                basic_settings["password"],
+            )
+        return session
+
+    def warm_up(self) -> float | None:
+        """Construct the zeep client (loading the WSDL) ahead of sending, and
+        return the time it took.
+
+        Failures are logged and left to the sending of the invoices.
+        """
+        if not self.mock:
+            try:
+                self.client
+            except Exception:
+                pass
+        return self.startup_time
 
     @staticmethod
     def from_settings() -> "PrismeClient":
@@ -160,6 +267,8 @@ class PrismeClient(Prisme):
                     auth=prisme_settings["auth"],
                     proxy=prisme_settings["proxy"],
                     mock=False,
+                    wsdl_cache=prisme_settings.get("wsdl_cache"),
+                    pool_size=prisme_settings.get("pool_size", 10),
                 )
         return PrismeClient.instance
 
@@ -0,0 +1,379 @@
+import random
+import threading
+import time
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List, Set, Tuple
+from xml.etree import ElementTree
+from xml.sax.saxutils import escape
+
+from prisme.invoice import InvoiceRequest
+
+from havneafgifter.clients.prisme import InvoiceCustomTableRequest
+
+# A local stand-in for the Prisme SOAP service, for testing the sending of
+# invoices without the real service.
+#
+# Only the operation used by `PrismeClient` (`processService`) is implemented,
+# for the methods of `HavneafgiftInvoiceRequest` (creating an invoice) and
+# `InvoiceCustomTableRequest` (creating a debitor account). The stand-in serves
+# its own WSDL, so the regular zeep client talks to it exactly as it talks to
+# Prisme, and can delay its replies, fail at random, and reply that the debitor
+# account does not exist for a given share of the CVR numbers.
+
+NAMESPACE = "http://schemas.datacontract.org/2004/07/Dynamics.Ax.Application"
+
+DEBITOR_MISSING_TEXT = "Debitorkonto findes ikke"
+
+WSDL = """<?xml version="1.0" encoding="utf-8"?>
+<wsdl:definitions
+    xmlns:wsdl="http://schemas.xmlsoap.org/wsdl/"
+    xmlns:soap="http://schemas.xmlsoap.org/wsdl/soap/"
+    xmlns:xsd="http://www.w3.org/2001/XMLSchema"
+    xmlns:tns="{namespace}"
+    targetNamespace="{namespace}">
+  <wsdl:types>
+    <xsd:schema elementFormDefault="qualified" targetNamespace="{namespace}">
+      <xsd:complexType name="GWSRequestHeaderDCFUJ">
+        <xsd:sequence>
+          <xsd:element name="area" type="xsd:string" minOccurs="0"/>
+          <xsd:element name="clientVersion" type="xsd:int" minOccurs="0"/>
+          <xsd:element name="method" type="xsd:string" minOccurs="0"/>
+        </xsd:sequence>
+      </xsd:complexType>
+      <xsd:complexType name="GWSRequestXMLDCFUJ">
+        <xsd:sequence>
+          <xsd:element name="xml" type="xsd:string" minOccurs="0"/>
+        </xsd:sequence>
+      </xsd:complexType>
+      <xsd:complexType name="ArrayOfGWSRequestXMLDCFUJ">
+        <xsd:sequence>
+          <xsd:element name="GWSRequestXMLDCFUJ" type="tns:GWSRequestXMLDCFUJ"
+                       minOccurs="0" maxOccurs="unbounded"/>
+        </xsd:sequence>
+      </xsd:complexType>
+      <xsd:complexType name="GWSRequestDCFUJ">
+        <xsd:sequence>
+          <xsd:element name="requestHeader" type="tns:GWSRequestHeaderDCFUJ"
+                       minOccurs="0"/>
+          <xsd:element name="xmlCollection" type="tns:ArrayOfGWSRequestXMLDCFUJ"
+                       minOccurs="0"/>
+        </xsd:sequence>
+      </xsd:complexType>
+      <xsd:complexType name="GWSReplyStatusDCFUJ">
+        <xsd:sequence>
+          <xsd:element name="replyCode" type="xsd:int" minOccurs="0"/>
+          <xsd:element name="replyText" type="xsd:string" minOccurs="0"/>
+        </xsd:sequence>
+      </xsd:complexType>
+      <xsd:complexType name="GWSReplyInstanceDCFUJ">
+        <xsd:sequence>
+          <xsd:element name="replyCode" type="xsd:int" minOccurs="0"/>
+          <xsd:element name="replyText" type="xsd:string" minOccurs="0"/>
+          <xsd:element name="xml" type="xsd:string" minOccurs="0"/>
+        </xsd:sequence>
+      </xsd:complexType>
+      <xsd:complexType name="ArrayOfGWSReplyInstanceDCFUJ">
+        <xsd:sequence>
+          <xsd:element name="GWSReplyInstanceDCFUJ"
+                       type="tns:GWSReplyInstanceDCFUJ"
+                       minOccurs="0" maxOccurs="unbounded"/>
+        </xsd:sequence>
+      </xsd:complexType>
+      <xsd:complexType name="GWSReplyDCFUJ">
+        <xsd:sequence>
+          <xsd:element name="instanceCollection"
+                       type="tns:ArrayOfGWSReplyInstanceDCFUJ" minOccurs="0"/>
+          <xsd:element name="status" type="tns:GWSReplyStatusDCFUJ"
+                       minOccurs="0"/>
+        </xsd:sequence>
+      </xsd:complexType>
+      <xsd:element name="processService">
+        <xsd:complexType>
+          <xsd:sequence>
+            <xsd:element name="request" type="tns:GWSRequestDCFUJ"/>
+          </xsd:sequence>
+        </xsd:complexType>
+      </xsd:element>
+      <xsd:element name="processServiceResponse">
+        <xsd:complexType>
+          <xsd:sequence>
+            <xsd:element name="response" type="tns:GWSReplyDCFUJ"/>
+          </xsd:sequence>
+        </xsd:complexType>
+      </xsd:element>
+    </xsd:schema>
+  </wsdl:types>
+  <wsdl:message name="processServiceRequest">
+    <wsdl:part name="parameters" element="tns:processService"/>
+  </wsdl:message>
+  <wsdl:message name="processServiceResponse">
+    <wsdl:part name="parameters" element="tns:processServiceResponse"/>
+  </wsdl:message>
+  <wsdl:portType name="GWSService">
+    <wsdl:operation name="processService">
+      <wsdl:input message="tns:processServiceRequest"/>
+      <wsdl:output message="tns:processServiceResponse"/>
+    </wsdl:operation>
+  </wsdl:portType>
+  <wsdl:binding name="GWSServiceBinding" type="tns:GWSService">
+    <soap:binding transport="http://schemas.xmlsoap.org/soap/http"/>
+    <wsdl:operation name="processService">
+      <soap:operation soapAction="{namespace}/GWSService/processService"
+                      style="document"/>
+      <wsdl:input><soap:body use="literal"/></wsdl:input>
+      <wsdl:output><soap:body use="literal"/></wsdl:output>
+    </wsdl:operation>
+  </wsdl:binding>
+  <wsdl:service name="GWSService">
+    <wsdl:port name="GWSServicePort" binding="tns:GWSServiceBinding">
+      <soap:address location="{location}"/>
+    </wsdl:port>
+  </wsdl:service>
+</wsdl:definitions>
+"""
+
+RESPONSE = """<?xml version="1.0" encoding="utf-8"?>
+<s:Envelope xmlns:s="http://schemas.xmlsoap.org/soap/envelope/">
+  <s:Body>
+    <processServiceResponse xmlns="{namespace}">
+      <response>
+        <instanceCollection>{instances}</instanceCollection>
+        <status>
+          <replyCode>{code}</replyCode>
+          <replyText>{text}</replyText>
+        </status>
+      </response>
+    </processServiceResponse>
+  </s:Body>
+</s:Envelope>
+"""
+
+INSTANCE = """
+          <GWSReplyInstanceDCFUJ>
+            <replyCode>{code}</replyCode>
+            <replyText>{text}</replyText>
+            <xml>{xml}</xml>
+          </GWSReplyInstanceDCFUJ>"""
+
+
+@dataclass
+class StandInConfig:
+    # Delay (in seconds) of each reply, plus a random delay of up to `jitter`
+    latency: float = 0.0
+    jitter: float = 0.0
+    # Share of the requests failing with `error_code`
+    error_rate: float = 0.0
+    error_code: int = 500
+    # Share of the CVR numbers not having a debitor account, until one is
+    # created. Whether a CVR number has an account is decided the first time
+    # it is seen.
+    debitor_missing_rate: float = 0.0
+    # Seed of the random decisions above, for repeatable runs
+    seed: int | None = None
+
+    @staticmethod
+    def add_arguments(parser):
+        # Command line options of management commands using the stand-in
+        parser.add_argument(
+            "--latency", type=float, default=0.0, help="Delay of each reply (s)"
+        )
+        parser.add_argument(
+            "--jitter", type=float, default=0.0, help="Extra random delay (s)"
+        )
+        parser.add_argument(
+            "--error-rate",
+            type=float,
+            default=0.0,
+            help="Share of requests failing (0-1)",
+        )
+        parser.add_argument(
+            "--debitor-missing-rate",
+            type=float,
+            default=0.0,
+            help="Share of CVR numbers without a debitor account (0-1)",
+        )
+        parser.add_argument("--seed", type=int, help="Seed for repeatable runs")
+
+    @classmethod
+    def from_options(cls, options) -> "StandInConfig":
+        return cls(
+            latency=options["latency"],
+            jitter=options["jitter"],
+            error_rate=options["error_rate"],
+            debitor_missing_rate=options["debitor_missing_rate"],
+            seed=options["seed"],
+        )
+
+
+@dataclass
+class StandInStats:
+    requests: int = 0
+    errors: int = 0
+    invoices: int = 0
+    debitors_missing: int = 0
+    debitors_created: int = 0
+
+    def __str__(self) -> str:
+        return (
+            f"{self.requests} requests, {self.errors} errors, "
+            f"{self.invoices} invoices, {self.debitors_missing} missing debitors, "
+            f"{self.debitors_created} debitors created"
+        )
+
+
+# A reply instance: code, text and XML
+Reply = Tuple[int, str, str]
+
+
+@dataclass
+class PrismeStandIn:
+    config: StandInConfig = field(default_factory=StandInConfig)
+    stats: StandInStats = field(default_factory=StandInStats)
+    # CVR numbers with (True) or without (False) a debitor account
+    debitors: dict[str, bool] = field(default_factory=dict)
+    invoiced: Set[str] = field(default_factory=set)
+
+    def __post_init__(self):
+        self._random = random.Random(self.config.seed)
+        self._lock = threading.Lock()
+        self._rec_id = 0
+
+    def process(self, method: str, xml: List[str]) -> Tuple[int, str, List[Reply]]:
+        """Handle a `processService` call, returning the reply code and text of
+        the call, and a reply per request XML."""
+        with self._lock:
+            self.stats.requests += 1
+            delay = self.config.latency + self._random.uniform(0, self.config.jitter)
+            failed = self._random.random() < self.config.error_rate
+        if delay:
+            time.sleep(delay)
+        if failed:
+            with self._lock:
+                self.stats.errors += 1
+            return self.config.error_code, "Stand-in error", []
+        if method == InvoiceRequest.method:
+            return 0, "", [self._create_invoice(x) for x in xml]
+        if method == InvoiceCustomTableRequest.method:
+            return 0, "", [self._create_debitor(x) for x in xml]
+        return 1, f"Unknown method {method}", []
+
+    def _parse(self, xml: str) -> Tuple[str, str]:
+        root = ElementTree.fromstring(xml)
+        return (
+            root.findtext("HarborTaxIdFUJ", ""),
+            root.findtext("custTable/IdentificationNumber", ""),
+        )
+
+    def _create_invoice(self, xml: str) -> Reply:
+        afgift_id, cvr = self._parse(xml)
+        with self._lock:
+            if cvr not in self.debitors:
+                self.debitors[cvr] = (
+                    self._random.random() >= self.config.debitor_missing_rate
+                )
+            if not self.debitors[cvr]:
+                self.stats.debitors_missing += 1
+                return 1, DEBITOR_MISSING_TEXT, ""
+            self.stats.invoices += 1
+            self.invoiced.add(afgift_id)
+            self._rec_id += 1
+            return (
+                0,
+                "",
+                f"<CustInvoiceTable><RecId>{self._rec_id}</RecId>"
+                f"<HarborTaxIdFUJ>{afgift_id}</HarborTaxIdFUJ>"
+                f"<InvoiceId>{self._rec_id}</InvoiceId></CustInvoiceTable>",
+            )
+
+    def _create_debitor(self, xml: str) -> Reply:
+        afgift_id, cvr = self._parse(xml)
+        with self._lock:
+            self.debitors[cvr] = True
+            self.stats.debitors_created += 1
+        return 0, "", f"<CustTable><AccountNum>{cvr}</AccountNum></CustTable>"
+
+
+class PrismeStandInHandler(BaseHTTPRequestHandler):
+    server: "PrismeStandInServer"
+    # Keep connections alive, as Prisme does
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self._send(200, WSDL.format(namespace=NAMESPACE, location=self.server.url))
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        envelope = ElementTree.fromstring(body)
+        method = envelope.findtext(".//{*}requestHeader/{*}method", "")
+        xml = [
+            element.text or ""
+            for element in envelope.iterfind(".//{*}xmlCollection/{*}*/{*}xml")
+        ]
+        code, text, replies = self.server.stand_in.process(method, xml)
+        instances = "".join(
+            INSTANCE.format(
+                code=reply_code, text=escape(reply_text), xml=escape(reply_xml)
+            )
+            for reply_code, reply_text, reply_xml in replies
+        )
+        self._send(
+            200,
+            RESPONSE.format(
+                namespace=NAMESPACE, instances=instances, code=code, text=escape(text)
+            ),
+        )
+
+    def _send(self, status: int, content: str):
+        data = content.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "text/xml; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class PrismeStandInServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(
+        self,
+        stand_in: PrismeStandIn | None = None,
+        host: str = "127.0.0.1",
+        port: int = 0,
+    ):
+        super().__init__((host, port), PrismeStandInHandler)
+        self.host = host
+        self.stand_in = stand_in or PrismeStandIn()
+        self._thread: threading.Thread | None = None
+
+    @property
+    def url(self) -> str:
+        # The port is chosen by the OS, if not given
+        return f"http://{self.host}:{self.server_port}/"
+
+    @property
+    def wsdl_url(self) -> str:
+        return f"{self.url}?wsdl"
+
+    def start(self) -> "PrismeStandInServer":
+        """Serve in a background thread, until `stop` is called."""
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def __enter__(self) -> "PrismeStandInServer":
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
@@ -1,5 +1,7 @@
-from dataclasses import dataclass
+from bisect import bisect_right
+from dataclasses import dataclass, field
 from datetime import date, datetime, timedelta
+from typing import List, Sequence
 
 
 # A finite range of dates
@@ -21,32 +23,110 @@ class DateRange:
         return days.days
 
 
+def started_days(start_datetime: datetime, end_datetime: datetime) -> int:
+    started_whole_days = (end_datetime.date() - start_datetime.date()).days
+    started_partial_day = 1 if end_datetime.time() > start_datetime.time() else 0
+    return started_whole_days + started_partial_day
+
+
+def started_weeks(start_datetime: datetime, end_datetime: datetime) -> int:
+    delta = end_datetime - start_datetime
+    whole_days = delta.days
+    whole_weeks = whole_days // 7
+    extra_days = whole_days - (whole_weeks * 7)
+    partial_day = 1 if delta.seconds > 0 else 0
+    partial_week = 1 if extra_days or partial_day else 0
+    return whole_weeks + partial_week
+
+
 # A finite range of dates
-@dataclass
+@dataclass(frozen=True, slots=True)
 class DateTimeRange:
     start_datetime: datetime  # first day of range
     end_datetime: datetime  # first day out of range
 
+    # Derived values, computed once
+    _started_days: int = field(init=False, repr=False, compare=False)
+    _started_weeks: int = field(init=False, repr=False, compare=False)
+
+    def __post_init__(self):
+        object.__setattr__(
+            self,
+            "_started_days",
+            started_days(self.start_datetime, self.end_datetime),
+        )
+        object.__setattr__(
+            self,
+            "_started_weeks",
+            started_weeks(self.start_datetime, self.end_datetime),
+        )
+
     @property
     def timedelta(self) -> timedelta:
         return self.end_datetime - self.start_datetime
 
     @property
     def started_days(self) -> int:
-        started_whole_days = (
-            self.end_datetime.date() - self.start_datetime.date()
-        ).days
-        started_partial_day = (
-            1 if self.end_datetime.time() > self.start_datetime.time() else 0
-        )
-        return started_whole_days + started_partial_day
+        return self._started_days
 
     @property
     def started_weeks(self) -> int:
-        delta = self.timedelta
-        whole_days = delta.days
-        whole_weeks = whole_days // 7
-        extra_days = whole_days - (whole_weeks * 7)
-        partial_day = 1 if delta.seconds > 0 else 0
-        partial_week = 1 if extra_days or partial_day else 0
-        return whole_weeks + partial_week
+        return self._started_weeks
+
+
+# The overlaps between a number of datetime ranges and a number of periods, as
+# computed by `overlap_periods`. Each overlap is stored in the columns below, at the
+# same position in every list, without creating a `DateTimeRange` per overlap.
+@dataclass
+class PeriodOverlaps:
+    range_index: List[int] = field(default_factory=list)
+    period_index: List[int] = field(default_factory=list)
+    start_datetime: List[datetime] = field(default_factory=list)
+    end_datetime: List[datetime] = field(default_factory=list)
+    started_days: List[int] = field(default_factory=list)
+    started_weeks: List[int] = field(default_factory=list)
+
+    def __len__(self) -> int:
+        return len(self.range_index)
+
+
+def overlap_periods(
+    starts: Sequence[datetime],
+    ends: Sequence[datetime],
+    period_starts: Sequence[datetime | None],
+    period_ends: Sequence[datetime | None],
+) -> PeriodOverlaps:
+    """Return the overlaps between each range from `starts[i]` to `ends[i]` and
+    each period from `period_starts[j]` to `period_ends[j]`.
+
+    A period start or end of `None` is open. The periods must be ordered by their
+    start, open start first (as `TaxRates`). Like `TaxRates.get_overlap`, periods
+    merely touching a range are included, and the overlaps are listed per range in
+    the order of the periods.
+    """
+    open_start = sum(1 for period_start in period_starts if period_start is None)
+    closed_starts = period_starts[open_start:]
+    overlaps = PeriodOverlaps()
+    for range_index, (start, end) in enumerate(zip(starts, ends)):
+        # All periods starting no later than the end of the range
+        count = open_start + bisect_right(closed_starts, end)  # type: ignore
+        for period_index in range(count):
+            period_start = period_starts[period_index]
+            period_end = period_ends[period_index]
+            if period_end is not None and period_end < start:
+                continue
+            overlap_start = (
+                period_start
+                if period_start is not None and period_start > start
+                else start
+            )
+            overlap_end = (
+                period_end if period_end is not None and period_end < end else end
+            )
+            overlaps.range_index.append(range_index)
+            overlaps.period_index.append(period_index)
+            overlaps.start_datetime.append(overlap_start)
+            overlaps.end_datetime.append(overlap_end)
+            overlaps.started_days.append(started_days(overlap_start, overlap_end))
+            overlaps.started_weeks.append(started_weeks(overlap_start, overlap_end))
+    return overlaps
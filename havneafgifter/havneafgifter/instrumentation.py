@@ -0,0 +1,116 @@
+from __future__ import annotations
+
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Dict, Iterator
+
+from django.db import transaction
+from django.db.models import F
+from django.db.models.functions import Greatest
+
+# Timing of the stages of a pipeline (e.g. sending invoices), for finding out
+# where the time goes without attaching a profiler.
+#
+# A stage is timed by wrapping it in `span(name)`, and events (e.g. retries) are
+# counted by `count(name)`. Each span is logged (at DEBUG level, with the stage
+# name and duration as structured `extra` fields), and the spans and counters
+# are accumulated in memory per process. `flush` logs a summary and adds the
+# accumulated values to the `StageMetric` table, which is shared by all
+# processes (such as the cron jobs sending invoices), and exposed by the metrics
+# app.
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class SpanStats:
+    count: int = 0
+    total: float = 0.0
+    max: float = 0.0
+
+    def add(self, duration: float):
+        self.count += 1
+        self.total += duration
+        self.max = max(self.max, duration)
+
+    @property
+    def mean(self) -> float:
+        return self.total / self.count if self.count else 0.0
+
+
+class Instrumentation:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.spans: Dict[str, SpanStats] = {}
+        self.counters: Dict[str, int] = {}
+
+    @contextmanager
+    def span(self, name: str, **context) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - start
+            with self._lock:
+                self.spans.setdefault(name, SpanStats()).add(duration)
+            logger.debug(
+                "%s took %.3f s",
+                name,
+                duration,
+                extra={"span": name, "duration": duration, **context},
+            )
+
+    def count(self, name: str, n: int = 1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def reset(self):
+        with self._lock:
+            self.spans = {}
+            self.counters = {}
+
+    def flush(self):
+        """Log and save the accumulated spans and counters, and start over."""
+        from havneafgifter.models import MetricKind, StageMetric
+
+        with self._lock:
+            spans, self.spans = self.spans, {}
+            counters, self.counters = self.counters, {}
+        if not spans and not counters:
+            return
+        logger.info(
+            "Stage timings: %s",
+            ", ".join(
+                [
+                    f"{name} {stats.count} x {stats.mean:.3f} s "
+                    f"(max {stats.max:.3f} s)"
+                    for name, stats in sorted(spans.items())
+                ]
+                + [f"{name} {value}" for name, value in sorted(counters.items())]
+            ),
+        )
+        with transaction.atomic():
+            for name, stats in spans.items():
+                metric, _ = StageMetric.objects.select_for_update().get_or_create(
+                    kind=MetricKind.SPAN, name=name
+                )
+                StageMetric.objects.filter(pk=metric.pk).update(
+                    count=F("count") + stats.count,
+                    total_seconds=F("total_seconds") + stats.total,
+                    max_seconds=Greatest(F("max_seconds"), stats.max),
+                )
+            for name, value in counters.items():
+                metric, _ = StageMetric.objects.select_for_update().get_or_create(
+                    kind=MetricKind.COUNTER, name=name
+                )
+                StageMetric.objects.filter(pk=metric.pk).update(
+                    count=F("count") + value
+                )
+
+
+instrumentation = Instrumentation()
+span = instrumentation.span
+count = instrumentation.count
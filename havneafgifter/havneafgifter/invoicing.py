@@ -0,0 +1,236 @@
+from __future__ import annotations
+
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import Callable, Dict, Iterable, List, Set
+
+from django.db import connection, transaction
+from django.db.models import Exists, OuterRef, Q, QuerySet
+
+from havneafgifter.instrumentation import instrumentation
+from havneafgifter.models import (
+    CruiseTaxForm,
+    HarborDuesForm,
+    InvoiceOutboxItem,
+    PrismeDebitor,
+    Status,
+)
+
+logger = logging.getLogger(__name__)
+
+# Sending of invoices to Prisme for all NEW forms.
+#
+# Several dispatchers (e.g. overlapping cron runs) may run at the same time. A
+# dispatcher claims a batch of forms by locking their rows with
+# `SELECT ... FOR UPDATE SKIP LOCKED` and setting their `invoice_claimed_at`,
+# and commits that before calling Prisme, so other dispatchers skip those forms
+# instead of invoicing them a second time. Within a dispatcher, a bounded pool
+# of threads each claim and send one batch at a time.
+#
+# The result of each invoice is saved (and its claim cleared) in a transaction
+# of its own, so an invoice accepted by Prisme stays INVOICED when a later form
+# of the batch fails. A form whose result could not be saved, e.g. because of a
+# database error or because the dispatcher was killed, keeps its claim: its
+# invoice may have been sent, so it is not sent again until the claim is
+# released (in the admin).
+#
+# Forms whose invoice could not be sent get an `InvoiceOutboxItem`, and are
+# only picked up again once it is due (with exponential backoff), and not at
+# all after a permanent failure.
+#
+# The CVR numbers known to have a debitor account in Prisme are recorded as
+# `PrismeDebitor`s. Optionally, the missing debitor accounts are created before
+# sending the invoices, so the first invoice to a new debitor is not rejected
+# (and sent again, with the receipt attached) after creating the account.
+
+
+@dataclass
+class DispatchReport:
+    forms: int = 0
+    invoiced: int = 0
+    debitors_created: int = 0
+
+    @property
+    def failed(self) -> int:
+        # Forms which could not be sent, and are still NEW
+        return self.forms - self.invoiced
+
+    def merge(self, other: DispatchReport):
+        self.forms += other.forms
+        self.invoiced += other.invoiced
+        self.debitors_created += other.debitors_created
+
+    def __str__(self) -> str:
+        return f"Invoiced {self.invoiced} of {self.forms} forms ({self.failed} failed)"
+
+
+def dispatch_invoices(
+    batch_size: int = 10,
+    threads: int = 1,
+    queryset: QuerySet[HarborDuesForm] | None = None,
+    create_debitors: bool = False,
+) -> DispatchReport:
+    """Send the invoices of all due forms (in `queryset`, if given), claimed in
+    batches of `batch_size` forms, by `threads` worker threads.
+
+    If `create_debitors` is set, the debitor accounts not known to exist in
+    Prisme are created first (see `create_missing_debitors`).
+
+    Each form is attempted at most once per call; forms failing to send remain
+    NEW, and are attempted again once their `InvoiceOutboxItem` is due.
+    """
+    report = DispatchReport()
+    if create_debitors:
+        report.debitors_created = create_missing_debitors(due_forms(queryset=queryset))
+    attempted: Set[int] = set()
+    lock = threading.Lock()
+
+    def claim(pks: List[int]):
+        with lock:
+            attempted.update(pks)
+
+    def work():
+        while True:
+            with lock:
+                exclude = set(attempted)
+            batch_report = dispatch_batch(
+                batch_size, exclude, on_claim=claim, queryset=queryset
+            )
+            with lock:
+                report.merge(batch_report)
+            if batch_report.forms == 0:
+                break
+
+    try:
+        if threads > 1:
+            with ThreadPoolExecutor(max_workers=threads) as pool:
+                futures = [pool.submit(_in_thread, work) for _ in range(threads)]
+                for future in futures:
+                    future.result()
+        else:
+            work()
+    finally:
+        # Log the time spent in each stage, and add it to the metrics
+        instrumentation.flush()
+    return report
+
+
+def due_forms(
+    now: datetime | None = None, queryset: QuerySet[HarborDuesForm] | None = None
+) -> QuerySet[HarborDuesForm]:
+    """Return the NEW forms (in `queryset`, if given) whose invoice should be
+    sent now."""
+    if now is None:
+        now = datetime.now(timezone.utc)
+    if queryset is None:
+        queryset = HarborDuesForm.objects.all()
+    # A subquery rather than a join, as the rows are locked `FOR UPDATE`
+    not_due = InvoiceOutboxItem.objects.filter(form=OuterRef("pk")).filter(
+        Q(permanent_failure=True) | Q(next_attempt_at__gt=now)
+    )
+    return queryset.filter(status=Status.NEW, invoice_claimed_at=None).exclude(
+        Exists(not_due)
+    )
+
+
+def dispatch_batch(
+    batch_size: int,
+    exclude: Iterable[int] = (),
+    on_claim: Callable[[List[int]], None] | None = None,
+    queryset: QuerySet[HarborDuesForm] | None = None,
+) -> DispatchReport:
+    """Claim up to `batch_size` due forms not claimed by another dispatcher (and
+    not in `exclude`), and send their invoices.
+
+    `on_claim` is called with the primary keys of the claimed forms, as soon as
+    the claim is committed.
+    """
+    report = DispatchReport()
+    pks = claim_forms(batch_size, exclude, queryset=queryset)
+    if on_claim is not None:
+        on_claim(pks)
+    for form in _load_forms(pks):
+        report.forms += 1
+        try:
+            with transaction.atomic():
+                form.send_invoice()
+                HarborDuesForm.objects.filter(pk=form.pk).update(
+                    invoice_claimed_at=None
+                )
+        except Exception as e:
+            # The claim is kept, see above
+            logger.exception(e)
+        else:
+            if form.status == Status.INVOICED:
+                report.invoiced += 1
+    return report
+
+
+def claim_forms(
+    batch_size: int,
+    exclude: Iterable[int] = (),
+    queryset: QuerySet[HarborDuesForm] | None = None,
+) -> List[int]:
+    """Claim up to `batch_size` due forms (in `queryset`, if given) not in
+    `exclude`, and return their primary keys."""
+    now = datetime.now(timezone.utc)
+    with transaction.atomic():
+        pks: List[int] = list(
+            due_forms(now, queryset=queryset)
+            .select_for_update(skip_locked=True)
+            .exclude(pk__in=list(exclude))
+            .order_by("pk")
+            .values_list("pk", flat=True)[:batch_size]
+        )
+        HarborDuesForm.objects.filter(pk__in=pks).update(invoice_claimed_at=now)
+    return pks
+
+
+def create_missing_debitors(queryset: QuerySet[HarborDuesForm]) -> int:
+    """Create the debitor accounts in Prisme of the CVR numbers of the forms in
+    `queryset` which are not known to have one, and return the number created.
+
+    Accounts failing to be created are left to `HarborDuesForm.send_invoice`.
+    """
+    forms_by_cvr: Dict[str, HarborDuesForm] = {}
+    for form in _load_forms(queryset.values_list("pk", flat=True)):
+        cvr = form.get_cvr()
+        if cvr:
+            forms_by_cvr.setdefault(cvr, form)
+    known = set(
+        PrismeDebitor.objects.filter(cvr__in=forms_by_cvr).values_list("cvr", flat=True)
+    )
+    created = 0
+    for cvr, form in forms_by_cvr.items():
+        if cvr not in known:
+            try:
+                form.create_debitor(cvr)
+            except Exception as e:
+                logger.exception(e)
+            else:
+                created += 1
+    return created
+
+
+def _load_forms(pks: Iterable[int]) -> List[HarborDuesForm]:
+    # Load cruise tax forms as such, as they have their own invoice lines and
+    # receipt
+    pks = list(pks)
+    forms: List[HarborDuesForm] = [
+        *HarborDuesForm.objects.filter(
+            pk__in=pks, cruisetaxform__isnull=True
+        ).select_related("shipping_agent"),
+        *CruiseTaxForm.objects.filter(pk__in=pks).select_related("shipping_agent"),
+    ]
+    return sorted(forms, key=lambda form: form.pk)
+
+
+def _in_thread(func):
+    # Each thread has its own database connection, which is closed when done
+    try:
+        func()
+    finally:
+        connection.close()
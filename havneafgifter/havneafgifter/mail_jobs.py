@@ -0,0 +1,228 @@
+from __future__ import annotations
+
+import logging
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, wait
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Iterable, List
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.db.models import F, Q, QuerySet
+from django.utils import translation
+from django.utils.translation import gettext
+
+from havneafgifter import mails
+from havneafgifter.models import (
+    CruiseTaxForm,
+    HarborDuesForm,
+    MailJob,
+    MailJobStatus,
+    User,
+)
+from havneafgifter.workers import process_pool
+
+logger = logging.getLogger(__name__)
+
+# Sending of notification mails outside of the request.
+#
+# Rendering the receipt PDF and talking to the SMTP server can take seconds,
+# so views only record a `MailJob` (in the same transaction as the form), and
+# return at once. The `mail_worker` command claims the pending jobs with
+# `SELECT ... FOR UPDATE SKIP LOCKED` (so several workers may run), and runs
+# them in a pool of worker processes. The outcome of each job is stored on it,
+# and shown to the user on their next page view (see
+# `HandleNotificationMailMixin.add_mail_job_messages`).
+#
+# Failing jobs are attempted again after an exponentially growing delay. Jobs
+# whose worker process crashed are attempted again at once, in a new pool if
+# the crash broke the pool. Each `mail_worker` records a heartbeat on its
+# running jobs, so jobs left running by a worker which is gone (e.g. killed)
+# are attempted again once their heartbeat is `MAIL_JOBS["timeout"]` seconds
+# old, while slow jobs of a live worker are left alone.
+
+
+def enqueue_mail(
+    mail_class: type[mails.NotificationMail],
+    form: HarborDuesForm | CruiseTaxForm,
+    user: User | None = None,
+) -> MailJob:
+    """Record that `mail_class` should be sent for `form`, by the mail worker."""
+    return MailJob.objects.create(
+        form=form,
+        user=user if isinstance(user, User) else None,
+        mail_class=mail_class.__name__,
+        language=translation.get_language() or settings.LANGUAGE_CODE,
+    )
+
+
+def get_mail_class(name: str) -> type[mails.NotificationMail]:
+    mail_class = getattr(mails, name, None)
+    if not (
+        isinstance(mail_class, type) and issubclass(mail_class, mails.NotificationMail)
+    ):
+        raise ValueError(f"Unknown mail class {name!r}")
+    return mail_class
+
+
+def claim_jobs(limit: int) -> List[int]:
+    """Mark up to `limit` pending jobs which are due as running, and return their
+    primary keys."""
+    if limit <= 0:
+        return []
+    now = datetime.now(timezone.utc)
+    with transaction.atomic():
+        pks: List[int] = list(
+            MailJob.objects.filter(status=MailJobStatus.PENDING)
+            .filter(Q(next_attempt_at=None) | Q(next_attempt_at__lte=now))
+            .select_for_update(skip_locked=True)
+            .order_by("created")
+            .values_list("pk", flat=True)[:limit]
+        )
+        MailJob.objects.filter(pk__in=pks).update(
+            status=MailJobStatus.RUNNING,
+            started=now,
+            heartbeat=now,
+            attempts=F("attempts") + 1,
+        )
+    return pks
+
+
+def keep_alive(pks: Iterable[int]) -> int:
+    """Record that the running jobs among `pks` are still being run, and return
+    their number."""
+    return MailJob.objects.filter(pk__in=pks, status=MailJobStatus.RUNNING).update(
+        heartbeat=datetime.now(timezone.utc)
+    )
+
+
+def requeue_lost_jobs(timeout: int) -> int:
+    """Run the jobs whose heartbeat is more than `timeout` seconds old again (or
+    give up on them), and return their number."""
+    cutoff = datetime.now(timezone.utc) - timedelta(seconds=timeout)
+    return requeue_jobs(
+        MailJob.objects.filter(
+            Q(heartbeat__lt=cutoff) | Q(heartbeat=None, started__lt=cutoff)
+        ),
+        "Timed out",
+    )
+
+
+def requeue_jobs(jobs: QuerySet[MailJob], error: str) -> int:
+    """Run the running jobs among `jobs` again (or give up on them, after
+    `MAIL_JOBS["max_attempts"]` attempts), recording `error`, and return their
+    number."""
+    running = jobs.filter(status=MailJobStatus.RUNNING)
+    max_attempts: int = settings.MAIL_JOBS["max_attempts"]  # type: ignore[misc]
+    requeued = running.filter(attempts__lt=max_attempts).update(
+        status=MailJobStatus.PENDING, error=error
+    )
+    return requeued + running.update(
+        status=MailJobStatus.FAILED,
+        error=error,
+        message=gettext("Error when sending email"),
+        finished=datetime.now(timezone.utc),
+    )
+
+
+def run_mail_job(pk: int) -> str:
+    """Send the mail of a claimed job, record the outcome, and return the new
+    status of the job.
+
+    Failing jobs are pending again, after a delay of `MAIL_JOBS["retry_delay"]`
+    seconds (doubled after each attempt), until they have been attempted
+    `MAIL_JOBS["max_attempts"]` times.
+    """
+    job = MailJob.objects.select_related("user").get(pk=pk)
+    with translation.override(job.language):
+        try:
+            mail = get_mail_class(job.mail_class)(_load_form(job.form_id), job.user)
+            result = mail.send_email()
+        except Exception as e:
+            logger.exception(e)
+            job.error = str(e)
+            if job.attempts < settings.MAIL_JOBS["max_attempts"]:  # type: ignore
+                job.status = MailJobStatus.PENDING
+            else:
+                job.status = MailJobStatus.FAILED
+                job.message = gettext("Error when sending email")
+        else:
+            if result.succeeded:
+                job.status = MailJobStatus.SUCCEEDED
+                job.message = mail.success_message
+            else:
+                job.status = MailJobStatus.FAILED
+                job.message = mail.error_message
+    job.finished = datetime.now(timezone.utc)
+    if job.status == MailJobStatus.PENDING:
+        delay: int = settings.MAIL_JOBS["retry_delay"]  # type: ignore[misc]
+        job.next_attempt_at = job.finished + timedelta(
+            seconds=delay * 2 ** (job.attempts - 1)
+        )
+    job.save(
+        update_fields=["status", "error", "message", "finished", "next_attempt_at"]
+    )
+    return job.status
+
+
+def run_worker(
+    workers: int, poll_interval: float, timeout: int, once: bool = False
+) -> int:
+    """Run the pending jobs in a pool of `workers` processes, looking for new
+    jobs every `poll_interval` seconds, until interrupted (or, if `once` is set,
+    until no jobs are pending and due). Return the number of jobs run."""
+    jobs = 0
+    pool = process_pool(workers)
+    running: Dict[Future, int] = {}
+    try:
+        while True:
+            # Jobs still running in this worker are not lost, however long
+            # they take
+            keep_alive(running.values())
+            requeue_lost_jobs(timeout)
+            for pk in claim_jobs(workers - len(running)):
+                running[pool.submit(_run_in_process, pk)] = pk
+                jobs += 1
+            if not running:
+                if once:
+                    return jobs
+                time.sleep(poll_interval)
+                continue
+            done, _ = wait(running, timeout=poll_interval, return_when=FIRST_COMPLETED)
+            broken = False
+            for future in done:
+                pk = running.pop(future)
+                try:
+                    future.result()
+                except Exception as e:
+                    # Errors in the jobs themselves are recorded by
+                    # `run_mail_job`, so the worker process crashed, or the
+                    # outcome of the job could not be saved
+                    logger.exception(e)
+                    requeue_jobs(MailJob.objects.filter(pk=pk), repr(e))
+                    broken = broken or isinstance(e, BrokenProcessPool)
+            if broken:
+                # The other jobs of a broken pool fail as well, and are
+                # requeued as they are collected
+                pool.shutdown(wait=False)
+                pool = process_pool(workers)
+    finally:
+        pool.shutdown(cancel_futures=True)
+
+
+def _run_in_process(pk: int) -> str:
+    # The worker processes are long-lived, so drop their database connection
+    # if it is broken or too old, as at the end of a request
+    close_old_connections()
+    try:
+        return run_mail_job(pk)
+    finally:
+        close_old_connections()
+
+
+def _load_form(pk: int) -> HarborDuesForm | CruiseTaxForm:
+    # Load cruise tax forms as such, as they have their own receipt
+    return CruiseTaxForm.objects.filter(pk=pk).first() or HarborDuesForm.objects.get(
+        pk=pk
+    )
@@ -1,9 +1,7 @@
 import logging
 from dataclasses import dataclass
-from io import BytesIO
 
 from django.conf import settings
-from django.core.files import File
 from django.core.mail import EmailMessage
 from django.db.models import Model
 from django.templatetags.l10n import localize
@@ -11,6 +9,7 @@ from django.utils import translation
 from django.utils.translation import gettext
 
 from havneafgifter.models import CruiseTaxForm, HarborDuesForm, ShipType, User, UserType
+from havneafgifter.receipts import get_receipt_pdf, save_receipt_pdf
 
 logger = logging.getLogger(__name__)
 
@@ -103,18 +102,15 @@ class NotificationMail:
             from_email=settings.EMAIL_SENDER,
             bcc=self.mail_recipients,
         )
-        receipt = self.form.get_receipt()
+        pdf = get_receipt_pdf(self.form)
         msg.attach(
             filename=self.form.get_pdf_filename(),
-            content=receipt.pdf,
+            content=pdf,
             mimetype="application/pdf",
         )
         result = msg.send(fail_silently=False)
         if result:
-            self.form.pdf = File(
-                BytesIO(receipt.pdf), name=self.form.get_pdf_filename()
-            )
-            self.form.save(update_fields=["pdf"])
+            save_receipt_pdf(self.form, pdf)
         return SendResult(mail=self, succeeded=result == 1, msg=msg)
 
     @property
@@ -0,0 +1,25 @@
+# SPDX-FileCopyrightText: 2026 Magenta ApS <info@magenta.dk>
+#
+# SPDX-License-Identifier: MPL-2.0
+
+from django.core.management.base import BaseCommand
+
+from havneafgifter.receipts import clear_receipt_cache
+
+
+class Command(BaseCommand):
+    help = (
+        "Delete the stored receipt previews, e.g. after changing the receipt "
+        "templates"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--stored",
+            action="store_true",
+            help="Also stop serving the stored receipts of forms as previews",
+        )
+
+    def handle(self, *args, **options):
+        deleted = clear_receipt_cache(stored=options["stored"])
+        self.stdout.write(f"Deleted {deleted} receipt previews")
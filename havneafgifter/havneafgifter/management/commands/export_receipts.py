@@ -0,0 +1,79 @@
+# SPDX-FileCopyrightText: 2026 Magenta ApS <info@magenta.dk>
+#
+# SPDX-License-Identifier: MPL-2.0
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from havneafgifter.models import HarborDuesForm
+from havneafgifter.receipt_export import (
+    EXPORT_FORMATS,
+    iter_export_forms,
+    iter_merged_pdf,
+    iter_receipt_zip,
+    iter_stored_receipts,
+)
+from havneafgifter.tables import HarborDuesFormFilter
+
+
+class Command(BaseCommand):
+    help = (
+        "Export the receipts of the forms matching the given filters (as in "
+        "the form list, e.g. status=APPROVED arrival_after=2026-05-01) as a "
+        "ZIP file or as a single PDF"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "filters",
+            nargs="*",
+            metavar="FILTER=VALUE",
+            help="Filters of the form list",
+        )
+        parser.add_argument("--output", required=True, help="File to write")
+        parser.add_argument(
+            "--format",
+            choices=EXPORT_FORMATS,
+            default="zip",
+            help="Export a ZIP file of receipts, or a single PDF",
+        )
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=settings.RECEIPT_EXPORT["workers"],
+            help="Number of processes rendering receipts (ZIP files only)",
+        )
+
+    def handle(self, *args, **options):
+        data = {}
+        for item in options["filters"]:
+            key, sep, value = item.partition("=")
+            if not sep:
+                raise CommandError(f"Filters must be given as FILTER=VALUE: {item}")
+            data[key] = value
+        filterset = HarborDuesFormFilter(data, queryset=HarborDuesForm.objects.all())
+        unknown = set(data) - set(filterset.filters)
+        if unknown:
+            raise CommandError(f"Unknown filters: {', '.join(sorted(unknown))}")
+        if not filterset.is_valid():
+            raise CommandError(filterset.errors.as_text())
+        queryset = filterset.qs
+        count = queryset.count()
+        if options["format"] == "pdf":
+            limit = settings.RECEIPT_EXPORT["max_merged_forms"]
+            if count > limit:
+                raise CommandError(
+                    f"{count} forms are too many to merge into a single PDF "
+                    f"(at most {limit}), export them as a ZIP file instead"
+                )
+            if count == 0:
+                raise CommandError("No forms match the filters")
+            chunks = iter_merged_pdf(iter_export_forms(queryset))
+        else:
+            chunks = iter_receipt_zip(
+                iter_stored_receipts(iter_export_forms(queryset), options["workers"])
+            )
+        with open(options["output"], "wb") as file:
+            for chunk in chunks:
+                file.write(chunk)
+        self.stdout.write(f"Exported {count} receipts to {options['output']}")
@@ -0,0 +1,43 @@
+# SPDX-FileCopyrightText: 2026 Magenta ApS <info@magenta.dk>
+#
+# SPDX-License-Identifier: MPL-2.0
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from havneafgifter.mail_jobs import run_worker
+
+
+class Command(BaseCommand):
+    help = (
+        "Render receipts and send the notification mails queued by the web "
+        "application, using a pool of worker processes"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=settings.MAIL_JOBS["workers"],
+            help="Number of worker processes",
+        )
+        parser.add_argument(
+            "--poll-interval",
+            type=float,
+            default=settings.MAIL_JOBS["poll_interval"],
+            help="Seconds between looking for new mail jobs",
+        )
+        parser.add_argument(
+            "--once",
+            action="store_true",
+            help="Exit when no mail jobs are pending",
+        )
+
+    def handle(self, *args, **options):
+        jobs = run_worker(
+            workers=options["workers"],
+            poll_interval=options["poll_interval"],
+            timeout=settings.MAIL_JOBS["timeout"],
+            once=options["once"],
+        )
+        self.stdout.write(f"Ran {jobs} mail jobs")
@@ -0,0 +1,129 @@
+# SPDX-FileCopyrightText: 2026 Magenta ApS <info@magenta.dk>
+#
+# SPDX-License-Identifier: MPL-2.0
+
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from havneafgifter.clients.prisme import PrismeClient
+from havneafgifter.clients.prisme_standin import (
+    PrismeStandIn,
+    PrismeStandInServer,
+    StandInConfig,
+)
+from havneafgifter.invoicing import dispatch_invoices
+from havneafgifter.models import HarborDuesForm, PrismeDebitor, ShippingAgent, Status
+
+# Fields not copied from the template form
+SKIPPED_FIELDS = ("id", "status", "shipping_agent", "pdf", "prisme_recid")
+
+
+class Command(BaseCommand):
+    help = (
+        "Measure the throughput of sending invoices, by sending the invoices of "
+        "a number of new forms (copies of a template form) to a local Prisme "
+        "stand-in. The forms are deleted afterwards. Only for development and "
+        "test databases."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--forms", type=int, default=100, help="Number of forms to invoice"
+        )
+        parser.add_argument(
+            "--debitors",
+            type=int,
+            default=10,
+            help="Number of distinct CVR numbers invoiced",
+        )
+        parser.add_argument(
+            "--template",
+            type=int,
+            help="Primary key of the form to copy (default: any complete form)",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=10,
+            help="Number of forms claimed (and locked) at a time",
+        )
+        parser.add_argument(
+            "--threads",
+            type=int,
+            default=1,
+            help="Send the invoices using this many threads",
+        )
+        parser.add_argument(
+            "--create-debitors",
+            action="store_true",
+            help="First create the debitor accounts not known to exist in Prisme",
+        )
+        StandInConfig.add_arguments(parser)
+
+    def handle(self, *args, **options):
+        template = self.get_template(options["template"])
+        agents = ShippingAgent.objects.bulk_create(
+            ShippingAgent(name=f"Prisme load test {i}", cvr=90000000 + i)
+            for i in range(options["debitors"])
+        )
+        forms = HarborDuesForm.objects.bulk_create(
+            self.copy_form(template, status=Status.NEW, shipping_agent=agent)
+            for agent in (agents[i % len(agents)] for i in range(options["forms"]))
+        )
+        stand_in = PrismeStandIn(StandInConfig.from_options(options))
+        instance = PrismeClient.instance
+        try:
+            with PrismeStandInServer(stand_in) as server:
+                PrismeClient.instance = PrismeClient(server.wsdl_url, auth={})
+                start = time.perf_counter()
+                report = dispatch_invoices(
+                    batch_size=options["batch_size"],
+                    threads=options["threads"],
+                    create_debitors=options["create_debitors"],
+                    queryset=HarborDuesForm.objects.filter(
+                        pk__in=[form.pk for form in forms]
+                    ),
+                )
+                elapsed = time.perf_counter() - start
+        finally:
+            PrismeClient.instance = instance
+            self.delete_forms(forms)
+            ShippingAgent.objects.filter(pk__in=[agent.pk for agent in agents]).delete()
+            PrismeDebitor.objects.filter(
+                cvr__in=[str(agent.cvr) for agent in agents]
+            ).delete()
+
+        self.stdout.write(str(report))
+        self.stdout.write(
+            f"{elapsed:.2f} s, {report.invoiced / elapsed:.1f} invoices per second"
+        )
+        self.stdout.write(f"Prisme stand-in: {stand_in.stats}")
+
+    def get_template(self, pk: int | None) -> HarborDuesForm:
+        queryset = HarborDuesForm.objects.filter(cruisetaxform__isnull=True)
+        if pk is not None:
+            queryset = queryset.filter(pk=pk)
+        else:
+            queryset = queryset.exclude(status=Status.DRAFT).filter(
+                port_of_call__isnull=False,
+                datetime_of_arrival__isnull=False,
+                datetime_of_departure__isnull=False,
+                gross_tonnage__isnull=False,
+            )
+        template = queryset.order_by("pk").first()
+        if template is None:
+            raise CommandError("No form to use as template (load demo data first)")
+        return template
+
+    def copy_form(self, template: HarborDuesForm, **kwargs) -> HarborDuesForm:
+        for field in HarborDuesForm._meta.fields:
+            if field.name not in SKIPPED_FIELDS:
+                kwargs.setdefault(field.attname, getattr(template, field.attname))
+        return HarborDuesForm(**kwargs)
+
+    def delete_forms(self, forms):
+        for form in HarborDuesForm.objects.filter(pk__in=[form.pk for form in forms]):
+            if form.pdf:
+                form.pdf.delete(save=False)
+        HarborDuesForm.objects.filter(pk__in=[form.pk for form in forms]).delete()
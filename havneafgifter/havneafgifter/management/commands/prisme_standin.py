@@ -0,0 +1,35 @@
+# SPDX-FileCopyrightText: 2026 Magenta ApS <info@magenta.dk>
+#
+# SPDX-License-Identifier: MPL-2.0
+
+from django.core.management.base import BaseCommand
+
+from havneafgifter.clients.prisme_standin import (
+    PrismeStandIn,
+    PrismeStandInServer,
+    StandInConfig,
+)
+
+
+class Command(BaseCommand):
+    help = (
+        "Run a local stand-in for the Prisme SOAP service. Point PRISME_WSDL at "
+        "the printed WSDL URL (with PRISME_MOCK unset) to send invoices to it."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--host", type=str, default="127.0.0.1")
+        parser.add_argument("--port", type=int, default=8060)
+        StandInConfig.add_arguments(parser)
+
+    def handle(self, *args, **options):
+        stand_in = PrismeStandIn(StandInConfig.from_options(options))
+        server = PrismeStandInServer(stand_in, options["host"], options["port"])
+        self.stdout.write(f"Serving Prisme stand-in, WSDL at {server.wsdl_url}")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            self.stdout.write(str(stand_in.stats))
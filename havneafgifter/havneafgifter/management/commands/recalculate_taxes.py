@@ -0,0 +1,66 @@
+# SPDX-FileCopyrightText: 2026 Magenta ApS <info@magenta.dk>
+#
+# SPDX-License-Identifier: MPL-2.0
+
+from datetime import date
+
+from django.core.management.base import BaseCommand
+
+from havneafgifter.models import Status
+from havneafgifter.recalculation import recalculate_taxes
+
+
+class Command(BaseCommand):
+    help = "Recalculate and store the taxes of existing forms"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--from",
+            dest="arrival_from",
+            type=date.fromisoformat,
+            help="Only forms arriving on or after this date (YYYY-MM-DD)",
+        )
+        parser.add_argument(
+            "--to",
+            dest="arrival_to",
+            type=date.fromisoformat,
+            help="Only forms arriving on or before this date (YYYY-MM-DD)",
+        )
+        parser.add_argument(
+            "--port",
+            dest="ports",
+            type=int,
+            action="append",
+            help="Only forms for this port of call (ID, may be repeated)",
+        )
+        parser.add_argument(
+            "--status",
+            dest="statuses",
+            choices=Status.values,
+            action="append",
+            help="Only forms with this status (may be repeated)",
+        )
+        parser.add_argument("--chunk-size", type=int, default=500)
+        parser.add_argument(
+            "--processes",
+            type=int,
+            default=None,
+            help="Spread the chunks over this many worker processes",
+        )
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            help="Report what would change without saving anything",
+        )
+
+    def handle(self, *args, **options):
+        report = recalculate_taxes(
+            arrival_from=options["arrival_from"],
+            arrival_to=options["arrival_to"],
+            ports=options["ports"],
+            statuses=options["statuses"],
+            chunk_size=options["chunk_size"],
+            processes=options["processes"],
+            dry_run=options["dry_run"],
+        )
+        self.stdout.write(str(report))
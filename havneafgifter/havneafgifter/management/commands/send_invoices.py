@@ -4,11 +4,45 @@
 
 from django.core.management.base import BaseCommand
 
-from havneafgifter.models import HarborDuesForm, Status
+from havneafgifter.clients.prisme import PrismeClient
+from havneafgifter.invoicing import dispatch_invoices
 
 
 class Command(BaseCommand):
+    help = "Send invoices to Prisme for all new forms"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=10,
+            help="Number of forms claimed (and locked) at a time",
+        )
+        parser.add_argument(
+            "--threads",
+            type=int,
+            default=1,
+            help="Send the invoices using this many threads",
+        )
+        parser.add_argument(
+            "--create-debitors",
+            action="store_true",
+            help="First create the debitor accounts not known to exist in Prisme",
+        )
+
     def handle(self, *args, **options):
-        qs = HarborDuesForm.objects.filter(status=Status.NEW)
-        for report in qs:
-            report.send_invoice()
+        client = PrismeClient.from_settings()
+        startup_time = client.warm_up()
+        if startup_time is not None and options["verbosity"] > 1:
+            self.stdout.write(
+                f"Prisme client ready in {startup_time:.2f} s "
+                f"(WSDL {'cached' if client.wsdl_cached else 'fetched'})"
+            )
+        report = dispatch_invoices(
+            batch_size=options["batch_size"],
+            threads=options["threads"],
+            create_debitors=options["create_debitors"],
+        )
+        if options["create_debitors"]:
+            self.stdout.write(f"Created {report.debitors_created} debitors")
+        self.stdout.write(str(report))
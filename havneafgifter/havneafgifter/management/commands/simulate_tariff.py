@@ -0,0 +1,78 @@
+# SPDX-FileCopyrightText: 2026 Magenta ApS <info@magenta.dk>
+#
+# SPDX-License-Identifier: MPL-2.0
+
+from datetime import date
+
+from django.core import serializers
+from django.core.management.base import BaseCommand, CommandError
+
+from havneafgifter.models import (
+    DisembarkmentTaxRate,
+    HarborDuesForm,
+    PortTaxRate,
+    Status,
+    TaxRates,
+)
+from havneafgifter.recalculation import filter_forms
+from havneafgifter.simulation import FormColumns, candidate_index, simulate
+
+
+class Command(BaseCommand):
+    help = (
+        "Show the revenue impact of a candidate tariff on historical forms. "
+        "The candidate is read from a JSON file in fixture format (as written by "
+        "`dumpdata`), containing one TaxRates object and its PortTaxRate and "
+        "DisembarkmentTaxRate objects. If the TaxRates object has the pk of an "
+        "existing TaxRates, it replaces it, otherwise it is added. "
+        "Nothing is saved."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("candidate", type=str, help="Path to JSON file")
+        parser.add_argument(
+            "--from",
+            dest="arrival_from",
+            type=date.fromisoformat,
+            help="Only forms arriving on or after this date (YYYY-MM-DD)",
+        )
+        parser.add_argument(
+            "--to",
+            dest="arrival_to",
+            type=date.fromisoformat,
+            help="Only forms arriving on or before this date (YYYY-MM-DD)",
+        )
+
+    def handle(self, *args, **options):
+        tax_rates = None
+        port_tax_rates = []
+        disembarkment_tax_rates = []
+        with open(options["candidate"]) as file:
+            for deserialized in serializers.deserialize("json", file):
+                obj = deserialized.object
+                if isinstance(obj, TaxRates):
+                    if tax_rates is not None:
+                        raise CommandError("Expected exactly one TaxRates object")
+                    tax_rates = obj
+                elif isinstance(obj, PortTaxRate):
+                    port_tax_rates.append(obj)
+                elif isinstance(obj, DisembarkmentTaxRate):
+                    disembarkment_tax_rates.append(obj)
+        if tax_rates is None:
+            raise CommandError("Expected exactly one TaxRates object")
+        if (
+            tax_rates.pk is not None
+            and not TaxRates.objects.filter(pk=tax_rates.pk).exists()
+        ):
+            tax_rates.pk = None
+
+        queryset = filter_forms(
+            HarborDuesForm.objects.exclude(status=Status.DRAFT),
+            arrival_from=options["arrival_from"],
+            arrival_to=options["arrival_to"],
+        )
+        result = simulate(
+            candidate_index(tax_rates, port_tax_rates, disembarkment_tax_rates),
+            FormColumns.load(queryset),
+        )
+        self.stdout.write(str(result))
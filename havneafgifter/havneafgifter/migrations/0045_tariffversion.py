@@ -0,0 +1,29 @@
+# Generated by Django 5.2.16 on 2026-10-17 03:15
+
+import uuid
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("havneafgifter", "0044_alter_harborduesform_nationality_and_more"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="TariffVersion",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("version", models.UUIDField(default=uuid.uuid4)),
+            ],
+        ),
+    ]
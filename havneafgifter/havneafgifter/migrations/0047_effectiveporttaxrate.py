@@ -0,0 +1,29 @@
+# Generated by Django 5.2.16 on 2026-10-17 03:59
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('havneafgifter', '0046_harborduesform_tax_fingerprint'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EffectivePortTaxRate',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('vessel_type', models.CharField(choices=[('CRUISE', 'Cruise ship'), ('FREIGHTER', 'Freighter'), ('FISHER', 'Foreign fishing ship'), ('PASSENGER', 'Passenger ship'), ('OTHER', 'Other vessel')], max_length=9, verbose_name='Vessel type')),
+                ('gt_start', models.PositiveIntegerField(verbose_name='Vessel gross tonnage (lower)')),
+                ('gt_end', models.PositiveIntegerField(blank=True, null=True, verbose_name='Vessel gross tonnage (upper)')),
+                ('port', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='havneafgifter.port', verbose_name='Harbour')),
+                ('port_tax_rate', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='havneafgifter.porttaxrate')),
+                ('tax_rates', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='effective_port_tax_rates', to='havneafgifter.taxrates')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('tax_rates', 'port', 'vessel_type', 'gt_start'), name='effective_port_tax_rate_unique')],
+            },
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 5.2.16 on 2026-10-17 04:20
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('havneafgifter', '0047_effectiveporttaxrate'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='InvoiceOutboxItem',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('attempts', models.PositiveIntegerField(default=0)),
+                ('last_error', models.TextField(blank=True, null=True)),
+                ('last_attempt_at', models.DateTimeField(blank=True, null=True)),
+                ('next_attempt_at', models.DateTimeField(db_index=True)),
+                ('permanent_failure', models.BooleanField(default=False)),
+                ('form', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='invoice_outbox_item', to='havneafgifter.harborduesform')),
+            ],
+            options={
+                'ordering': ['next_attempt_at'],
+            },
+        ),
+    ]
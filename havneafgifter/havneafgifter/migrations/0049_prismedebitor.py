@@ -0,0 +1,22 @@
+# Generated by Django 5.2.16 on 2026-10-17 04:29
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('havneafgifter', '0048_invoiceoutboxitem'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PrismeDebitor',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('cvr', models.CharField(max_length=8, unique=True)),
+                ('account_num', models.BigIntegerField(blank=True, null=True)),
+                ('updated', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
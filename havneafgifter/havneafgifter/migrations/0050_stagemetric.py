@@ -0,0 +1,28 @@
+# Generated by Django 5.2.16 on 2026-10-17 04:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('havneafgifter', '0049_prismedebitor'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StageMetric',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('span', 'Span'), ('counter', 'Counter')], max_length=10)),
+                ('name', models.CharField(max_length=100)),
+                ('count', models.PositiveBigIntegerField(default=0)),
+                ('total_seconds', models.FloatField(default=0)),
+                ('max_seconds', models.FloatField(default=0)),
+                ('updated', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('kind', 'name'), name='stage_metric_unique')],
+            },
+        ),
+    ]
@@ -0,0 +1,20 @@
+# Generated by Django 5.2.16 on 2026-10-17 04:39
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("havneafgifter", "0050_stagemetric"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="harborduesform",
+            name="pdf_fingerprint",
+            field=models.CharField(
+                blank=True, editable=False, max_length=64, null=True
+            ),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.16 on 2026-10-17 05:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("havneafgifter", "0052_mailjob"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="harborduesform",
+            name="invoice_claimed_at",
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.16 on 2026-10-17 05:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("havneafgifter", "0053_harborduesform_invoice_claimed_at"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="mailjob",
+            name="next_attempt_at",
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,47 @@
+from django.db import migrations
+
+
+def regenerate_effective_port_tax_rates(apps, schema_editor):
+    # Fill the effective port tax rates of the existing tariffs, the same way as
+    # `EffectivePortTaxRate.regenerate`
+    from havneafgifter.models import ShipType
+    from havneafgifter.tariffs import PortTaxRateTable
+
+    EffectivePortTaxRate = apps.get_model("havneafgifter", "EffectivePortTaxRate")
+    Port = apps.get_model("havneafgifter", "Port")
+    PortTaxRate = apps.get_model("havneafgifter", "PortTaxRate")
+    TaxRates = apps.get_model("havneafgifter", "TaxRates")
+
+    port_ids = list(Port.objects.order_by("pk").values_list("pk", flat=True))
+    for tax_rates in TaxRates.objects.all():
+        table = PortTaxRateTable(PortTaxRate.objects.filter(tax_rates=tax_rates))
+        EffectivePortTaxRate.objects.filter(tax_rates=tax_rates).delete()
+        EffectivePortTaxRate.objects.bulk_create(
+            [
+                EffectivePortTaxRate(
+                    tax_rates=tax_rates,
+                    port_id=port_id,
+                    vessel_type=vessel_type,
+                    gt_start=gt_start,
+                    gt_end=gt_end,
+                    port_tax_rate=port_tax_rate,
+                )
+                for port_id in port_ids
+                for vessel_type in ShipType.values
+                for gt_start, gt_end, port_tax_rate in table.bands(port_id, vessel_type)
+            ]
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("havneafgifter", "0054_mailjob_next_attempt_at"),
+    ]
+
+    operations = [
+        migrations.RunPython(
+            regenerate_effective_port_tax_rates,
+            reverse_code=migrations.RunPython.noop,
+        ),
+    ]
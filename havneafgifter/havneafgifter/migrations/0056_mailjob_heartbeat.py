@@ -0,0 +1,18 @@
+# Generated by Django 5.2.16 on 2026-10-17 07:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("havneafgifter", "0055_regenerate_effectiveporttaxrate"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="mailjob",
+            name="heartbeat",
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
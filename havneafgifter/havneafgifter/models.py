@@ -1,11 +1,14 @@
 from __future__ import annotations
 
+import dataclasses
 import logging
+import operator
 import re
+import uuid
 from datetime import date, datetime, timedelta, timezone
 from decimal import Decimal
-from io import BytesIO
-from typing import Dict, List, Set
+from functools import partial, reduce
+from typing import TYPE_CHECKING, Any, Dict, Iterable, List, Set, Tuple
 
 from django.conf import settings
 from django.contrib.auth.models import AbstractUser, Group
@@ -20,55 +23,114 @@ from django.core.validators import (
     MinValueValidator,
     RegexValidator,
 )
-from django.db import models
-from django.db.models import F, Q, QuerySet
-from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.db import DEFAULT_DB_ALIAS, connections, models, transaction
+from django.db.models import Exists, F, OuterRef, Q, QuerySet
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete
 from django.template.defaultfilters import date as tmpl_date
 from django.utils import translation
-from django.utils.functional import cached_property
 from django.utils.translation import gettext_lazy as _
 from django_countries import countries
 from django_fsm import FSMField, transition
 from prisme.exceptions import PrismeException
 from simple_history.models import HistoricalRecords
 from simple_history.signals import pre_create_historical_record
-from simple_history.utils import update_change_reason
+from simple_history.utils import bulk_update_with_history, update_change_reason
 
 from havneafgifter.clients.prisme import (
     HavneafgiftInvoiceLine,
     HavneafgiftInvoiceRequest,
     HavneafgiftInvoiceResponse,
     InvoiceCustomTableRequest,
+    InvoiceCustomTableResponse,
     PrismeClient,
+    first_response,
 )
-from havneafgifter.data import DateTimeRange
+from havneafgifter.data import DateTimeRange, started_days, started_weeks
+from havneafgifter.instrumentation import count, span
+
+if TYPE_CHECKING:
+    from havneafgifter.calculation import DisembarkmentInput, TaxInput, TaxResult
 
 logger = logging.getLogger(__name__)
 
 pdf_storage = FileSystemStorage(location=settings.STORAGE_PDF)
 
 
-def get_changed_fields(new: models.Model) -> Set[str]:
-    changed = set()
-    cls = new.__class__
-    old = None
-    if new.pk:
-        old = cls.objects.filter(pk=new.pk).first()  # type: ignore[attr-defined]
-    if old is None:
-        old = cls()
-    for field in cls._meta._get_fields(reverse=False):  # type: ignore[attr-defined]
-        if not new.pk and (field.many_to_many or field.one_to_many):
-            continue
-        field_name = field.name
-        try:
-            if getattr(old, field_name) != getattr(new, field_name):
-                changed.add(field_name)
-        except AttributeError:
-            pass
-    return changed
-
-
-class User(AbstractUser):
+class ChangedFieldsMixin(models.Model):
+    """Keeps a snapshot of the fields named in `tracked_fields`, as loaded from
+    (or last saved to) the database, so that `get_changed_fields` can compare
+    them in memory instead of fetching the row again.
+    """
+
+    class Meta:
+        abstract = True
+
+    tracked_fields: Tuple[str, ...] = ()
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._take_snapshot()
+        return instance
+
+    def refresh_from_db(self, using=None, fields=None, from_queryset=None):
+        super().refresh_from_db(using=using, fields=fields, from_queryset=from_queryset)
+        self._take_snapshot(fields)
+
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        # With `update_fields`, the other fields still have their old values
+        # in the database
+        self._take_snapshot(kwargs.get("update_fields"))
+
+    def _get_tracked_attnames(
+        self, field_names: Iterable[str] | None = None
+    ) -> Dict[str, str]:
+        attnames = {}
+        for name in self.tracked_fields:
+            attname = self._meta.get_field(name).attname  # type: ignore
+            if field_names is None or name in field_names or attname in field_names:
+                attnames[name] = attname
+        return attnames
+
+    def _take_snapshot(self, field_names: Iterable[str] | None = None):
+        snapshot = self.__dict__.setdefault("_field_snapshot", {})
+        for name, attname in self._get_tracked_attnames(field_names).items():
+            # Deferred fields are not loaded
+            if attname in self.__dict__:
+                snapshot[name] = self.__dict__[attname]
+
+    def get_saved_value(self, field_name: str):
+        """Return the value of `field_name` as loaded from (or last saved to) the
+        database, or `None` if not known.
+        """
+        return self.__dict__.get("_field_snapshot", {}).get(field_name)
+
+    def get_changed_fields(
+        self, update_fields: Iterable[str] | None = None
+    ) -> Set[str]:
+        """Return the names of the tracked fields changed since the instance was
+        loaded or saved, limited to `update_fields` if given.
+
+        Fields of a new instance count as changed if they differ from their
+        default.
+        """
+        snapshot = self.__dict__.get("_field_snapshot")
+        changed = set()
+        for name, attname in self._get_tracked_attnames(update_fields).items():
+            if attname not in self.__dict__:
+                # Deferred, and not touched since
+                continue
+            value = self.__dict__[attname]
+            if snapshot is None:
+                if value != self._meta.get_field(name).get_default():  # type: ignore
+                    changed.add(name)
+            elif name not in snapshot or snapshot[name] != value:
+                changed.add(name)
+        return changed
+
+
+class User(AbstractUser, ChangedFieldsMixin):
     cpr = models.CharField(
         max_length=10,
         null=True,
@@ -118,6 +180,9 @@ class User(AbstractUser):
         on_delete=models.SET_NULL,
     )
 
+    # Changes to these fields make `save` check the CVR of the user's forms
+    tracked_fields = ("username", "cvr")
+
     def clean(self):
         if self.port is not None:
             if self.port_authority is None:
@@ -245,10 +310,14 @@ class User(AbstractUser):
         return False
 
     def save(self, *args, **kwargs):
-        changed = get_changed_fields(self)
+        changed = self.get_changed_fields(kwargs.get("update_fields"))
+        # Forms with the previous username as IMO may lose their CVR
+        vessel_imos = {self.username}
+        if "username" in changed and self.get_saved_value("username"):
+            vessel_imos.add(self.get_saved_value("username"))
         super().save(*args, **kwargs)
         if "username" in changed or "cvr" in changed:
-            HarborDuesForm.check_cvr()
+            HarborDuesForm.schedule_check_cvr(vessel_imos=vessel_imos)
 
     @staticmethod
     def on_m2m_change(sender, instance, model, action, *args, **kwargs):
@@ -259,12 +328,12 @@ class User(AbstractUser):
         ):
             # If there's a chance that the User was added or removed
             # from the group "Ship", associated HarborDuesForms may be affected
-            HarborDuesForm.check_cvr()
+            HarborDuesForm.schedule_check_cvr(vessel_imos=[instance.username])
 
     @staticmethod
     def on_delete(sender, instance, *args, **kwargs):
         if imo_validator_bool(instance.username):
-            HarborDuesForm.check_cvr()
+            HarborDuesForm.schedule_check_cvr(vessel_imos=[instance.username])
 
 
 m2m_changed.connect(User.on_m2m_change, sender=User.groups.through)
@@ -412,7 +481,7 @@ class UserType(models.TextChoices):
     SHIP = "ship", _("ship")
 
 
-class ShippingAgent(PermissionsMixin, models.Model):
+class ShippingAgent(ChangedFieldsMixin, PermissionsMixin, models.Model):
     class Meta:
         ordering = ["name"]
 
@@ -435,6 +504,9 @@ class ShippingAgent(PermissionsMixin, models.Model):
         blank=False,
     )
 
+    # Changes to these fields make `save` check the CVR of the agent's forms
+    tracked_fields = ("cvr",)
+
     def __str__(self) -> str:
         return self.name
 
@@ -457,17 +529,30 @@ class ShippingAgent(PermissionsMixin, models.Model):
         return action == "change" and not from_group and user.shipping_agent == self
 
     def save(self, *args, **kwargs):
-        changed = get_changed_fields(self)
+        changed = self.get_changed_fields(kwargs.get("update_fields"))
         super().save(*args, **kwargs)
         if "cvr" in changed:
-            HarborDuesForm.check_cvr()
+            HarborDuesForm.schedule_check_cvr(shipping_agent_ids=[self.pk])
+
+    @staticmethod
+    def on_pre_delete(sender, instance, *args, **kwargs):
+        # The forms lose their shipping agent (SET_NULL) during the deletion,
+        # so remember which forms are affected
+        instance._affected_form_ids = list(
+            HarborDuesForm.objects.filter(shipping_agent=instance).values_list(
+                "pk", flat=True
+            )
+        )
 
     @staticmethod
     def on_delete(sender, instance, *args, **kwargs):
-        HarborDuesForm.check_cvr()
+        HarborDuesForm.schedule_check_cvr(
+            pks=getattr(instance, "_affected_form_ids", [])
+        )
 
 
-post_delete.connect(ShippingAgent.on_delete)
+pre_delete.connect(ShippingAgent.on_pre_delete, sender=ShippingAgent)
+post_delete.connect(ShippingAgent.on_delete, sender=ShippingAgent)
 
 
 def imo_validator(value: str):
@@ -586,7 +671,31 @@ class Reason(models.Model):
     )
 
 
-class HarborDuesForm(PermissionsMixin, models.Model):
+@dataclasses.dataclass
+class _PendingCvrCheck:
+    # The forms to check with `HarborDuesForm.check_cvr` when the current
+    # transaction is committed, collected by `HarborDuesForm.schedule_check_cvr`
+    vessel_imos: Set[str] = dataclasses.field(default_factory=set)
+    shipping_agent_ids: Set[int] = dataclasses.field(default_factory=set)
+    pks: Set[int] = dataclasses.field(default_factory=set)
+    flushed: bool = False
+
+    def is_registered(self, connection) -> bool:
+        # Whether `flush` is still to be run when the transaction commits
+        return not self.flushed and any(
+            self.flush in callback for callback in connection.run_on_commit
+        )
+
+    def flush(self):
+        self.flushed = True
+        HarborDuesForm.check_cvr(
+            vessel_imos=self.vessel_imos,
+            shipping_agent_ids=self.shipping_agent_ids,
+            pks=self.pks,
+        )
+
+
+class HarborDuesForm(ChangedFieldsMixin, PermissionsMixin, models.Model):
     class Meta:
         constraints = [
             models.CheckConstraint(
@@ -658,7 +767,14 @@ class HarborDuesForm(PermissionsMixin, models.Model):
         bases=[Reason],
         history_change_reason_field=models.TextField(null=True),
         related_name="harbor_dues_form_history_entries",
-        excluded_fields=["harbour_tax", "pdf"],  # exclude system-maintained fields
+        # exclude system-maintained fields
+        excluded_fields=[
+            "harbour_tax",
+            "pdf",
+            "tax_fingerprint",
+            "pdf_fingerprint",
+            "invoice_claimed_at",
+        ],
     )
 
     status = FSMField(
@@ -770,6 +886,14 @@ class HarborDuesForm(PermissionsMixin, models.Model):
         verbose_name=_("PDF file"),
     )
 
+    # Fingerprint of the receipt stored in `pdf` (see `havneafgifter.receipts`)
+    pdf_fingerprint = models.CharField(
+        null=True,
+        blank=True,
+        editable=False,
+        max_length=64,
+    )
+
     agent_reference = models.CharField(
         null=True,
         blank=True,
@@ -782,6 +906,28 @@ class HarborDuesForm(PermissionsMixin, models.Model):
         blank=True,
     )
 
+    # Sat når `havneafgifter.invoicing` tager anmeldelsen, inden fakturaen
+    # sendes til Prisme, og ryddet når resultatet er gemt. Står det tilbage, kan
+    # fakturaen være sendt uden at det blev gemt, så den sendes ikke igen
+    # automatisk.
+    invoice_claimed_at = models.DateTimeField(
+        null=True,
+        blank=True,
+        editable=False,
+    )
+
+    # Hash of the input (form fields, disembarkments and tariff version) that the
+    # stored taxes were last calculated from
+    tax_fingerprint = models.CharField(
+        null=True,
+        blank=True,
+        editable=False,
+        max_length=64,
+    )
+
+    # Changes to these fields make `save` check the CVR of the form
+    tracked_fields = ("shipping_agent", "vessel_imo")
+
     @transition(
         field=status,
         source=[Status.DRAFT, Status.REJECTED],
@@ -842,7 +988,55 @@ class HarborDuesForm(PermissionsMixin, models.Model):
         return None
 
     @staticmethod
-    def check_cvr():
+    def has_cvr_condition() -> Q:
+        # Same as `get_cvr() is not None`, as a filter condition
+        return Q(shipping_agent__cvr__isnull=False) | Q(
+            Exists(
+                User.objects.filter(
+                    username=OuterRef("vessel_imo"),
+                    groups__name="Ship",
+                    cvr__isnull=False,
+                )
+            )
+        )
+
+    @staticmethod
+    def schedule_check_cvr(
+        vessel_imos: Iterable[str] = (),
+        shipping_agent_ids: Iterable[int] = (),
+        pks: Iterable[int] = (),
+        using: str | None = None,
+    ):
+        # Check the CVR of the matching forms once the current transaction is
+        # committed. All calls within the same transaction are collected, and
+        # checked in a single `check_cvr`. Outside a transaction, the forms are
+        # checked immediately.
+        connection = transaction.get_connection(using)
+        if not connection.in_atomic_block:
+            HarborDuesForm.check_cvr(vessel_imos, shipping_agent_ids, pks)
+            return
+        pending: _PendingCvrCheck | None = getattr(
+            connection, "_pending_cvr_check", None
+        )
+        # Add to the pending check of the transaction, also from sibling
+        # savepoints (e.g. one per row of an import), unless it has run already
+        # or was discarded by rolling back the savepoint which registered it.
+        # Forms added from a savepoint which is rolled back later are checked
+        # anyway, which is harmless.
+        if pending is None or not pending.is_registered(connection):
+            pending = _PendingCvrCheck()
+            setattr(connection, "_pending_cvr_check", pending)
+            transaction.on_commit(pending.flush, using=using)
+        pending.vessel_imos.update(vessel_imos)
+        pending.shipping_agent_ids.update(shipping_agent_ids)
+        pending.pks.update(pks)
+
+    @staticmethod
+    def check_cvr(
+        vessel_imos: Iterable[str] | None = None,
+        shipping_agent_ids: Iterable[int] | None = None,
+        pks: Iterable[int] | None = None,
+    ):
         # Checks all forms that need a CVR
         # (either they have it or don't, but they do need it for invoicing)
         # Make sure their state reflects the presence or absence of a CVR
@@ -853,25 +1047,55 @@ class HarborDuesForm(PermissionsMixin, models.Model):
         # - a ShippingAgent changes cvr
         # - a ShippingAgent is deleted
         # - a HarborDuesForm changes shipping_agent or vessel_imo
-        for form in HarborDuesForm.objects.filter(
+        # If any of `vessel_imos`, `shipping_agent_ids` or `pks` are given, only
+        # the forms matching (one of) them are checked.
+        forms = HarborDuesForm.objects.filter(
             status__in=(Status.NEW, Status.MISSING_CVR)
-        ):
-            cvr = form.get_cvr()
-            if form.status == Status.NEW and cvr is None:
-                form.need_cvr()
-                form.save(update_fields=("status",))
-            elif form.status == Status.MISSING_CVR and cvr is not None:
-                form.found_cvr()
-                form.save(update_fields=("status",))
+        )
+        scope = [
+            Q(**{lookup: list(values)})
+            for lookup, values in (
+                ("vessel_imo__in", vessel_imos),
+                ("shipping_agent__in", shipping_agent_ids),
+                ("pk__in", pks),
+            )
+            if values is not None
+        ]
+        if scope:
+            forms = forms.filter(reduce(operator.or_, scope))
+        has_cvr = HarborDuesForm.has_cvr_condition()
+        changed = forms.filter(
+            (Q(status=Status.NEW) & ~has_cvr) | (Q(status=Status.MISSING_CVR) & has_cvr)
+        ).values_list("pk", flat=True)
+
+        # Cruise tax forms have their own history
+        with transaction.atomic():
+            for model, queryset in (
+                (
+                    HarborDuesForm,
+                    HarborDuesForm.objects.filter(
+                        pk__in=changed, cruisetaxform__isnull=True
+                    ),
+                ),
+                (CruiseTaxForm, CruiseTaxForm.objects.filter(pk__in=changed)),
+            ):
+                changed_forms = list(queryset)
+                for form in changed_forms:
+                    if form.status == Status.NEW:
+                        form.need_cvr()
+                    else:
+                        form.found_cvr()
+                if changed_forms:
+                    bulk_update_with_history(changed_forms, model, ["status"])
 
     def save(self, *args, **kwargs):
         initial = self.pk is None
-        changed = get_changed_fields(self)
+        changed = self.get_changed_fields(kwargs.get("update_fields"))
         super().save(*args, **kwargs)
         if initial:
             update_change_reason(self, Status.DRAFT.label)
         if "shipping_agent" in changed or "vessel_imo" in changed:
-            HarborDuesForm.check_cvr()
+            HarborDuesForm.check_cvr(pks=[self.pk])
 
     def __str__(self) -> str:
         port_of_call = self.port_of_call or _("no port of call")
@@ -892,22 +1116,20 @@ class HarborDuesForm(PermissionsMixin, models.Model):
     @property
     def duration_in_days(self) -> int | None:
         if self._period_is_not_none():
-            range = DateTimeRange(
+            return started_days(
                 self.datetime_of_arrival,  # type: ignore
                 self.datetime_of_departure,  # type: ignore
             )
-            return range.started_days
         else:
             return None
 
     @property
     def duration_in_weeks(self) -> int | None:
         if self._period_is_not_none():
-            range = DateTimeRange(
+            return started_weeks(
                 self.datetime_of_arrival,  # type: ignore
                 self.datetime_of_departure,  # type: ignore
             )
-            return range.started_weeks
         else:
             return None
 
@@ -961,70 +1183,96 @@ class HarborDuesForm(PermissionsMixin, models.Model):
         ).first()
 
     def calculate_tax(self, save: bool = True, force_recalculation: bool = False):
-        self.calculate_harbour_tax(save=save)
+        if force_recalculation:
+            self.get_tax_result(refresh=True)
+        if save:
+            # Save all taxes (and the input they were calculated from) at once
+            update_fields = self._set_taxes(force_recalculation=force_recalculation)
+            self.tax_fingerprint = self.get_tax_fingerprint()
+            self.save(update_fields=(*update_fields, "tax_fingerprint"))
+
+    def calculate_tax_if_changed(self) -> bool:
+        # Calculate and save the taxes, unless they have already been calculated
+        # from the current input. Returns whether anything was calculated.
+        if self.tax_fingerprint == self.get_tax_fingerprint():
+            return False
+        self.calculate_tax(save=True)
+        return True
+
+    def get_tax_fingerprint(self) -> str:
+        from havneafgifter.tariffs import get_tariff_index
+
+        # Read from the current fields and disembarkments, not the tax memo
+        return self.get_tax_input().get_fingerprint(get_tariff_index().version)
+
+    def _set_taxes(self, force_recalculation: bool) -> List[str]:
+        # Set (but do not save) the calculated taxes, and return their field names
+        self.harbour_tax = self.get_tax_result().harbour_tax
+        return ["harbour_tax"]
+
+    def get_tax_result(self, refresh: bool = False) -> TaxResult:
+        # The taxes of this form are needed in several places when e.g. rendering a
+        # receipt or sending an invoice, so they are calculated once and kept on
+        # the instance, until the input (including the disembarkments) or the
+        # tariffs change.
+        return self._get_tax_memo(refresh)[2]
+
+    def _get_tax_memo(
+        self, refresh: bool = False
+    ) -> tuple[TaxInput, list[Disembarkment], TaxResult]:
+        from havneafgifter.calculation import calculate_taxes
+        from havneafgifter.tariffs import get_tariff_index
+
+        tariffs = get_tariff_index()
+        disembarkments = self._get_disembarkments()
+        tax_input = dataclasses.replace(
+            self.get_tax_input(disembarkments=False),
+            disembarkments=tuple(
+                disembarkment.get_tax_input() for disembarkment in disembarkments
+            ),
+        )
+        key = (tax_input, tariffs.version)
+        memo = getattr(self, "_tax_memo", None)
+        if refresh or memo is None or memo[0] != key:
+            memo = (key, calculate_taxes(tax_input, tariffs))
+            self._tax_memo = memo
+        return tax_input, disembarkments, memo[1]
+
+    def _get_disembarkments(self) -> list[Disembarkment]:
+        return []
+
+    def get_tax_input(self, disembarkments: bool = True) -> TaxInput:
+        # The values relevant for calculating the taxes of this form
+        from havneafgifter.calculation import TaxInput
+
+        return TaxInput(
+            vessel_type=self.vessel_type,
+            port_of_call_id=self.port_of_call_id,  # type: ignore
+            gross_tonnage=self.gross_tonnage,
+            datetime_of_arrival=self.datetime_of_arrival,
+            datetime_of_departure=self.datetime_of_departure,
+            form_date=self.date,
+        )
 
     def calculate_harbour_tax(
         self, save: bool = True
     ) -> dict[str, Decimal | list[dict] | None]:
-        if (
-            self.has_port_of_call
-            and self._any_is_none(
-                self.datetime_of_arrival,
-                self.datetime_of_departure,
-                self.gross_tonnage,
-            )
-        ) or not self.has_port_of_call:
-            harbour_tax = None
-            details = []  # type: ignore
-        else:
-            taxrates = TaxRates.objects.filter(
-                Q(start_datetime__isnull=True)
-                | Q(start_datetime__lte=self.datetime_of_departure),
-                Q(end_datetime__isnull=True)
-                | Q(end_datetime__gte=self.datetime_of_arrival),
-            )
-            harbour_tax = Decimal(0)
-            details = []
-            for taxrate in taxrates:
-                datetime_range = taxrate.get_overlap(
-                    self.datetime_of_arrival,  # type: ignore
-                    self.datetime_of_departure,  # type: ignore
-                )
-                port_taxrate: PortTaxRate | None = taxrate.get_port_tax_rate(
-                    port=self.port_of_call,  # type: ignore
-                    vessel_type=self.vessel_type,  # type: ignore
-                    gross_ton=self.gross_tonnage,  # type: ignore
-                )
-                range_port_tax = Decimal(0)
-                if port_taxrate is not None:
-                    gross_tonnage: int = max(
-                        self.gross_tonnage,  # type: ignore
-                        port_taxrate.round_gross_ton_up_to,
-                    )
-                    if self.vessel_type in (
-                        ShipType.FREIGHTER,
-                        ShipType.OTHER,
-                    ):
-                        payments = datetime_range.started_weeks
-                    else:
-                        payments = datetime_range.started_days
-                    payment_price = port_taxrate.port_tax_rate * gross_tonnage
-                    range_port_tax = payments * payment_price
-
-                    harbour_tax += range_port_tax
-                details.append(
-                    {
-                        "port_taxrate": port_taxrate,
-                        "date_range": datetime_range,
-                        "harbour_tax": range_port_tax,
-                    }
-                )
+        result = self.get_tax_result()
+        harbour_tax = result.harbour_tax
+        details = [
+            {
+                "port_taxrate": line.port_tax_rate,
+                "date_range": line.date_range,
+                "harbour_tax": line.harbour_tax,
+            }
+            for line in result.harbour_tax_lines
+        ]
         if save:
             self.harbour_tax = harbour_tax
             self.save(update_fields=("harbour_tax",))
         return {"harbour_tax": harbour_tax, "details": details}
 
-    @cached_property
+    @property
     def tax_per_gross_ton(self) -> Decimal | None:
         result = None
         harbour_tax = self.calculate_harbour_tax(save=False)
@@ -1228,50 +1476,86 @@ class HarborDuesForm(PermissionsMixin, models.Model):
         # return self.date
 
     def send_invoice(self):
+        from havneafgifter.receipts import get_receipt_pdf, save_receipt_pdf
+
         if self.status == Status.NEW:
             cvr = self.get_cvr()
 
             if cvr:
-
-                receipt = self.get_receipt()
-                self.pdf = File(BytesIO(receipt.pdf), name=self.get_pdf_filename())
-                self.save(update_fields=["pdf"])
-
+                if hasattr(self, "invoice_outbox_item"):
+                    count("invoice_retried")
                 try:
-                    prisme_request_1 = HavneafgiftInvoiceRequest(
-                        afgift_id=self.pk,
-                        invoice_date=self.invoice_date,
-                        due_date=self.invoice_due_date,
-                        accounting_date=self.invoice_date,
-                        text="Havneafgifter - Harbour taxes",
-                        files=[self.pdf],
-                        lines=self.invoice_lines,
-                        cvr=cvr,
-                    )
-
-                    client = PrismeClient.from_settings()
-                    try:
-                        response = client.process_service(prisme_request_1)
-                    except PrismeException as e:
-                        if "Debitorkonto findes ikke" in e.text:
-                            prisme_request_2: InvoiceCustomTableRequest = (
-                                prisme_request_1.create_custom_table_request()
-                            )
-                            # Create debitorkonto
-                            client.process_service(prisme_request_2)
-                            # Try again
-                            response = client.process_service(prisme_request_1)
-                        else:
-                            raise
-                except Exception as e:  # pragma: no cover
-                    print(e)
+                    with span("send_invoice", form=self.pk):
+                        with span("receipt_pdf", form=self.pk):
+                            pdf = get_receipt_pdf(self)
+                        with span("pdf_storage", form=self.pk):
+                            save_receipt_pdf(self, pdf)
+
+                        with span("invoice_lines", form=self.pk):
+                            prisme_request_1 = self.get_invoice_request(cvr, [self.pdf])
+
+                        client = PrismeClient.from_settings()
+                        try:
+                            with span("prisme_invoice", form=self.pk):
+                                response = client.process_service(prisme_request_1)
+                        except PrismeException as e:
+                            if "Debitorkonto findes ikke" in e.text:
+                                prisme_request_2: InvoiceCustomTableRequest = (
+                                    prisme_request_1.create_custom_table_request()
+                                )
+                                # Create debitorkonto
+                                with span("prisme_create_debitor", form=self.pk):
+                                    PrismeDebitor.remember_response(
+                                        cvr, client.process_service(prisme_request_2)
+                                    )
+                                count("debitor_created")
+                                # Try again
+                                count("invoice_resent")
+                                with span("prisme_invoice", form=self.pk):
+                                    response = client.process_service(prisme_request_1)
+                            else:
+                                raise
+                except Exception as e:
                     logger.exception(e)
-                    # Couldn't send right now, keep in queue
+                    count("invoice_failed")
+                    # Couldn't send right now, keep in queue until the next attempt
+                    InvoiceOutboxItem.record_failure(self, e)
                 else:
+                    response = first_response(response)
                     if type(response) is HavneafgiftInvoiceResponse:
                         self.prisme_recid = response.rec_id
                     self.invoice()
                     self.save(update_fields=("status", "prisme_recid"))
+                    InvoiceOutboxItem.objects.filter(form=self).delete()
+                    PrismeDebitor.remember(cvr)
+                    count("invoiced")
+
+    def get_invoice_request(
+        self, cvr: str, files: List[File]
+    ) -> HavneafgiftInvoiceRequest:
+        return HavneafgiftInvoiceRequest(
+            afgift_id=self.pk,
+            invoice_date=self.invoice_date,
+            due_date=self.invoice_due_date,
+            accounting_date=self.invoice_date,
+            text="Havneafgifter - Harbour taxes",
+            files=files,
+            lines=self.invoice_lines,
+            cvr=cvr,
+        )
+
+    def create_debitor(self, cvr: str | None = None) -> PrismeDebitor:
+        # Create the debitor account of `cvr` (by default the CVR number of this
+        # form) in Prisme, without sending an invoice or the receipt
+        if cvr is None:
+            cvr = self.get_cvr()
+        if not cvr:
+            raise ValueError("Form has no CVR number")
+        request = self.get_invoice_request(cvr, []).create_custom_table_request()
+        with span("prisme_create_debitor", form=self.pk):
+            response = PrismeClient.from_settings().process_service(request)
+        count("debitor_created")
+        return PrismeDebitor.remember_response(cvr, response)
 
 
 class CruiseTaxForm(HarborDuesForm):
@@ -1308,27 +1592,55 @@ class CruiseTaxForm(HarborDuesForm):
             "pax_tax",
             "disembarkment_tax",
             "pdf",
+            "tax_fingerprint",
+            "pdf_fingerprint",
+            "invoice_claimed_at",
         ],
     )
 
-    def calculate_tax(self, save: bool = True, force_recalculation: bool = False):
-        super().calculate_tax(save=save)  # calculates harbour tax
-        self.calculate_passenger_tax(save=save)
-        self.calculate_disembarkment_tax(
-            save=save,
+    def _set_taxes(self, force_recalculation: bool) -> List[str]:
+        # Sets harbour tax
+        update_fields = super()._set_taxes(force_recalculation=force_recalculation)
+        self.pax_tax = self.get_tax_result().passenger_tax
+        self.disembarkment_tax = self._calculate_disembarkment_tax(
+            save_disembarkments=True,
             force_recalculation=force_recalculation,
-        )
+        )["disembarkment_tax"]
+        return [*update_fields, "pax_tax", "disembarkment_tax"]
 
     def calculate_disembarkment_tax(
         self, save: bool = True, force_recalculation: bool = False
+    ):
+        calculation = self._calculate_disembarkment_tax(
+            save_disembarkments=save, force_recalculation=force_recalculation
+        )
+        if save:
+            self.disembarkment_tax = calculation["disembarkment_tax"]
+            self.save(update_fields=("disembarkment_tax",))
+        return calculation
+
+    def _calculate_disembarkment_tax(
+        self, save_disembarkments: bool, force_recalculation: bool
     ):
         disembarkment_date = self.datetime_of_arrival or self.date
         disembarkment_tax = Decimal(0)
         details = []
-        for disembarkment in self.disembarkment_set.all():
-            tax = disembarkment.get_disembarkment_tax(
-                save=save, force_recalculation=force_recalculation
-            )
+        changed_disembarkments = []
+        _, disembarkments, result = self._get_tax_memo()
+        for disembarkment, line in zip(disembarkments, result.disembarkment_tax_lines):
+            # As in `Disembarkment.get_disembarkment_tax`, a stored tax is kept
+            # unless recalculation is forced
+            if disembarkment.disembarkment_tax and not force_recalculation:
+                tax = disembarkment.disembarkment_tax
+            else:
+                tax = line.tax
+                if save_disembarkments and (
+                    disembarkment.disembarkment_tax != line.tax
+                    or disembarkment.used_disembarkment_tax_rate != line.rate
+                ):
+                    disembarkment.disembarkment_tax = line.tax
+                    disembarkment.used_disembarkment_tax_rate = line.rate
+                    changed_disembarkments.append(disembarkment)
             if tax is not None:
                 disembarkment_tax += tax
 
@@ -1341,28 +1653,39 @@ class CruiseTaxForm(HarborDuesForm):
                 }
             )
 
-        if save:
-            self.disembarkment_tax = disembarkment_tax
-            self.save(update_fields=("disembarkment_tax",))
+        if changed_disembarkments:
+            Disembarkment.objects.bulk_update(
+                changed_disembarkments,
+                ["disembarkment_tax", "used_disembarkment_tax_rate"],
+            )
         return {"disembarkment_tax": disembarkment_tax, "details": details}
 
+    def get_tax_input(self, disembarkments: bool = True) -> TaxInput:
+        tax_input = super().get_tax_input()
+        return dataclasses.replace(
+            tax_input,
+            number_of_passengers=self.number_of_passengers,
+            disembarkments=(
+                tuple(
+                    disembarkment.get_tax_input()
+                    for disembarkment in self._get_disembarkments()
+                )
+                if disembarkments
+                else ()
+            ),
+        )
+
+    def _get_disembarkments(self) -> list[Disembarkment]:
+        # Fetch the disembarkments along with their sites in one query, unless
+        # they have been prefetched already
+        if "disembarkment_set" in getattr(self, "_prefetched_objects_cache", {}):
+            return list(self.disembarkment_set.all())
+        return list(self.disembarkment_set.select_related("disembarkment_site"))
+
     def calculate_passenger_tax(self, save: bool = True) -> dict[str, Decimal | None]:
-        rate: Decimal = Decimal("0")
-        if self._any_is_none(
-            self.number_of_passengers,
-            self.datetime_of_arrival,
-            self.datetime_of_departure,
-        ):
-            pax_tax = None
-            rate = Decimal("0")
-        else:
-            arrival_date = self.datetime_of_arrival
-            taxrate = TaxRates.objects.filter(
-                Q(start_datetime__isnull=True) | Q(start_datetime__lte=arrival_date),
-                Q(end_datetime__isnull=True) | Q(end_datetime__gte=arrival_date),
-            ).first()
-            rate = taxrate and taxrate.pax_tax_rate or Decimal(0)
-            pax_tax: Decimal = self.number_of_passengers * rate  # type: ignore
+        result = self.get_tax_result()
+        pax_tax = result.passenger_tax
+        rate = result.passenger_tax_rate
         if save:
             self.pax_tax = pax_tax
             self.save(update_fields=("pax_tax",))
@@ -1434,6 +1757,195 @@ class CruiseTaxForm(HarborDuesForm):
         return CruiseTaxFormReceipt(self, **kwargs)
 
 
+class MetricKind(models.TextChoices):
+    SPAN = ("span", _("Span"))
+    COUNTER = ("counter", _("Counter"))
+
+
+class StageMetric(models.Model):
+    # Samlede tider og tællere for trinene i f.eks. fakturering, på tværs af
+    # processer (se `havneafgifter.instrumentation`)
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["kind", "name"], name="stage_metric_unique"
+            ),
+        ]
+
+    kind = models.CharField(max_length=10, choices=MetricKind.choices)
+
+    name = models.CharField(max_length=100)
+
+    # Antal gennemløb af et trin, eller værdien af en tæller
+    count = models.PositiveBigIntegerField(default=0)
+
+    total_seconds = models.FloatField(default=0)
+
+    max_seconds = models.FloatField(default=0)
+
+    updated = models.DateTimeField(auto_now=True)
+
+    def __str__(self) -> str:
+        return f"{self.kind} {self.name}"
+
+
+class PrismeDebitor(models.Model):
+    # Et CVR-nummer, som vides at have en debitorkonto i Prisme, fordi der er
+    # sendt en faktura til det, eller fordi debitorkontoen er oprettet.
+    cvr = models.CharField(max_length=8, unique=True)
+
+    # Kontonummeret fra Prisme, hvis vi selv har oprettet debitorkontoen
+    account_num = models.BigIntegerField(null=True, blank=True)
+
+    updated = models.DateTimeField(auto_now=True)
+
+    def __str__(self) -> str:
+        return self.cvr
+
+    @classmethod
+    def remember(cls, cvr: str, account_num: int | None = None) -> PrismeDebitor:
+        if account_num is None:
+            return cls.objects.get_or_create(cvr=cvr)[0]
+        return cls.objects.update_or_create(
+            cvr=cvr, defaults={"account_num": account_num}
+        )[0]
+
+    @classmethod
+    def remember_response(cls, cvr: str, response) -> PrismeDebitor:
+        # Remember `cvr` after Prisme replied to the creation of its debitor
+        # account
+        response = first_response(response)
+        if type(response) is InvoiceCustomTableResponse:
+            return cls.remember(cvr, getattr(response, "account_num", None))
+        return cls.remember(cvr)
+
+
+class InvoiceOutboxItem(models.Model):
+    # En anmeldelse, hvis faktura ikke kunne sendes til Prisme, med antal
+    # forsøg, seneste fejl og tidspunktet for næste forsøg. Slettes når
+    # fakturaen er sendt.
+    class Meta:
+        ordering = ["next_attempt_at"]
+
+    form = models.OneToOneField(
+        HarborDuesForm,
+        on_delete=models.CASCADE,
+        related_name="invoice_outbox_item",
+    )
+
+    attempts = models.PositiveIntegerField(default=0)
+
+    last_error = models.TextField(null=True, blank=True)
+
+    last_attempt_at = models.DateTimeField(null=True, blank=True)
+
+    next_attempt_at = models.DateTimeField(db_index=True)
+
+    # Sat når videre forsøg er nytteløse, f.eks. ved fejl i data
+    permanent_failure = models.BooleanField(default=False)
+
+    def __str__(self) -> str:
+        return f"{self.form_id}: {self.attempts} attempts"
+
+    @classmethod
+    def record_failure(
+        cls, form: HarborDuesForm, error: Exception
+    ) -> InvoiceOutboxItem:
+        retry: Dict[str, Any] = settings.PRISME["retry"]  # type: ignore[misc]
+        now = datetime.now(timezone.utc)
+        item = cls.objects.filter(form=form).first() or cls(form=form)
+        item.attempts += 1
+        item.last_error = str(error)
+        item.last_attempt_at = now
+        # Exponential backoff
+        delay = min(retry["base_delay"] * 2 ** (item.attempts - 1), retry["max_delay"])
+        item.next_attempt_at = now + timedelta(seconds=delay)
+        item.permanent_failure = item.attempts >= retry["max_attempts"] or (
+            isinstance(error, PrismeException)
+            and error.code in retry["permanent_error_codes"]
+        )
+        item.save()
+        return item
+
+    def retry_now(self):
+        self.next_attempt_at = datetime.now(timezone.utc)
+        self.permanent_failure = False
+        self.save(update_fields=["next_attempt_at", "permanent_failure"])
+
+
+class MailJobStatus(models.TextChoices):
+    PENDING = ("pending", _("Pending"))
+    RUNNING = ("running", _("Running"))
+    SUCCEEDED = ("succeeded", _("Succeeded"))
+    FAILED = ("failed", _("Failed"))
+
+
+class MailJob(models.Model):
+    # En notifikationsmail (med kvitteringen som PDF) for en anmeldelse, som
+    # sendes af `mail_worker` i stedet for under requestet (se
+    # `havneafgifter.mail_jobs`)
+    class Meta:
+        ordering = ["created"]
+
+    form = models.ForeignKey(
+        HarborDuesForm,
+        on_delete=models.CASCADE,
+        related_name="mail_jobs",
+    )
+
+    # Brugeren, der udløste mailen, og som får besked om resultatet
+    user = models.ForeignKey(
+        User,
+        null=True,
+        blank=True,
+        on_delete=models.SET_NULL,
+        related_name="mail_jobs",
+    )
+
+    # Navnet på en underklasse af `havneafgifter.mails.NotificationMail`
+    mail_class = models.CharField(max_length=100)
+
+    # Sproget, som mailen og kvitteringen skal skrives på
+    language = models.CharField(max_length=10)
+
+    status = models.CharField(
+        max_length=10,
+        choices=MailJobStatus.choices,
+        default=MailJobStatus.PENDING,
+        db_index=True,
+    )
+
+    attempts = models.PositiveIntegerField(default=0)
+
+    # Tidspunktet for næste forsøg, efter en fejl
+    next_attempt_at = models.DateTimeField(null=True, blank=True)
+
+    error = models.TextField(null=True, blank=True)
+
+    # Beskeden til brugeren, når mailen er sendt (eller ikke kunne sendes)
+    message = models.TextField(null=True, blank=True)
+
+    # Sat når beskeden er vist for brugeren
+    reported = models.BooleanField(default=False)
+
+    created = models.DateTimeField(auto_now_add=True)
+
+    started = models.DateTimeField(null=True, blank=True)
+
+    # Opdateres af `mail_worker`, så længe jobbet kører. Et kørende job uden et
+    # nyligt livstegn anses for tabt, og køres igen.
+    heartbeat = models.DateTimeField(null=True, blank=True)
+
+    finished = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self) -> str:
+        return f"{self.mail_class} for {self.form_id}: {self.status}"
+
+    @property
+    def done(self) -> bool:
+        return self.status in (MailJobStatus.SUCCEEDED, MailJobStatus.FAILED)
+
+
 class PassengersByCountry(PermissionsMixin, models.Model):
     class Meta:
         ordering = [
@@ -1575,28 +2087,9 @@ class Disembarkment(PermissionsMixin, models.Model):
         if self.disembarkment_tax and not force_recalculation:
             return self.disembarkment_tax
         else:
-            cruisetaxform = self.cruise_tax_form
-            disembarkment_date = cruisetaxform.datetime_of_arrival or cruisetaxform.date
-            taxrate = TaxRates.objects.filter(
-                Q(start_datetime__isnull=True)
-                | Q(start_datetime__lte=disembarkment_date),
-                Q(end_datetime__isnull=True) | Q(end_datetime__gte=disembarkment_date),
-            ).first()
-            disembarkment_tax_rate = (
-                taxrate.get_disembarkment_tax_rate(self.disembarkment_site)
-                if taxrate
-                else None
+            disembarkment_tax, used_disembarkment_tax_rate = (
+                self.calculate_disembarkment_tax_and_rate()
             )
-            disembarkment_tax = Decimal(0)
-            used_disembarkment_tax_rate = Decimal(0)
-            if disembarkment_tax_rate is not None:
-                disembarkment_tax = (
-                    self.number_of_passengers
-                    * disembarkment_tax_rate.disembarkment_tax_rate
-                )
-                used_disembarkment_tax_rate = (
-                    disembarkment_tax_rate.disembarkment_tax_rate
-                )
             if save:
                 self.disembarkment_tax = disembarkment_tax
                 self.used_disembarkment_tax_rate = used_disembarkment_tax_rate
@@ -1608,6 +2101,29 @@ class Disembarkment(PermissionsMixin, models.Model):
                 )
             return disembarkment_tax
 
+    def get_tax_input(self) -> DisembarkmentInput:
+        from havneafgifter.calculation import DisembarkmentInput
+
+        return DisembarkmentInput(
+            disembarkment_site_id=self.disembarkment_site_id,  # type: ignore
+            municipality=self.disembarkment_site.municipality,
+            number_of_passengers=self.number_of_passengers,
+        )
+
+    def calculate_disembarkment_tax_and_rate(self) -> tuple[Decimal, Decimal]:
+        # Returns the disembarkment tax and the rate it was calculated from,
+        # without touching the stored values
+        from havneafgifter.calculation import calculate_disembarkment_tax_line
+        from havneafgifter.tariffs import get_tariff_index
+
+        form_input = self.cruise_tax_form.get_tax_input(disembarkments=False)
+        line = calculate_disembarkment_tax_line(
+            self.get_tax_input(),
+            form_input.disembarkment_datetime,
+            get_tariff_index(),
+        )
+        return line.tax, line.rate
+
     @classmethod
     def _filter_user_permissions(
         cls, qs: QuerySet, user: User, action: str
@@ -1651,6 +2167,19 @@ class TaxRates(PermissionsMixin, models.Model):
     def get_port_tax_rate(
         self, port: Port, vessel_type: str, gross_ton: int
     ) -> PortTaxRate | None:
+        # Opslag i den forudberegnede tabel (se `EffectivePortTaxRate`)
+        effective = (
+            self.effective_port_tax_rates.filter(
+                port=port, vessel_type=vessel_type, gt_start__lte=gross_ton
+            )
+            .filter(Q(gt_end__gte=gross_ton) | Q(gt_end__isnull=True))
+            .select_related("port_tax_rate")
+            .order_by("-gt_start")
+            .first()
+        )
+        if effective is not None:
+            return effective.port_tax_rate
+        # Tabellen er ikke genereret (endnu), eller der er ingen sats
         qs = self.port_tax_rates.filter(gt_start__lte=gross_ton).filter(
             Q(gt_end__gte=gross_ton) | Q(gt_end__isnull=True)
         )
@@ -1683,28 +2212,45 @@ class TaxRates(PermissionsMixin, models.Model):
 
     def save(self, *args, **kwargs):
         super().full_clean()
-        super().save(*args, **kwargs)
+        # `on_update` kører i samme transaktion som selve gemningen
+        with transaction.atomic(using=kwargs.get("using")):
+            super().save(*args, **kwargs)
 
     @staticmethod
     def on_update(sender, instance: TaxRates, **kwargs):
         # En TaxRates-tabel har (måske) fået ændret sin `start_datetime`
         # Opdatér `end_datetime` på alle tabeller som er påvirkede
         # (tidl. prev, ny prev, tabellen selv)
-        # Det er nemmest og sikrest at loope over hele banden,
-        # så vi er sikre på at ramme alle
         update_fields = kwargs.get("update_fields")
         if not update_fields or "start_datetime" in update_fields:
-            end_datetime = None
-            for item in TaxRates.objects.all().order_by(
-                F("start_datetime").desc(nulls_last=True)
-            ):
-                # Loop over alle tabeller fra sidste til første
-                # (reverse af default ordering)
-                if item.end_datetime != end_datetime:
-                    item.end_datetime = end_datetime
-                    # Sæt kun `end_datetime`, så vi forhindrer rekursion
-                    item.save(update_fields=("end_datetime",))
-                end_datetime = item.start_datetime
+            if TaxRates.update_end_datetimes(using=kwargs.get("using")):
+                # En UPDATE udløser ikke post_save, så tarifversionen
+                # opdateres eksplicit
+                TariffVersion.on_tariff_change(sender=TaxRates)
+
+    @classmethod
+    def update_end_datetimes(cls, using: str | None = None) -> int:
+        # Sæt `end_datetime` på alle tabeller til `start_datetime` på den næste
+        # tabel (i default ordering), med én UPDATE uden at gemme (og dermed
+        # uden at udløse signaler). Returnerer antallet af ændrede tabeller.
+        db = connections[using or DEFAULT_DB_ALIAS]
+        quote_name = db.ops.quote_name
+        table = quote_name(cls._meta.db_table)
+        pk = quote_name(cls._meta.pk.column)  # type: ignore[union-attr]
+        start, end = (
+            quote_name(cls._meta.get_field(name).column)  # type: ignore
+            for name in ("start_datetime", "end_datetime")
+        )
+        with db.cursor() as cursor:
+            cursor.execute(
+                f"UPDATE {table} AS item SET {end} = following.next_start "
+                f"FROM (SELECT {pk}, LEAD({start}) OVER "
+                f"(ORDER BY {start} ASC NULLS FIRST, {pk}) AS next_start "
+                f"FROM {table}) AS following "
+                f"WHERE item.{pk} = following.{pk} "
+                f"AND item.{end} IS DISTINCT FROM following.next_start"
+            )
+            return cursor.rowcount
 
     def __str__(self) -> str:
         start = self.start_datetime.date() if self.start_datetime else "-∞"
@@ -1806,6 +2352,152 @@ class PortTaxRate(PermissionsMixin, models.Model):
         return f"{vessel_label}, {port}"
 
 
+class EffectivePortTaxRate(models.Model):
+    # Udfoldet udgave af `PortTaxRate`: én række pr. (TaxRates, havn, skibstype,
+    # bruttotonnage-interval), hvor "specifik værdi, ellers NULL" allerede er
+    # slået op. Tabellen er afledt, og genereres igen med `schedule_regenerate`
+    # når en `PortTaxRate` gemmes eller slettes, eller en havn oprettes.
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["tax_rates", "port", "vessel_type", "gt_start"],
+                name="effective_port_tax_rate_unique",
+            ),
+        ]
+
+    tax_rates = models.ForeignKey(
+        TaxRates,
+        on_delete=models.CASCADE,
+        related_name="effective_port_tax_rates",
+    )
+
+    port = models.ForeignKey(
+        Port,
+        on_delete=models.CASCADE,
+        verbose_name=_("Harbour"),
+    )
+
+    vessel_type = models.CharField(
+        max_length=9,
+        choices=ShipType,
+        verbose_name=_("Vessel type"),
+    )
+
+    gt_start = models.PositiveIntegerField(
+        verbose_name=_("Vessel gross tonnage (lower)"),
+    )
+
+    # Inklusiv, som `PortTaxRate.gt_end`
+    gt_end = models.PositiveIntegerField(
+        null=True,
+        blank=True,
+        verbose_name=_("Vessel gross tonnage (upper)"),
+    )
+
+    port_tax_rate = models.ForeignKey(
+        PortTaxRate,
+        on_delete=models.CASCADE,
+        related_name="+",
+    )
+
+    def __str__(self) -> str:
+        return (
+            f"{self.tax_rates}, {self.port}, {self.vessel_type}, "
+            f"{self.gt_start} t - {self.gt_end} t"
+        )
+
+    @classmethod
+    def regenerate(cls, tax_rates: TaxRates) -> int:
+        """Replace the effective port tax rates of `tax_rates`, and return the
+        number of rows created.
+        """
+        from havneafgifter.tariffs import PortTaxRateTable
+
+        table = PortTaxRateTable(tax_rates.port_tax_rates.all())
+        rows = [
+            cls(
+                tax_rates=tax_rates,
+                port_id=port_id,
+                vessel_type=vessel_type,
+                gt_start=gt_start,
+                gt_end=gt_end,
+                port_tax_rate=port_tax_rate,
+            )
+            for port_id in Port.objects.order_by("pk").values_list("pk", flat=True)
+            for vessel_type in ShipType.values
+            for gt_start, gt_end, port_tax_rate in table.bands(port_id, vessel_type)
+        ]
+        with transaction.atomic():
+            cls.objects.filter(tax_rates=tax_rates).delete()
+            cls.objects.bulk_create(rows)
+        return len(rows)
+
+    @classmethod
+    def regenerate_all(cls) -> int:
+        return sum(cls.regenerate(tax_rates) for tax_rates in TaxRates.objects.all())
+
+    @classmethod
+    def schedule_regenerate(
+        cls, tax_rates_ids: Iterable[int], using: str | None = None
+    ):
+        # Regenerate the rows of the given `TaxRates` once the current transaction
+        # is committed. Until then their rows are deleted, so
+        # `TaxRates.get_port_tax_rate` reads `PortTaxRate` directly instead of
+        # stale rows. Outside a transaction, the rows are regenerated immediately.
+        tax_rates_ids = set(tax_rates_ids)
+        connection = transaction.get_connection(using)
+        if not connection.in_atomic_block:
+            cls._regenerate_pending(tax_rates_ids)
+            return
+        cls.objects.using(using).filter(tax_rates_id__in=tax_rates_ids).delete()
+        pending: Set[int] | None = getattr(
+            connection, "_pending_effective_port_tax_rates", None
+        )
+        if pending is None:
+            pending = set()
+            setattr(connection, "_pending_effective_port_tax_rates", pending)
+        pending.update(tax_rates_ids)
+        # The first callback to run regenerates all `TaxRates` scheduled in the
+        # transaction (e.g. once for all rows of a formset), the rest find
+        # nothing left to do
+        transaction.on_commit(partial(cls._regenerate_pending, pending), using=using)
+
+    @classmethod
+    def _regenerate_pending(cls, pending: Set[int]):
+        tax_rates_ids = set(pending)
+        pending.clear()
+        for tax_rates in TaxRates.objects.filter(pk__in=tax_rates_ids):
+            cls.regenerate(tax_rates)
+
+    @staticmethod
+    def on_port_tax_rate_change(sender, instance, using=None, **kwargs):
+        EffectivePortTaxRate.schedule_regenerate([instance.tax_rates_id], using=using)
+
+    @staticmethod
+    def on_port_save(sender, instance, created, using=None, **kwargs):
+        # A new port needs its rows in every table
+        if created:
+            EffectivePortTaxRate.schedule_regenerate(
+                TaxRates.objects.using(using).values_list("pk", flat=True),
+                using=using,
+            )
+
+
+post_save.connect(
+    EffectivePortTaxRate.on_port_tax_rate_change,
+    sender=PortTaxRate,
+    dispatch_uid="PortTaxRate_effective_save",
+)
+post_delete.connect(
+    EffectivePortTaxRate.on_port_tax_rate_change,
+    sender=PortTaxRate,
+    dispatch_uid="PortTaxRate_effective_delete",
+)
+post_save.connect(
+    EffectivePortTaxRate.on_port_save, sender=Port, dispatch_uid="Port_effective_save"
+)
+
+
 class DisembarkmentTaxRate(PermissionsMixin, models.Model):
     class Meta:
         unique_together = ("tax_rates", "municipality", "disembarkment_site")
@@ -1863,6 +2555,43 @@ class DisembarkmentTaxRate(PermissionsMixin, models.Model):
         return f"{municipality}, {disembarkment_site}"
 
 
+class TariffVersion(models.Model):
+    # Enkelt række, hvis `version` udskiftes hver gang takstdata ændres.
+    # Bruges af `havneafgifter.tariffs` til at afgøre om processens
+    # takstindeks er forældet.
+    version = models.UUIDField(default=uuid.uuid4)
+
+    @classmethod
+    def current(cls) -> uuid.UUID | None:
+        return cls.objects.filter(pk=1).values_list("version", flat=True).first()
+
+    @classmethod
+    def bump(cls) -> uuid.UUID:
+        version = uuid.uuid4()
+        cls.objects.update_or_create(pk=1, defaults={"version": version})
+        return version
+
+    @staticmethod
+    def on_tariff_change(sender, **kwargs):
+        from havneafgifter.tariffs import invalidate_tariff_index
+
+        TariffVersion.bump()
+        invalidate_tariff_index()
+
+
+for _tariff_model in (TaxRates, PortTaxRate, DisembarkmentTaxRate):
+    post_save.connect(
+        TariffVersion.on_tariff_change,
+        sender=_tariff_model,
+        dispatch_uid=f"{_tariff_model.__name__}_tariff_change_save",
+    )
+    post_delete.connect(
+        TariffVersion.on_tariff_change,
+        sender=_tariff_model,
+        dispatch_uid=f"{_tariff_model.__name__}_tariff_change_delete",
+    )
+
+
 class Vessel(models.Model):
     user = models.OneToOneField(
         User,
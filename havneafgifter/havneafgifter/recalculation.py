@@ -0,0 +1,192 @@
+from __future__ import annotations
+
+from dataclasses import dataclass, field
+from datetime import date
+from decimal import Decimal
+from itertools import repeat
+from typing import Dict, Iterable, List
+
+from django.db import transaction
+from django.db.models import Prefetch, QuerySet
+
+from havneafgifter.calculation import calculate_harbour_taxes
+from havneafgifter.models import (
+    CruiseTaxForm,
+    Disembarkment,
+    HarborDuesForm,
+    Port,
+    Status,
+)
+from havneafgifter.tariffs import get_tariff_index
+from havneafgifter.workers import process_pool
+
+# Batch recalculation of the stored taxes (`harbour_tax`, `pax_tax` and
+# `disembarkment_tax`) on existing forms, e.g. after a tariff correction.
+#
+# Forms are processed in chunks of primary keys. Each chunk is loaded with its
+# disembarkments in a few queries, recalculated in memory (the harbour taxes of a
+# chunk in one batch), and written back using `bulk_update`. Chunks can be spread
+# over a pool of worker processes.
+
+TAX_FIELDS = ("harbour_tax", "pax_tax", "disembarkment_tax")
+
+
+@dataclass
+class RecalculationReport:
+    dry_run: bool = False
+    forms: int = 0
+    changed_forms: int = 0
+    # Number of changed values, and the sum of the changes, per tax field
+    changed: Dict[str, int] = field(default_factory=dict)
+    delta: Dict[str, Decimal] = field(default_factory=dict)
+
+    def add_change(self, field_name: str, old: Decimal | None, new: Decimal | None):
+        self.changed[field_name] = self.changed.get(field_name, 0) + 1
+        self.delta[field_name] = self.delta.get(field_name, Decimal(0)) + (
+            (new or Decimal(0)) - (old or Decimal(0))
+        )
+
+    def merge(self, other: RecalculationReport):
+        self.forms += other.forms
+        self.changed_forms += other.changed_forms
+        for field_name, count in other.changed.items():
+            self.changed[field_name] = self.changed.get(field_name, 0) + count
+        for field_name, delta in other.delta.items():
+            self.delta[field_name] = self.delta.get(field_name, Decimal(0)) + delta
+
+    @property
+    def total_delta(self) -> Decimal:
+        return sum(self.delta.values(), Decimal(0))
+
+    def __str__(self) -> str:
+        lines = [
+            f"{'Would change' if self.dry_run else 'Changed'} "
+            f"{self.changed_forms} of {self.forms} forms"
+        ]
+        for field_name in TAX_FIELDS:
+            if field_name in self.changed:
+                lines.append(
+                    f"  {field_name}: {self.changed[field_name]} changed, "
+                    f"delta {self.delta[field_name]}"
+                )
+        lines.append(f"  total delta: {self.total_delta}")
+        return "\n".join(lines)
+
+
+def filter_forms(
+    queryset: QuerySet[HarborDuesForm],
+    arrival_from: date | None = None,
+    arrival_to: date | None = None,
+    ports: Iterable[Port | int] | None = None,
+    statuses: Iterable[Status | str] | None = None,
+) -> QuerySet[HarborDuesForm]:
+    if arrival_from is not None:
+        queryset = queryset.filter(datetime_of_arrival__date__gte=arrival_from)
+    if arrival_to is not None:
+        queryset = queryset.filter(datetime_of_arrival__date__lte=arrival_to)
+    if ports is not None:
+        queryset = queryset.filter(port_of_call__in=ports)
+    if statuses is not None:
+        queryset = queryset.filter(status__in=statuses)
+    return queryset
+
+
+def recalculate_taxes(
+    queryset: QuerySet[HarborDuesForm] | None = None,
+    arrival_from: date | None = None,
+    arrival_to: date | None = None,
+    ports: Iterable[Port | int] | None = None,
+    statuses: Iterable[Status | str] | None = None,
+    chunk_size: int = 500,
+    processes: int | None = None,
+    dry_run: bool = False,
+) -> RecalculationReport:
+    """Recalculate and store the taxes of the given forms (all forms, if no
+    queryset is given), optionally narrowed down by arrival date, port of call and
+    status.
+
+    Disembarkment taxes are always recalculated, i.e. this corresponds to
+    `calculate_tax(save=True, force_recalculation=True)` on every form.
+
+    If `processes` is larger than 1, the chunks are processed by a pool of that
+    many worker processes. If `dry_run` is set, nothing is written, but the report
+    still tells how many forms (and how much tax) would change.
+    """
+    if queryset is None:
+        queryset = HarborDuesForm.objects.all()
+    queryset = filter_forms(queryset, arrival_from, arrival_to, ports, statuses)
+    pks: List[int] = list(queryset.order_by("pk").values_list("pk", flat=True))
+    chunks = [pks[i : i + chunk_size] for i in range(0, len(pks), chunk_size)]
+
+    report = RecalculationReport(dry_run=dry_run)
+    if processes is not None and processes > 1 and len(chunks) > 1:
+        with process_pool(processes) as pool:
+            for chunk_report in pool.map(recalculate_chunk, chunks, repeat(dry_run)):
+                report.merge(chunk_report)
+    else:
+        for chunk in chunks:
+            report.merge(recalculate_chunk(chunk, dry_run))
+    return report
+
+
+def recalculate_chunk(pks: List[int], dry_run: bool = False) -> RecalculationReport:
+    report = RecalculationReport(dry_run=dry_run)
+    changed_forms: List[HarborDuesForm] = []
+    changed_cruise_forms: List[CruiseTaxForm] = []
+    changed_disembarkments: List[Disembarkment] = []
+
+    forms = HarborDuesForm.objects.filter(pk__in=pks, cruisetaxform__isnull=True)
+    cruise_forms = CruiseTaxForm.objects.filter(pk__in=pks).prefetch_related(
+        Prefetch(
+            "disembarkment_set",
+            queryset=Disembarkment.objects.select_related("disembarkment_site"),
+        )
+    )
+    all_forms: List[HarborDuesForm] = [*forms, *cruise_forms]
+    harbour_taxes = calculate_harbour_taxes(
+        [form.get_tax_input(disembarkments=False) for form in all_forms],
+        get_tariff_index(),
+    )
+    for form, harbour_tax in zip(all_forms, harbour_taxes):
+        report.forms += 1
+        new_values: Dict[str, Decimal | None] = {"harbour_tax": harbour_tax}
+        if isinstance(form, CruiseTaxForm):
+            new_values["pax_tax"] = form.calculate_passenger_tax(save=False)[
+                "passenger_tax"
+            ]
+            disembarkment_tax = Decimal(0)
+            for disembarkment in form.disembarkment_set.all():
+                tax, rate = disembarkment.calculate_disembarkment_tax_and_rate()
+                disembarkment_tax += tax
+                if (
+                    disembarkment.disembarkment_tax != tax
+                    or disembarkment.used_disembarkment_tax_rate != rate
+                ):
+                    disembarkment.disembarkment_tax = tax
+                    disembarkment.used_disembarkment_tax_rate = rate
+                    changed_disembarkments.append(disembarkment)
+            new_values["disembarkment_tax"] = disembarkment_tax
+
+        form_changed = False
+        for field_name, new in new_values.items():
+            old = getattr(form, field_name)
+            if old != new:
+                report.add_change(field_name, old, new)
+                setattr(form, field_name, new)
+                form_changed = True
+        if form_changed:
+            report.changed_forms += 1
+            if isinstance(form, CruiseTaxForm):
+                changed_cruise_forms.append(form)
+            else:
+                changed_forms.append(form)
+
+    if not dry_run:
+        with transaction.atomic():
+            HarborDuesForm.objects.bulk_update(changed_forms, ["harbour_tax"])
+            CruiseTaxForm.objects.bulk_update(changed_cruise_forms, TAX_FIELDS)
+            Disembarkment.objects.bulk_update(
+                changed_disembarkments,
+                ["disembarkment_tax", "used_disembarkment_tax_rate"],
+            )
+    return report
@@ -0,0 +1,159 @@
+from __future__ import annotations
+
+import io
+import zipfile
+from collections import deque
+from concurrent.futures import Future
+from tempfile import SpooledTemporaryFile
+from typing import Deque, Dict, Iterable, Iterator, List, Tuple
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.db.models import QuerySet
+from django.utils import timezone, translation
+
+from havneafgifter.models import CruiseTaxForm, HarborDuesForm, pdf_storage
+from havneafgifter.receipts import get_pdf_renderer, get_stored_receipt_pdf
+from havneafgifter.workers import process_pool
+
+# Export of the receipts of many forms at once.
+#
+# ZIP files are written entry by entry to the response, from the PDFs kept in
+# `pdf_storage` (`form.pdf` where it is current, else a stored preview, see
+# `get_stored_receipt_pdf`), so only a chunk of a single receipt is in memory
+# at a time. Receipts which are not stored yet are rendered as they are
+# written by the export view, and by a pool of worker processes, a few forms
+# ahead of the one being written, by the `export_receipts` command.
+#
+# A merged PDF cannot be pieced together from the stored PDFs, so its receipts
+# are laid out as one document. That is done in memory, which is why merged
+# PDFs are limited to `RECEIPT_EXPORT["max_merged_forms"]` forms.
+#
+# The export view must finish within the request timeout of gunicorn, so it
+# exports at most `RECEIPT_EXPORT["max_zip_forms"]` forms at once. Larger
+# exports are done by the `export_receipts` command.
+
+EXPORT_FORMATS = ("zip", "pdf")
+
+CHUNK_SIZE = 64 * 1024
+
+# Number of forms loaded from the database per query
+_BATCH_SIZE = 100
+
+
+def iter_export_forms(queryset: QuerySet) -> Iterator[HarborDuesForm]:
+    """Yield the forms of `queryset` in the order of their primary keys,
+    loading cruise tax forms as such, one batch of forms at a time."""
+    pks: List[int] = list(queryset.order_by("pk").values_list("pk", flat=True))
+    for start in range(0, len(pks), _BATCH_SIZE):
+        batch = pks[start : start + _BATCH_SIZE]
+        forms: Dict[int, HarborDuesForm] = {
+            form.pk: form for form in HarborDuesForm.objects.filter(pk__in=batch)
+        }
+        forms.update(
+            (form.pk, form) for form in CruiseTaxForm.objects.filter(pk__in=batch)
+        )
+        for pk in batch:
+            if pk in forms:
+                yield forms[pk]
+
+
+def iter_stored_receipts(
+    forms: Iterable[HarborDuesForm], workers: int
+) -> Iterator[Tuple[HarborDuesForm, str]]:
+    """Yield each of `forms` with the name of its current receipt PDF in
+    `pdf_storage`, in order.
+
+    The receipts are stored by a pool of `workers` processes (or in this
+    process, if `workers` is 1), at most `2 * workers` forms ahead of the form
+    yielded, in the current language.
+    """
+    if workers <= 1:
+        for form in forms:
+            yield form, get_stored_receipt_pdf(form)[0]
+        return
+    language = translation.get_language() or settings.LANGUAGE_CODE
+    pool = process_pool(workers)
+    try:
+        pending: Deque[Tuple[HarborDuesForm, Future]] = deque()
+        for form in forms:
+            pending.append((form, pool.submit(_store_in_process, form.pk, language)))
+            if len(pending) >= 2 * workers:
+                form, future = pending.popleft()
+                yield form, future.result()
+        while pending:
+            form, future = pending.popleft()
+            yield form, future.result()
+    finally:
+        # Do not render the rest if the export is aborted
+        pool.shutdown(cancel_futures=True)
+
+
+def iter_receipt_zip(
+    receipts: Iterable[Tuple[HarborDuesForm, str]],
+) -> Iterator[bytes]:
+    """Yield a ZIP file of the stored receipts in `receipts` (as yielded by
+    `iter_stored_receipts`), chunk by chunk."""
+    buffer = _ChunkBuffer()
+    with zipfile.ZipFile(buffer, "w", compression=zipfile.ZIP_STORED) as archive:
+        for form, name in receipts:
+            modified = timezone.localtime(pdf_storage.get_modified_time(name))
+            info = zipfile.ZipInfo(
+                f"{form.form_id}.pdf", date_time=modified.timetuple()[:6]
+            )
+            # Known in advance, so ZIP64 extensions are only used where needed
+            info.file_size = pdf_storage.size(name)
+            with pdf_storage.open(name, "rb") as source:
+                with archive.open(info, "w") as target:
+                    while chunk := source.read(CHUNK_SIZE):
+                        target.write(chunk)
+                        yield from buffer.take()
+            yield from buffer.take()
+    yield from buffer.take()
+
+
+def iter_merged_pdf(forms: Iterable[HarborDuesForm]) -> Iterator[bytes]:
+    """Yield a single PDF of the receipts of `forms` (at least one), chunk by
+    chunk."""
+    renderer = get_pdf_renderer()
+    documents = [renderer.render_document(form.get_receipt().html) for form in forms]
+    merged = documents[0].copy(
+        [page for document in documents for page in document.pages]
+    )
+    with SpooledTemporaryFile(max_size=CHUNK_SIZE) as file:
+        merged.write_pdf(file)
+        file.seek(0)
+        while chunk := file.read(CHUNK_SIZE):
+            yield chunk
+
+
+class _ChunkBuffer(io.RawIOBase):
+    # Unseekable file keeping what is written to it, until it is taken. The
+    # `zipfile` module writes data descriptors after the entries in this case,
+    # rather than seeking back to their headers.
+
+    def __init__(self) -> None:
+        super().__init__()
+        self._chunks: List[bytes] = []
+
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def take(self) -> List[bytes]:
+        chunks, self._chunks = self._chunks, []
+        return chunks
+
+
+def _store_in_process(pk: int, language: str) -> str:
+    # The worker processes are reused, so drop their database connection if it
+    # is broken or too old, as at the end of a request
+    close_old_connections()
+    try:
+        with translation.override(language):
+            form = CruiseTaxForm.objects.filter(
+                pk=pk
+            ).first() or HarborDuesForm.objects.get(pk=pk)
+            return get_stored_receipt_pdf(form)[0]
+    finally:
+        close_old_connections()
@@ -1,16 +1,50 @@
-from typing import Callable
+import hashlib
+import mimetypes
+import os
+import posixpath
+import threading
+from collections import OrderedDict
+from datetime import datetime
+from functools import cache
+from io import BytesIO
+from typing import Callable, Dict, Tuple
+from urllib.parse import unquote, urlsplit
 
 import weasyprint
+from django.conf import settings
 from django.contrib.auth.models import AnonymousUser
+from django.contrib.staticfiles import finders
+from django.core.exceptions import SuspiciousFileOperation
+from django.core.files import File
+from django.core.files.base import ContentFile
 from django.http import HttpRequest
 from django.template import Context, Engine, RequestContext, Template
+from django.utils import translation
+from django.utils._os import safe_join
 from django.utils.safestring import SafeString
 from django_fsm import has_transition_perm
-from django_weasyprint.utils import django_url_fetcher
 
-from havneafgifter.models import CruiseTaxForm, HarborDuesForm, ShipType, Status, User
+from havneafgifter.models import (
+    CruiseTaxForm,
+    HarborDuesForm,
+    ShipType,
+    Status,
+    User,
+    pdf_storage,
+)
 
 _PDF_BASE_TEMPLATE: str = "havneafgifter/pdf/base.html"
+_PDF_STYLESHEET: str = "havneafgifter/pdf/receipt.css"
+
+# Number of rendered receipt PDFs kept in memory (see `get_receipt_pdf`)
+PDF_CACHE_SIZE: int = 32
+
+# Directory in `pdf_storage` of the receipt PDFs rendered for previews (see
+# `get_stored_receipt_pdf`)
+PREVIEW_DIR: str = "preview"
+
+_pdf_cache: OrderedDict[Tuple[int, str], bytes] = OrderedDict()
+_pdf_cache_lock = threading.Lock()
 
 
 class Receipt:
@@ -47,14 +81,7 @@ class Receipt:
 
     @property
     def pdf(self) -> bytes:
-        font_config = weasyprint.text.fonts.FontConfiguration()
-        html = weasyprint.HTML(
-            string=self.html,
-            base_url="",
-            url_fetcher=django_url_fetcher,
-        )
-        document = html.render(font_config=font_config)
-        return document.write_pdf()
+        return get_pdf_renderer().render(self.html)
 
     def get_context_data(self) -> dict:
         return {
@@ -91,6 +118,134 @@ class Receipt:
             return self.form.status == Status.NEW
 
 
+class PDFAssetError(Exception):
+    """An asset (stylesheet, image, font, ...) of a receipt PDF is not
+    available locally."""
+
+
+class LocalAssetFetcher(weasyprint.urls.URLFetcher):
+    """Fetches the assets of receipt PDFs without using the network, so
+    rendering does not wait for (or depend on) other servers.
+
+    Static files are read from `STATIC_ROOT`, or found by the static file
+    finders if not collected. They may be referred to by a `file:` URL, by the
+    URL of any host under `STATIC_URL`, or by one of the URLs (e.g. of a CDN)
+    mapped to static files in `PDF_ASSET_URLS`. `data:` URLs are decoded. Any
+    other URL, or a missing file, stops the rendering with a `PDFAssetError`.
+
+    Assets are kept in memory once read.
+    """
+
+    def __init__(self) -> None:
+        super().__init__(allowed_protocols=("data",), fail_on_errors=True)
+        self._fetched: Dict[str, Tuple[str, bytes, Dict[str, str]]] = {}
+
+    def fetch(self, url: str, headers=None) -> weasyprint.urls.URLFetcherResponse:
+        cached = self._fetched.get(url)
+        if cached is None:
+            if url.startswith("data:"):
+                response = super().fetch(url, headers)
+                try:
+                    cached = (url, response.read(), dict(response.headers.items()))
+                finally:
+                    response.close()
+            else:
+                path = self.find(url)
+                with open(path, "rb") as file:
+                    body = file.read()
+                mime_type, _ = mimetypes.guess_type(path)
+                cached = (
+                    url,
+                    body,
+                    {"Content-Type": mime_type or "application/octet-stream"},
+                )
+            self._fetched[url] = cached
+        return weasyprint.urls.URLFetcherResponse(*cached)
+
+    def find(self, url: str) -> str:
+        """Return the path of the static file at `url`."""
+        name = settings.PDF_ASSET_URLS.get(url)
+        if name is None:
+            static_url = str(settings.STATIC_URL)
+            parts = urlsplit(url)
+            if parts.scheme in ("file", "http", "https") and parts.path.startswith(
+                static_url
+            ):
+                name = unquote(parts.path.removeprefix(static_url))
+            else:
+                raise PDFAssetError(
+                    f"{url} is not a static file (and is not fetched over the "
+                    f"network)"
+                )
+        path: str | None = None
+        if settings.STATIC_ROOT:
+            try:
+                path = safe_join(settings.STATIC_ROOT, name)
+            except SuspiciousFileOperation:
+                raise PDFAssetError(f"{url} is not a static file")
+        if path is None or not os.path.isfile(path):
+            path = finders.find(name)
+        if not path:
+            raise PDFAssetError(
+                f"Static file {name} (for {url}) is neither in {settings.STATIC_ROOT} "
+                f"nor found by the static file finders"
+            )
+        return path
+
+
+class PDFRenderer:
+    """Renders receipt HTML to PDF, reusing what is the same for all receipts
+    between documents: the font configuration, the parsed receipt stylesheet,
+    and the fetched assets (see `LocalAssetFetcher`).
+
+    Use `get_pdf_renderer` to get the renderer of the current thread.
+    """
+
+    stylesheet: str = _PDF_STYLESHEET
+
+    def __init__(self) -> None:
+        self.font_config = weasyprint.text.fonts.FontConfiguration()
+        self.url_fetcher = LocalAssetFetcher()
+        self.stylesheets = [
+            weasyprint.CSS(
+                string=Engine.get_default()
+                .get_template(self.stylesheet)
+                .render(Context()),
+                url_fetcher=self.url_fetcher,
+                font_config=self.font_config,
+            )
+        ]
+
+    def render(self, html: str) -> bytes:
+        return self.render_document(html).write_pdf()
+
+    def render_document(self, html: str) -> weasyprint.Document:
+        """Lay out `html`, e.g. to combine its pages with those of other
+        receipts (see `havneafgifter.receipt_export`)."""
+        try:
+            return weasyprint.HTML(
+                string=html,
+                base_url="",
+                url_fetcher=self.url_fetcher,
+            ).render(font_config=self.font_config, stylesheets=self.stylesheets)
+        except weasyprint.urls.FatalURLFetchingError as e:
+            # Not an `Exception`, so raise the error of the fetcher instead
+            if isinstance(e.__cause__, PDFAssetError):
+                raise e.__cause__
+            raise PDFAssetError(str(e)) from e
+
+
+_pdf_renderers = threading.local()
+
+
+def get_pdf_renderer() -> PDFRenderer:
+    # WeasyPrint objects are not shared between threads
+    renderer = getattr(_pdf_renderers, "renderer", None)
+    if renderer is None:
+        renderer = _pdf_renderers.renderer = PDFRenderer()
+    return renderer
+
+
 class HarborDuesFormReceipt(Receipt):
     template: str = "havneafgifter/pdf/harbor_dues_form_receipt.html"
 
@@ -130,3 +285,156 @@ class CruiseTaxFormReceipt(Receipt):
             "disembarkment_tax_items": disembarkment_tax["details"],
             **context,
         }
+
+
+@cache
+def _get_template_version(*templates: str) -> str:
+    # Hash of the source of the given templates
+    engine = Engine.get_default()
+    digest = hashlib.sha256()
+    for name in templates:
+        digest.update(engine.get_template(name).source.encode("utf-8"))
+    return digest.hexdigest()
+
+
+def get_receipt_fingerprint(form: HarborDuesForm) -> str:
+    """Return a hash of everything the receipt PDF of `form` is rendered from:
+    the form fields (including its status), the tax input, the shipping agent,
+    the passengers by country, the templates and the language.
+    """
+    receipt_class = (
+        CruiseTaxFormReceipt
+        if isinstance(form, CruiseTaxForm)
+        else HarborDuesFormReceipt
+    )
+    fields = tuple(
+        getattr(form, field.attname)
+        for field in form._meta.fields
+        if field.name not in ("pdf", "pdf_fingerprint")
+    )
+    agent = form.shipping_agent
+    passengers: tuple = ()
+    if isinstance(form, CruiseTaxForm):
+        passengers = tuple(
+            form.passengers_by_country.order_by("pk").values_list(
+                "nationality", "number_of_passengers"
+            )
+        )
+    rejection = form.latest_rejection if form.status == Status.REJECTED else None
+    return hashlib.sha256(
+        repr(
+            (
+                form.pk,
+                fields,
+                form.get_tax_fingerprint(),
+                (agent.name, agent.email) if agent else None,
+                passengers,
+                getattr(rejection, "reason_text", None),
+                _get_template_version(
+                    _PDF_BASE_TEMPLATE,
+                    _PDF_STYLESHEET,
+                    "havneafgifter/pdf/receipt.html",
+                    receipt_class.template,
+                ),
+                translation.get_language(),
+            )
+        ).encode("utf-8")
+    ).hexdigest()
+
+
+def get_receipt_pdf(form: HarborDuesForm) -> bytes:
+    """Return the receipt PDF of `form`, rendering it only if it has changed.
+
+    The PDF is reused from memory (e.g. when sending several mails about the
+    same form), or from `form.pdf` if that was stored from the same input.
+    """
+    key = (form.pk, get_receipt_fingerprint(form))
+    with _pdf_cache_lock:
+        pdf = _pdf_cache.get(key)
+        if pdf is not None:
+            _pdf_cache.move_to_end(key)
+            return pdf
+    pdf = None
+    if form.pdf and form.pdf_fingerprint == key[1]:
+        try:
+            with form.pdf.open("rb") as file:
+                pdf = file.read()
+        except OSError:
+            pdf = None
+    if pdf is None:
+        pdf = form.get_receipt().pdf
+    with _pdf_cache_lock:
+        _pdf_cache[key] = pdf
+        while len(_pdf_cache) > PDF_CACHE_SIZE:
+            _pdf_cache.popitem(last=False)
+    return pdf
+
+
+def save_receipt_pdf(form: HarborDuesForm, pdf: bytes | None = None) -> None:
+    """Store the receipt PDF of `form` (as returned by `get_receipt_pdf`) in
+    `form.pdf`, unless it is already stored."""
+    fingerprint = get_receipt_fingerprint(form)
+    if form.pdf and form.pdf_fingerprint == fingerprint:
+        return
+    if pdf is None:
+        pdf = get_receipt_pdf(form)
+    form.pdf = File(BytesIO(pdf), name=form.get_pdf_filename())
+    form.pdf_fingerprint = fingerprint
+    form.save(update_fields=["pdf", "pdf_fingerprint"])
+
+
+def get_stored_receipt_pdf(form: HarborDuesForm) -> Tuple[str, str, datetime]:
+    """Return the name in `pdf_storage` of the current receipt PDF of `form`,
+    its fingerprint and its modification time, rendering and storing it first
+    if needed.
+
+    This is `form.pdf` if it is current, or else a preview stored under the
+    fingerprint, replacing the previous previews of `form`.
+    """
+    fingerprint = get_receipt_fingerprint(form)
+    if form.pdf and form.pdf_fingerprint == fingerprint:
+        try:
+            return (
+                form.pdf.name,
+                fingerprint,
+                pdf_storage.get_modified_time(form.pdf.name),
+            )
+        except OSError:
+            pass
+    directory = posixpath.join(PREVIEW_DIR, str(form.pk))
+    name = posixpath.join(directory, f"{fingerprint}.pdf")
+    if not pdf_storage.exists(name):
+        saved = pdf_storage.save(name, ContentFile(get_receipt_pdf(form)))
+        if saved != name:
+            # Stored by someone else in the meantime
+            pdf_storage.delete(saved)
+        for filename in pdf_storage.listdir(directory)[1]:
+            if filename != f"{fingerprint}.pdf":
+                pdf_storage.delete(posixpath.join(directory, filename))
+    return name, fingerprint, pdf_storage.get_modified_time(name)
+
+
+def clear_receipt_cache(stored: bool = False) -> int:
+    """Delete the stored previews (and forget the PDFs rendered in this
+    process), and return the number of previews deleted.
+
+    Receipts are re-rendered when their templates change anyway, but this frees
+    the storage used by outdated previews. If `stored` is set, `form.pdf` is no
+    longer reused as a preview either, until it is stored again.
+    """
+    with _pdf_cache_lock:
+        _pdf_cache.clear()
+    _get_template_version.cache_clear()
+    deleted = 0
+    if pdf_storage.exists(PREVIEW_DIR):
+        for directory in pdf_storage.listdir(PREVIEW_DIR)[0]:
+            path = posixpath.join(PREVIEW_DIR, directory)
+            for filename in pdf_storage.listdir(path)[1]:
+                pdf_storage.delete(posixpath.join(path, filename))
+                deleted += 1
+            pdf_storage.delete(path)
+    if stored:
+        HarborDuesForm.objects.filter(pdf_fingerprint__isnull=False).update(
+            pdf_fingerprint=None
+        )
+    return deleted
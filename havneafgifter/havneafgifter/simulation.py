@@ -0,0 +1,286 @@
+from __future__ import annotations
+
+from dataclasses import dataclass, field
+from datetime import date, datetime
+from decimal import Decimal
+from typing import Dict, Iterable, List
+
+from django.db.models import QuerySet
+from django.utils.translation import gettext as _
+
+from havneafgifter.calculation import (
+    DisembarkmentInput,
+    TaxInput,
+    calculate_disembarkment_tax_line,
+    calculate_harbour_taxes,
+    calculate_passenger_tax,
+)
+from havneafgifter.models import (
+    Disembarkment,
+    DisembarkmentTaxRate,
+    HarborDuesForm,
+    Municipality,
+    PortTaxRate,
+    ShipType,
+    Status,
+    TaxRates,
+)
+from havneafgifter.tariffs import TariffIndex, get_tariff_index
+
+# "What if" simulation of a candidate tariff over historical forms.
+#
+# The forms and their disembarkments are loaded once into column arrays (one list
+# per field, without model instances). The taxes are then computed row by row
+# (using `havneafgifter.calculation`) for both the current and the candidate
+# tariff, and the differences are summed up per port, vessel type and
+# municipality. Only the tariff index is consulted during the computation, so
+# evaluating a candidate does not query the database.
+
+
+@dataclass
+class FormColumns:
+    pk: List[int] = field(default_factory=list)
+    port_id: List[int | None] = field(default_factory=list)
+    port_name: List[str | None] = field(default_factory=list)
+    vessel_type: List[str | None] = field(default_factory=list)
+    gross_tonnage: List[int | None] = field(default_factory=list)
+    arrival: List[datetime | None] = field(default_factory=list)
+    departure: List[datetime | None] = field(default_factory=list)
+    form_date: List[date | None] = field(default_factory=list)
+    # Only set for cruise tax forms
+    passengers: List[int | None] = field(default_factory=list)
+
+    # Disembarkments, with `form` being the row number of the form above
+    disembarkment_form: List[int] = field(default_factory=list)
+    disembarkment_site_id: List[int] = field(default_factory=list)
+    disembarkment_municipality: List[int] = field(default_factory=list)
+    disembarkment_passengers: List[int] = field(default_factory=list)
+
+    def __len__(self) -> int:
+        return len(self.pk)
+
+    @classmethod
+    def load(cls, queryset: QuerySet[HarborDuesForm] | None = None) -> FormColumns:
+        if queryset is None:
+            queryset = HarborDuesForm.objects.exclude(status=Status.DRAFT)
+        else:
+            # Also accept e.g. `CruiseTaxForm` querysets
+            queryset = HarborDuesForm.objects.filter(
+                pk__in=queryset.values_list("pk", flat=True)
+            )
+        columns = cls()
+        rows = queryset.order_by("pk").values_list(
+            "pk",
+            "port_of_call_id",
+            "port_of_call__name",
+            "vessel_type",
+            "gross_tonnage",
+            "datetime_of_arrival",
+            "datetime_of_departure",
+            "date",
+            "cruisetaxform__number_of_passengers",
+        )
+        targets: tuple[list, ...] = (
+            columns.pk,
+            columns.port_id,
+            columns.port_name,
+            columns.vessel_type,
+            columns.gross_tonnage,
+            columns.arrival,
+            columns.departure,
+            columns.form_date,
+            columns.passengers,
+        )
+        for row in rows:
+            for column, value in zip(targets, row):
+                column.append(value)
+
+        row_numbers = {pk: row_number for row_number, pk in enumerate(columns.pk)}
+        disembarkments = Disembarkment.objects.filter(
+            cruise_tax_form__in=queryset.values_list("pk", flat=True)
+        ).values_list(
+            "cruise_tax_form_id",
+            "disembarkment_site_id",
+            "disembarkment_site__municipality",
+            "number_of_passengers",
+        )
+        for form_id, site_id, municipality, passengers in disembarkments:
+            columns.disembarkment_form.append(row_numbers[form_id])
+            columns.disembarkment_site_id.append(site_id)
+            columns.disembarkment_municipality.append(municipality)
+            columns.disembarkment_passengers.append(passengers)
+        return columns
+
+
+@dataclass
+class TaxColumns:
+    harbour_tax: List[Decimal]
+    pax_tax: List[Decimal]
+    # One value per disembarkment
+    disembarkment_tax: List[Decimal]
+
+    def form_totals(self, columns: FormColumns) -> List[Decimal]:
+        totals = [
+            harbour_tax + pax_tax
+            for harbour_tax, pax_tax in zip(self.harbour_tax, self.pax_tax)
+        ]
+        for row_number, tax in zip(columns.disembarkment_form, self.disembarkment_tax):
+            totals[row_number] += tax
+        return totals
+
+
+def calculate_tax_columns(index: TariffIndex, columns: FormColumns) -> TaxColumns:
+    """Compute the harbour, passenger and disembarkment taxes of all forms in
+    `columns`, using the tariffs in `index`, with missing values counting as zero.
+    """
+    zero = Decimal(0)
+    tax_inputs = [
+        TaxInput(
+            vessel_type=vessel_type,
+            port_of_call_id=port_id,
+            gross_tonnage=gross_tonnage,
+            datetime_of_arrival=arrival,
+            datetime_of_departure=departure,
+            form_date=form_date,
+            number_of_passengers=passengers,
+        )
+        for (
+            port_id,
+            vessel_type,
+            gross_tonnage,
+            arrival,
+            departure,
+            form_date,
+            passengers,
+        ) in zip(
+            columns.port_id,
+            columns.vessel_type,
+            columns.gross_tonnage,
+            columns.arrival,
+            columns.departure,
+            columns.form_date,
+            columns.passengers,
+        )
+    ]
+    harbour_tax: List[Decimal] = [
+        tax or zero for tax in calculate_harbour_taxes(tax_inputs, index)
+    ]
+    pax_tax: List[Decimal] = [
+        calculate_passenger_tax(tax_input, index)[0] or zero for tax_input in tax_inputs
+    ]
+    disembarkment_tax: List[Decimal] = [
+        calculate_disembarkment_tax_line(
+            DisembarkmentInput(site_id, municipality, passengers),
+            tax_inputs[row_number].disembarkment_datetime,
+            index,
+        ).tax
+        for row_number, site_id, municipality, passengers in zip(
+            columns.disembarkment_form,
+            columns.disembarkment_site_id,
+            columns.disembarkment_municipality,
+            columns.disembarkment_passengers,
+        )
+    ]
+    return TaxColumns(harbour_tax, pax_tax, disembarkment_tax)
+
+
+@dataclass
+class Delta:
+    current: Decimal = Decimal(0)
+    candidate: Decimal = Decimal(0)
+
+    @property
+    def delta(self) -> Decimal:
+        return self.candidate - self.current
+
+    def add(self, current: Decimal, candidate: Decimal):
+        self.current += current
+        self.candidate += candidate
+
+
+@dataclass
+class SimulationResult:
+    forms: int = 0
+    changed_forms: int = 0
+    total: Delta = field(default_factory=Delta)
+    by_port: Dict[str, Delta] = field(default_factory=dict)
+    by_vessel_type: Dict[str, Delta] = field(default_factory=dict)
+    # Only disembarkment tax is attributed to a municipality
+    by_municipality: Dict[str, Delta] = field(default_factory=dict)
+
+    def __str__(self) -> str:
+        lines = [
+            f"{self.changed_forms} of {self.forms} forms change",
+            f"Total: {self.total.current} -> {self.total.candidate} "
+            f"({self.total.delta:+})",
+        ]
+        for title, groups in (
+            ("Port", self.by_port),
+            ("Vessel type", self.by_vessel_type),
+            ("Municipality", self.by_municipality),
+        ):
+            lines.append(f"{title}:")
+            for label, delta in groups.items():
+                lines.append(
+                    f"  {label}: {delta.current} -> {delta.candidate} "
+                    f"({delta.delta:+})"
+                )
+        return "\n".join(lines)
+
+
+def simulate(
+    candidate: TariffIndex,
+    columns: FormColumns | None = None,
+    current: TariffIndex | None = None,
+) -> SimulationResult:
+    """Compare the taxes of the forms in `columns` (by default all non-draft
+    forms) under the `current` tariffs (by default the ones in effect) and the
+    `candidate` tariffs.
+    """
+    if columns is None:
+        columns = FormColumns.load()
+    if current is None:
+        current = get_tariff_index()
+    current_taxes = calculate_tax_columns(current, columns)
+    candidate_taxes = calculate_tax_columns(candidate, columns)
+
+    result = SimulationResult(forms=len(columns))
+    no_port = str(_("no port of call"))
+    for port_name, vessel_type, current_total, candidate_total in zip(
+        columns.port_name,
+        columns.vessel_type,
+        current_taxes.form_totals(columns),
+        candidate_taxes.form_totals(columns),
+    ):
+        if current_total != candidate_total:
+            result.changed_forms += 1
+        result.total.add(current_total, candidate_total)
+        result.by_port.setdefault(port_name or no_port, Delta()).add(
+            current_total, candidate_total
+        )
+        vessel_type_label = str(ShipType(vessel_type).label) if vessel_type else "-"
+        result.by_vessel_type.setdefault(vessel_type_label, Delta()).add(
+            current_total, candidate_total
+        )
+    for municipality, current_tax, candidate_tax in zip(
+        columns.disembarkment_municipality,
+        current_taxes.disembarkment_tax,
+        candidate_taxes.disembarkment_tax,
+    ):
+        result.by_municipality.setdefault(
+            str(Municipality(municipality).label), Delta()
+        ).add(current_tax, candidate_tax)
+    return result
+
+
+def candidate_index(
+    tax_rates: TaxRates,
+    port_tax_rates: Iterable[PortTaxRate],
+    disembarkment_tax_rates: Iterable[DisembarkmentTaxRate],
+) -> TariffIndex:
+    """Return the tariffs in effect, with `tax_rates` and its rates added (or
+    replacing the saved version of `tax_rates`).
+    """
+    return get_tariff_index().with_candidate(
+        tax_rates, port_tax_rates, disembarkment_tax_rates
+    )
@@ -0,0 +1,267 @@
+from __future__ import annotations
+
+import threading
+from bisect import bisect_right
+from copy import copy
+from datetime import datetime
+from typing import Iterable, Iterator, List, Tuple
+from uuid import UUID
+
+from havneafgifter.models import (
+    DisembarkmentTaxRate,
+    PortTaxRate,
+    TariffVersion,
+    TaxRates,
+)
+
+# In-memory index of the tariff tables (`TaxRates`, `PortTaxRate` and
+# `DisembarkmentTaxRate`).
+#
+# The tariff tables change a few times a year, but are read for every tax
+# calculation. Instead of querying them once (or more) per tariff period for
+# every form, each process keeps one compiled copy of the tables around, and
+# rebuilds it when the `TariffVersion` row says that the tables have changed.
+
+
+class PortTaxRateTable:
+    """The port tax rates belonging to a single `TaxRates` object, indexed by
+    gross tonnage.
+
+    The gross tonnage bands are split into elementary segments, within which the
+    set of matching `PortTaxRate` objects is constant. A lookup is then a binary
+    search for the segment, followed by the same "specific value, else NULL"
+    fallback as `TaxRates.get_port_tax_rate`.
+    """
+
+    def __init__(self, port_tax_rates: Iterable[PortTaxRate]):
+        rates = sorted(port_tax_rates, key=_by_pk)
+        boundaries = {rate.gt_start for rate in rates}
+        boundaries.update(rate.gt_end + 1 for rate in rates if rate.gt_end is not None)
+        self.boundaries: List[int] = sorted(boundaries)
+        self.segments: List[List[PortTaxRate]] = [
+            [
+                rate
+                for rate in rates
+                if rate.gt_start <= boundary
+                and (rate.gt_end is None or rate.gt_end >= boundary)
+            ]
+            for boundary in self.boundaries
+        ]
+        self._resolved: dict[tuple, PortTaxRate | None] = {}
+
+    def get(
+        self, port_id: int | None, vessel_type: str | None, gross_ton: int
+    ) -> PortTaxRate | None:
+        segment = bisect_right(self.boundaries, gross_ton) - 1
+        if segment < 0:
+            return None
+        key = (segment, vessel_type, port_id)
+        try:
+            return self._resolved[key]
+        except KeyError:
+            result = self._resolve(self.segments[segment], vessel_type, port_id)
+            self._resolved[key] = result
+            return result
+
+    def bands(
+        self, port_id: int | None, vessel_type: str | None
+    ) -> Iterator[Tuple[int, int | None, PortTaxRate]]:
+        """Yield `(gt_start, gt_end, port_tax_rate)` for the gross tonnage bands
+        in which a port tax rate applies to the given port and vessel type.
+
+        Adjacent segments resolving to the same rate are merged into one band,
+        and `gt_end` is inclusive (`None` for an open-ended band), as on
+        `PortTaxRate`.
+        """
+        band_start: int = 0
+        band_rate: PortTaxRate | None = None
+        for boundary in self.boundaries:
+            rate = self.get(port_id, vessel_type, boundary)
+            if rate is not band_rate:
+                if band_rate is not None:
+                    yield band_start, boundary - 1, band_rate
+                band_start, band_rate = boundary, rate
+        if band_rate is not None:
+            yield band_start, None, band_rate
+
+    @staticmethod
+    def _resolve(
+        candidates: List[PortTaxRate], vessel_type: str | None, port_id: int | None
+    ) -> PortTaxRate | None:
+        for attr, value in (("vessel_type", vessel_type), ("port_id", port_id)):
+            matching = [rate for rate in candidates if getattr(rate, attr) == value]
+            if matching:
+                candidates = matching
+            else:
+                candidates = [
+                    rate for rate in candidates if getattr(rate, attr) is None
+                ]
+        return candidates[0] if candidates else None
+
+
+def _by_pk(obj) -> tuple:
+    # Sort key mimicking `QuerySet.first()` on an unordered queryset. Unsaved
+    # objects (as in a candidate tariff) keep their relative order, and go last.
+    return (obj.pk is None, obj.pk or 0)
+
+
+class TariffPeriod:
+    def __init__(
+        self,
+        tax_rates: TaxRates,
+        port_tax_rates: Iterable[PortTaxRate],
+        disembarkment_tax_rates: Iterable[DisembarkmentTaxRate] = (),
+    ):
+        self.tax_rates = tax_rates
+        self.start_datetime: datetime | None = tax_rates.start_datetime
+        self.end_datetime: datetime | None = tax_rates.end_datetime
+        self.port_tax_rates = PortTaxRateTable(port_tax_rates)
+        self.disembarkment_tax_rates: List[DisembarkmentTaxRate] = sorted(
+            disembarkment_tax_rates, key=_by_pk
+        )
+        # First match wins, as in `TaxRates.get_disembarkment_tax_rate`
+        self._disembarkment_by_site: dict[int, DisembarkmentTaxRate] = {}
+        self._disembarkment_by_municipality: dict[int, DisembarkmentTaxRate] = {}
+        for rate in reversed(self.disembarkment_tax_rates):
+            if rate.disembarkment_site_id is not None:
+                self._disembarkment_by_site[rate.disembarkment_site_id] = rate
+            self._disembarkment_by_municipality[rate.municipality] = rate
+
+    def get_port_tax_rate(
+        self, port_id: int | None, vessel_type: str | None, gross_ton: int
+    ) -> PortTaxRate | None:
+        return self.port_tax_rates.get(port_id, vessel_type, gross_ton)
+
+    def get_disembarkment_tax_rate(
+        self, disembarkment_site_id: int, municipality: int
+    ) -> DisembarkmentTaxRate | None:
+        try:
+            return self._disembarkment_by_site[disembarkment_site_id]
+        except KeyError:
+            # Like `TaxRates.get_disembarkment_tax_rate`, the fallback is any
+            # rate in the municipality, not just those without a site
+            return self._disembarkment_by_municipality.get(municipality)
+
+
+class TariffIndex:
+    def __init__(self, periods: Iterable[TariffPeriod], version: UUID | None = None):
+        # Same order as `TaxRates.Meta.ordering`: ascending, open start first
+        self.periods: List[TariffPeriod] = sorted(
+            periods,
+            key=lambda period: (
+                period.start_datetime is not None,
+                period.start_datetime,
+            ),
+        )
+        self.version = version
+        self._open_start = sum(
+            1 for period in self.periods if period.start_datetime is None
+        )
+        self._starts: List[datetime] = [
+            period.start_datetime  # type: ignore[misc]
+            for period in self.periods[self._open_start :]
+        ]
+
+    @classmethod
+    def load(cls, version: UUID | None = None) -> TariffIndex:
+        port_tax_rates: dict[int, List[PortTaxRate]] = {}
+        for port_tax_rate in PortTaxRate.objects.all():
+            port_tax_rates.setdefault(port_tax_rate.tax_rates_id, []).append(
+                port_tax_rate
+            )
+        disembarkment_tax_rates: dict[int, List[DisembarkmentTaxRate]] = {}
+        for disembarkment_tax_rate in DisembarkmentTaxRate.objects.all():
+            disembarkment_tax_rates.setdefault(
+                disembarkment_tax_rate.tax_rates_id, []
+            ).append(disembarkment_tax_rate)
+        return cls(
+            (
+                TariffPeriod(
+                    tax_rates,
+                    port_tax_rates.get(tax_rates.pk, []),
+                    disembarkment_tax_rates.get(tax_rates.pk, []),
+                )
+                for tax_rates in TaxRates.objects.all()
+            ),
+            version=version,
+        )
+
+    def with_candidate(
+        self,
+        tax_rates: TaxRates,
+        port_tax_rates: Iterable[PortTaxRate],
+        disembarkment_tax_rates: Iterable[DisembarkmentTaxRate],
+    ) -> TariffIndex:
+        """Return a new index in which `tax_rates` (and its rates) replaces the
+        period with the same pk, or is added as a new period if it is unsaved.
+
+        The end of each period is recalculated as in `TaxRates.on_update`. Nothing
+        is saved, and this index is left untouched.
+        """
+        periods = [
+            copy(period)
+            for period in self.periods
+            if tax_rates.pk is None or period.tax_rates.pk != tax_rates.pk
+        ]
+        periods.append(TariffPeriod(tax_rates, port_tax_rates, disembarkment_tax_rates))
+        periods.sort(
+            key=lambda period: (
+                period.start_datetime is not None,
+                period.start_datetime,
+            )
+        )
+        end_datetime = None
+        for period in reversed(periods):
+            period.tax_rates = copy(period.tax_rates)
+            period.tax_rates.end_datetime = period.end_datetime = end_datetime
+            end_datetime = period.start_datetime
+        return TariffIndex(periods)
+
+    def get_periods(self, start: datetime, end: datetime) -> List[TariffPeriod]:
+        """Return the tariff periods which overlap the range from `start` to `end`,
+        with the same semantics as the query previously done in
+        `HarborDuesForm.calculate_harbour_tax`, i.e. periods which merely touch
+        the range are included.
+        """
+        # All periods starting no later than `end`
+        count = self._open_start + bisect_right(self._starts, end)
+        return [
+            period
+            for period in self.periods[:count]
+            if period.end_datetime is None or period.end_datetime >= start
+        ]
+
+    def get_period(self, moment: datetime) -> TariffPeriod | None:
+        """Return the first tariff period containing `moment`, as used for
+        passenger and disembarkment taxes.
+        """
+        periods = self.get_periods(moment, moment)
+        return periods[0] if periods else None
+
+
+_lock = threading.Lock()
+_index: TariffIndex | None = None
+
+
+def get_tariff_index() -> TariffIndex:
+    """Return the process-wide tariff index, rebuilding it if the tariff tables
+    have changed since it was built.
+
+    Batch callers should obtain the index once and reuse it for all forms.
+    """
+    global _index
+    version = TariffVersion.current()
+    index = _index
+    if index is None or index.version != version:
+        with _lock:
+            index = _index
+            if index is None or index.version != version:
+                index = TariffIndex.load(version)
+                _index = index
+    return index
+
+
+def invalidate_tariff_index() -> None:
+    global _index
+    with _lock:
+        _index = None
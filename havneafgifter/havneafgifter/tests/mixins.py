@@ -1,10 +1,12 @@
 import os
 import zoneinfo
+from contextlib import nullcontext
 from datetime import datetime, timezone
 
 from django.conf import settings
 from django.contrib.auth.models import Group
 from django.core.management import call_command
+from django.db import DEFAULT_DB_ALIAS
 
 from havneafgifter.models import (
     CruiseTaxForm,
@@ -25,7 +27,13 @@ class HarborDuesFormTestMixin:
     def setUpTestData(cls):
         call_command("create_groups", verbosity=1)
         super().setUpTestData()
+        # Run the CVR checks deferred until the transaction commits (see
+        # `HarborDuesForm.schedule_check_cvr`), as the test transaction never does
+        with cls.captureOnCommitCallbacks(execute=True):
+            cls._create_test_data()
 
+    @classmethod
+    def _create_test_data(cls):
         cls._load_initial_disembarkment_sites()
 
         cls.port_authority = PortAuthority.objects.create(
@@ -177,3 +185,27 @@ class HarborDuesFormTestMixin:
             "initial_disembarkment_sites.json",
         )
         call_command("loaddata", path, verbosity=0)
+
+
+class CommittedDataTestMixin:
+    """For `TransactionTestCase`s, whose data is committed, and thus seen by
+    worker threads and processes.
+
+    As the database is flushed after each test, `setUpTestData` is run before
+    each test, and the data created by the migrations is restored.
+    """
+
+    serialized_rollback = True
+
+    @classmethod
+    def setUpTestData(cls):
+        pass
+
+    @classmethod
+    def captureOnCommitCallbacks(cls, *, using=DEFAULT_DB_ALIAS, execute=False):
+        # Outside a transaction, the callbacks are run at once
+        return nullcontext([])
+
+    def setUp(self):
+        super().setUp()
+        type(self).setUpTestData()
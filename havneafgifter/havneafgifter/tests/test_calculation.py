@@ -1,8 +1,15 @@
 from datetime import datetime, timezone
 from decimal import Decimal
 
-from django.test import TestCase
+from django.test import SimpleTestCase, TestCase
+from django.utils import timezone as django_timezone
 
+from havneafgifter.calculation import (
+    DisembarkmentInput,
+    TaxInput,
+    calculate_harbour_tax,
+    calculate_taxes,
+)
 from havneafgifter.data import DateTimeRange
 from havneafgifter.models import (
     CruiseTaxForm,
@@ -18,6 +25,7 @@ from havneafgifter.models import (
     ShipType,
     TaxRates,
 )
+from havneafgifter.tariffs import TariffIndex, TariffPeriod
 
 
 class CalculationTest(TestCase):
@@ -539,3 +547,130 @@ class CalculationTest(TestCase):
         self, obj: HarborDuesForm | CruiseTaxForm
     ) -> HarborDuesForm | CruiseTaxForm:
         return obj._meta.model.objects.get(pk=obj.pk)
+
+
+class PureCalculationTest(SimpleTestCase):
+    # `SimpleTestCase` fails on any database query, proving that the calculation
+    # does no I/O
+
+    def setUp(self):
+        super().setUp()
+        tax_rates1 = TaxRates(
+            pax_tax_rate=Decimal("50"),
+            end_datetime=datetime(2025, 1, 1, tzinfo=timezone.utc),
+        )
+        tax_rates2 = TaxRates(
+            pax_tax_rate=Decimal("70"),
+            start_datetime=datetime(2025, 1, 1, tzinfo=timezone.utc),
+        )
+        self.port_tax_rate1 = PortTaxRate(
+            tax_rates=tax_rates1,
+            gt_start=0,
+            port_tax_rate=Decimal("0.7"),
+            round_gross_ton_up_to=70,
+        )
+        self.port_tax_rate2 = PortTaxRate(
+            tax_rates=tax_rates2,
+            gt_start=0,
+            port_tax_rate=Decimal("1.4"),
+            round_gross_ton_up_to=70,
+        )
+        self.tariffs = TariffIndex(
+            [
+                TariffPeriod(
+                    tax_rates1,
+                    [self.port_tax_rate1],
+                    [
+                        DisembarkmentTaxRate(
+                            tax_rates=tax_rates1,
+                            municipality=Municipality.AVANNAATA,
+                            disembarkment_tax_rate=Decimal("40"),
+                        )
+                    ],
+                ),
+                TariffPeriod(tax_rates2, [self.port_tax_rate2]),
+            ]
+        )
+
+    def test_calculate_taxes(self):
+        result = calculate_taxes(
+            TaxInput(
+                vessel_type=ShipType.CRUISE,
+                port_of_call_id=1,
+                gross_tonnage=10,
+                datetime_of_arrival=datetime(2024, 12, 30, 8, tzinfo=timezone.utc),
+                datetime_of_departure=datetime(2025, 1, 2, 16, tzinfo=timezone.utc),
+                number_of_passengers=100,
+                disembarkments=(
+                    DisembarkmentInput(1, Municipality.AVANNAATA, 20),
+                    DisembarkmentInput(2, Municipality.QEQQATA, 30),
+                ),
+            ),
+            self.tariffs,
+        )
+        # 2 days at 0.7 kr. and 2 days at 1.4 kr., for 70 tons (rounded up)
+        self.assertEqual(result.harbour_tax, Decimal("294"))
+        self.assertEqual(
+            [
+                (line.port_tax_rate, line.date_range.started_days, line.harbour_tax)
+                for line in result.harbour_tax_lines
+            ],
+            [
+                (self.port_tax_rate1, 2, Decimal("98")),
+                (self.port_tax_rate2, 2, Decimal("196")),
+            ],
+        )
+        # The passenger and disembarkment rates in effect at arrival
+        self.assertEqual(result.passenger_tax, Decimal("5000"))
+        self.assertEqual(result.passenger_tax_rate, Decimal("50"))
+        self.assertEqual(result.disembarkment_tax, Decimal("800"))
+        self.assertEqual(
+            [line.rate for line in result.disembarkment_tax_lines],
+            [Decimal("40"), Decimal("0")],
+        )
+        self.assertEqual(result.total_tax, Decimal("6094"))
+
+    def test_calculate_harbour_tax_per_week(self):
+        harbour_tax, lines = calculate_harbour_tax(
+            TaxInput(
+                vessel_type=ShipType.FREIGHTER,
+                port_of_call_id=1,
+                gross_tonnage=100,
+                datetime_of_arrival=datetime(2025, 1, 2, tzinfo=timezone.utc),
+                datetime_of_departure=datetime(2025, 1, 10, tzinfo=timezone.utc),
+            ),
+            self.tariffs,
+        )
+        # 2 started weeks at 1.4 kr. for 100 tons
+        self.assertEqual(harbour_tax, Decimal("280"))
+        self.assertEqual(len(lines), 1)
+
+    def test_insufficient_input(self):
+        result = calculate_taxes(
+            TaxInput(
+                vessel_type=ShipType.CRUISE,
+                form_date=datetime(2024, 12, 31).date(),
+                disembarkments=(DisembarkmentInput(1, Municipality.AVANNAATA, 10),),
+            ),
+            self.tariffs,
+        )
+        self.assertIsNone(result.harbour_tax)
+        self.assertEqual(result.harbour_tax_lines, [])
+        self.assertIsNone(result.passenger_tax)
+        # The form date is used for disembarkments
+        self.assertEqual(result.disembarkment_tax, Decimal("400"))
+
+    def test_disembarkment_datetime(self):
+        self.assertIsNone(TaxInput().disembarkment_datetime)
+        # A form date counts from midnight, in the current time zone
+        self.assertEqual(
+            TaxInput(form_date=datetime(2024, 12, 31).date()).disembarkment_datetime,
+            django_timezone.make_aware(datetime(2024, 12, 31)),
+        )
+        arrival = datetime(2025, 1, 1, 12, 0, tzinfo=timezone.utc)
+        self.assertEqual(
+            TaxInput(
+                datetime_of_arrival=arrival, form_date=datetime(2024, 12, 31).date()
+            ).disembarkment_datetime,
+            arrival,
+        )
@@ -1,8 +1,10 @@
+from dataclasses import FrozenInstanceError
 from datetime import date, datetime, timezone
 
 from django.test import TestCase
 
-from havneafgifter.data import DateRange, DateTimeRange
+from havneafgifter.data import DateRange, DateTimeRange, overlap_periods
+from havneafgifter.models import TaxRates
 
 
 class DateRangeTest(TestCase):
@@ -95,3 +97,59 @@ class DateTimeRangeTest(TestCase):
             ).started_weeks,
             2,
         )
+
+    def test_derived_values_are_cached(self):
+        date_range = DateTimeRange(
+            datetime(2024, 4, 1, 8, 0, 0, tzinfo=timezone.utc),
+            datetime(2024, 4, 9, 16, 0, 0, tzinfo=timezone.utc),
+        )
+        self.assertEqual(date_range.started_days, 9)
+        self.assertEqual(date_range.started_weeks, 2)
+        # Equality and representation only depend on the start and end
+        self.assertEqual(
+            date_range,
+            DateTimeRange(
+                datetime(2024, 4, 1, 8, 0, 0, tzinfo=timezone.utc),
+                datetime(2024, 4, 9, 16, 0, 0, tzinfo=timezone.utc),
+            ),
+        )
+        self.assertNotIn("started", repr(date_range))
+        # The range is immutable, so the derived values cannot go stale
+        with self.assertRaises(FrozenInstanceError):
+            date_range.end_datetime = datetime(2024, 4, 2, tzinfo=timezone.utc)
+
+
+class OverlapPeriodsTest(TestCase):
+    def test_overlap_periods(self):
+        def utc(*args):
+            return datetime(*args, tzinfo=timezone.utc)
+
+        period_starts = [None, utc(2025, 1, 1), utc(2025, 2, 1)]
+        period_ends = [utc(2025, 1, 1), utc(2025, 2, 1), None]
+        starts = [utc(2024, 12, 15, 8), utc(2025, 1, 10), utc(2025, 3, 1)]
+        ends = [utc(2025, 1, 3, 16), utc(2025, 1, 10, 12), utc(2025, 3, 20)]
+        overlaps = overlap_periods(starts, ends, period_starts, period_ends)
+        self.assertEqual(overlaps.range_index, [0, 0, 1, 2])
+        self.assertEqual(overlaps.period_index, [0, 1, 1, 2])
+        # Same result as computing each overlap separately
+        for position in range(len(overlaps)):
+            period_index = overlaps.period_index[position]
+            range_index = overlaps.range_index[position]
+            date_range = TaxRates(
+                start_datetime=period_starts[period_index],
+                end_datetime=period_ends[period_index],
+            ).get_overlap(starts[range_index], ends[range_index])
+            with self.subTest(position=position):
+                self.assertEqual(
+                    DateTimeRange(
+                        overlaps.start_datetime[position],
+                        overlaps.end_datetime[position],
+                    ),
+                    date_range,
+                )
+                self.assertEqual(
+                    overlaps.started_days[position], date_range.started_days
+                )
+                self.assertEqual(
+                    overlaps.started_weeks[position], date_range.started_weeks
+                )
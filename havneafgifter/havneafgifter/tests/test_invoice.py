@@ -1,11 +1,15 @@
+import os
 from datetime import date, datetime, timedelta
 from decimal import Decimal
+from io import StringIO
+from tempfile import TemporaryDirectory
 from unittest.mock import MagicMock, patch
 
 from django.conf import settings
 from django.contrib.auth.models import Group
 from django.core.management import call_command
-from django.test import TestCase, override_settings
+from django.db import connection
+from django.test import TestCase, TransactionTestCase, override_settings
 from prisme.client import Prisme
 from prisme.exceptions import PrismeException
 
@@ -14,24 +18,37 @@ from havneafgifter.clients.prisme import (
     InvoiceCustomTableResponse,
     PrismeClient,
 )
+from havneafgifter.clients.prisme_standin import (
+    PrismeStandIn,
+    PrismeStandInServer,
+    StandInConfig,
+)
+from havneafgifter.instrumentation import instrumentation
+from havneafgifter.invoicing import dispatch_batch, dispatch_invoices
 from havneafgifter.models import (
     CruiseTaxForm,
     Disembarkment,
     DisembarkmentSite,
     DisembarkmentTaxRate,
+    HarborDuesForm,
+    InvoiceOutboxItem,
+    MetricKind,
     Nationality,
     Port,
     PortAuthority,
     PortTaxRate,
+    PrismeDebitor,
     ShippingAgent,
     ShipType,
+    StageMetric,
     Status,
     TaxRates,
     User,
 )
+from havneafgifter.tests.mixins import CommittedDataTestMixin
 
 
-class InvoiceTest(TestCase):
+class InvoiceTestMixin:
     @classmethod
     def setUpTestData(cls):
         current_timezone = datetime.now().astimezone().tzinfo
@@ -95,6 +112,24 @@ class InvoiceTest(TestCase):
             disembarkment_site=cls.site,
         )
 
+    def _create_harbor_dues_form(self, **kwargs) -> HarborDuesForm:
+        kwargs.setdefault("shipping_agent", self.shipping_agent)
+        return HarborDuesForm.objects.create(
+            status=Status.NEW,
+            port_of_call=self.port,
+            nationality=Nationality.DENMARK,
+            vessel_name="Skidbladnir",
+            vessel_imo="7654321",
+            vessel_owner="Magenta ApS",
+            vessel_type=ShipType.FREIGHTER,
+            datetime_of_arrival=self.form.datetime_of_arrival,
+            datetime_of_departure=self.form.datetime_of_departure,
+            gross_tonnage=1000,
+            **kwargs,
+        )
+
+
+class InvoiceTest(InvoiceTestMixin, TestCase):
     @override_settings(PRISME={**settings.PRISME, "mock": True})
     def test_invoice(self):
         self.form.submit()
@@ -111,6 +146,24 @@ class InvoiceTest(TestCase):
         form = CruiseTaxForm.objects.get(pk=self.form.pk)
         self.assertEqual(form.status, Status.INVOICED)
 
+    @override_settings(PRISME={**settings.PRISME, "mock": True})
+    def test_dispatch_invoices_saves_metrics(self):
+        PrismeClient.instance = None
+        instrumentation.reset()
+        self.form.submit()
+        self.form.save()
+        self.assertEqual(dispatch_invoices().invoiced, 1)
+        # The metrics of each run are added to the saved ones
+        self._create_harbor_dues_form()
+        self.assertEqual(dispatch_invoices().invoiced, 1)
+        metric = StageMetric.objects.get(kind=MetricKind.COUNTER, name="invoiced")
+        self.assertEqual(metric.count, 2)
+        self.assertEqual(str(metric), "counter invoiced")
+        metric = StageMetric.objects.get(kind=MetricKind.SPAN, name="send_invoice")
+        self.assertEqual(metric.count, 2)
+        self.assertGreaterEqual(metric.total_seconds, metric.max_seconds)
+        self.assertEqual(instrumentation.counters, {})
+
     def test_due_date(self):
         self.assertEqual(self.form.invoice_due_date, date.today() + timedelta(days=14))
 
@@ -264,3 +317,333 @@ class InvoiceTest(TestCase):
     def test_custtable_response_none(self):
         response = InvoiceCustomTableResponse(None, None)
         self.assertFalse(hasattr(response, "account_num"))
+
+    @override_settings(PRISME={**settings.PRISME, "mock": False})
+    @patch.object(Prisme, "process_service")
+    def test_dispatch_invoices_attempts_each_form_once(self, mock_process_service):
+        PrismeClient.instance = None
+        mock_process_service.side_effect = PrismeException(
+            250, "Prisme kan bare ikke lide dig i dag", {}
+        )
+        self.form.submit()
+        self.form.save()
+        report = dispatch_invoices(batch_size=1)
+        self.assertEqual((report.forms, report.invoiced, report.failed), (1, 0, 1))
+        mock_process_service.assert_called_once()
+        form = CruiseTaxForm.objects.get(pk=self.form.pk)
+        self.assertEqual(form.status, Status.NEW)
+
+    @override_settings(PRISME={**settings.PRISME, "mock": True})
+    def test_dispatch_batch(self):
+        PrismeClient.instance = None
+        self.form.submit()
+        self.form.save()
+        self.assertEqual(dispatch_batch(10, exclude=[self.form.pk]).forms, 0)
+        claimed = []
+        report = dispatch_batch(10, on_claim=claimed.extend)
+        self.assertEqual(claimed, [self.form.pk])
+        self.assertEqual(report.invoiced, 1)
+        form = CruiseTaxForm.objects.get(pk=self.form.pk)
+        self.assertEqual(form.status, Status.INVOICED)
+
+    @override_settings(PRISME={**settings.PRISME, "mock": True})
+    def test_dispatch_batch_saves_each_form(self):
+        PrismeClient.instance = None
+        self.form.submit()
+        self.form.save()
+        other = self._create_harbor_dues_form()
+        remember = PrismeDebitor.remember
+
+        def fail_second(cvr, *args):
+            # A database error when saving the result of the second invoice
+            if fail_second.calls:
+                with connection.cursor() as cursor:
+                    cursor.execute("SELECT 1/0")
+            fail_second.calls += 1
+            return remember(cvr, *args)
+
+        fail_second.calls = 0
+        with patch.object(PrismeDebitor, "remember", side_effect=fail_second):
+            report = dispatch_batch(10)
+        self.assertEqual((report.forms, report.invoiced), (2, 1))
+        # The first invoice stays sent
+        form = CruiseTaxForm.objects.get(pk=self.form.pk)
+        self.assertEqual(form.status, Status.INVOICED)
+        self.assertIsNone(form.invoice_claimed_at)
+        # The second may have been sent too, so it keeps its claim, and is not
+        # sent again
+        other = HarborDuesForm.objects.get(pk=other.pk)
+        self.assertEqual(other.status, Status.NEW)
+        self.assertIsNotNone(other.invoice_claimed_at)
+        self.assertEqual(dispatch_invoices().forms, 0)
+        # Until the claim is released
+        HarborDuesForm.objects.filter(pk=other.pk).update(invoice_claimed_at=None)
+        self.assertEqual(dispatch_invoices().invoiced, 1)
+
+    @override_settings(PRISME={**settings.PRISME, "mock": False})
+    @patch.object(Prisme, "process_service")
+    def test_failed_invoice_is_retried_with_backoff(self, mock_process_service):
+        PrismeClient.instance = None
+        mock_process_service.side_effect = PrismeException(
+            250, "Prisme kan bare ikke lide dig i dag", {}
+        )
+        self.form.submit()
+        self.form.save()
+        dispatch_invoices()
+        item = InvoiceOutboxItem.objects.get(form=self.form)
+        self.assertEqual(item.attempts, 1)
+        self.assertEqual(str(item), f"{self.form.pk}: 1 attempts")
+        self.assertIn("Prisme kan bare ikke lide dig i dag", item.last_error)
+        self.assertEqual(
+            item.next_attempt_at - item.last_attempt_at,
+            timedelta(seconds=settings.PRISME["retry"]["base_delay"]),
+        )
+        self.assertFalse(item.permanent_failure)
+        # Not due yet
+        self.assertEqual(dispatch_invoices().forms, 0)
+        mock_process_service.assert_called_once()
+        # Due again, and fails again with twice the delay
+        item.retry_now()
+        dispatch_invoices()
+        item = InvoiceOutboxItem.objects.get(form=self.form)
+        self.assertEqual(item.attempts, 2)
+        self.assertEqual(
+            item.next_attempt_at - item.last_attempt_at,
+            timedelta(seconds=2 * settings.PRISME["retry"]["base_delay"]),
+        )
+        # Sent at last
+        mock_process_service.side_effect = None
+        item.retry_now()
+        self.assertEqual(dispatch_invoices().invoiced, 1)
+        self.assertFalse(InvoiceOutboxItem.objects.filter(form=self.form).exists())
+
+    @override_settings(
+        PRISME={
+            **settings.PRISME,
+            "mock": False,
+            "retry": {**settings.PRISME["retry"], "permanent_error_codes": [250]},
+        }
+    )
+    @patch.object(Prisme, "process_service")
+    def test_failed_invoice_permanent_failure(self, mock_process_service):
+        PrismeClient.instance = None
+        mock_process_service.side_effect = PrismeException(
+            250, "Prisme kan bare ikke lide dig i dag", {}
+        )
+        self.form.submit()
+        self.form.save()
+        dispatch_invoices()
+        item = InvoiceOutboxItem.objects.get(form=self.form)
+        self.assertTrue(item.permanent_failure)
+        item.next_attempt_at = item.last_attempt_at
+        item.save()
+        self.assertEqual(dispatch_invoices().forms, 0)
+
+    def test_send_invoice_to_stand_in(self):
+        instrumentation.reset()
+        stand_in = PrismeStandIn(StandInConfig(debitor_missing_rate=1))
+        with PrismeStandInServer(stand_in) as server:
+            PrismeClient.instance = PrismeClient(server.wsdl_url, auth={})
+            try:
+                self.form.submit()
+                self.form.save()
+                self.form.send_invoice()
+            finally:
+                PrismeClient.instance = None
+        form = CruiseTaxForm.objects.get(pk=self.form.pk)
+        self.assertEqual(form.status, Status.INVOICED)
+        self.assertEqual(form.prisme_recid, 1)
+        # Failed for the missing debitor, created it, and tried again
+        self.assertEqual(stand_in.stats.requests, 3)
+        self.assertEqual(stand_in.stats.debitors_created, 1)
+        self.assertEqual(stand_in.invoiced, {str(self.form.pk)})
+        self.assertEqual(
+            PrismeDebitor.objects.get(cvr="12345678").account_num, 12345678
+        )
+        # Each stage is timed
+        self.assertEqual(
+            {name: stats.count for name, stats in instrumentation.spans.items()},
+            {
+                "send_invoice": 1,
+                "receipt_pdf": 1,
+                "pdf_storage": 1,
+                "invoice_lines": 1,
+                "prisme_invoice": 2,
+                "prisme_create_debitor": 1,
+            },
+        )
+        self.assertEqual(
+            instrumentation.counters,
+            {"debitor_created": 1, "invoice_resent": 1, "invoiced": 1},
+        )
+        instrumentation.reset()
+
+    def test_send_invoice_to_stand_in_error(self):
+        stand_in = PrismeStandIn(StandInConfig(error_rate=1, error_code=42))
+        with PrismeStandInServer(stand_in) as server:
+            PrismeClient.instance = PrismeClient(server.wsdl_url, auth={})
+            try:
+                self.form.submit()
+                self.form.save()
+                self.form.send_invoice()
+            finally:
+                PrismeClient.instance = None
+        form = CruiseTaxForm.objects.get(pk=self.form.pk)
+        self.assertEqual(form.status, Status.NEW)
+        self.assertIn("Code: 42", form.invoice_outbox_item.last_error)
+
+    @patch("havneafgifter.clients.prisme_standin.time.sleep")
+    def test_stand_in_latency_and_unknown_method(self, mock_sleep):
+        stand_in = PrismeStandIn(StandInConfig(latency=0.5))
+        self.assertEqual(
+            stand_in.process("unknownMethod", []),
+            (1, "Unknown method unknownMethod", []),
+        )
+        mock_sleep.assert_called_once_with(0.5)
+        self.assertEqual(stand_in.stats.requests, 1)
+
+    def test_prisme_load_test(self):
+        PrismeClient.instance = None
+        template = self._create_harbor_dues_form(shipping_agent=None)
+        stdout = StringIO()
+        call_command(
+            "prisme_load_test",
+            forms=4,
+            debitors=2,
+            debitor_missing_rate=1,
+            template=template.pk,
+            stdout=stdout,
+        )
+        output = stdout.getvalue()
+        self.assertIn("Invoiced 4 of 4 forms (0 failed)", output)
+        self.assertIn("invoices per second", output)
+        self.assertIn("2 debitors created", output)
+        # The copies are deleted again
+        self.assertQuerySetEqual(
+            HarborDuesForm.objects.exclude(pk=self.form.pk), [template]
+        )
+        # The client is restored
+        self.assertIsNone(PrismeClient.instance)
+
+    def test_dispatch_invoices_create_debitors(self):
+        stand_in = PrismeStandIn(StandInConfig(debitor_missing_rate=1))
+        with PrismeStandInServer(stand_in) as server:
+            PrismeClient.instance = PrismeClient(server.wsdl_url, auth={})
+            try:
+                self.form.submit()
+                self.form.save()
+                report = dispatch_invoices(create_debitors=True)
+                # Nothing left to create
+                self.assertEqual(
+                    dispatch_invoices(create_debitors=True).debitors_created, 0
+                )
+            finally:
+                PrismeClient.instance = None
+        self.assertEqual((report.invoiced, report.debitors_created), (1, 1))
+        # The invoice was not rejected for the missing debitor account
+        self.assertEqual(stand_in.stats.requests, 2)
+        self.assertEqual(stand_in.stats.debitors_missing, 0)
+        self.assertEqual(str(PrismeDebitor.objects.get()), "12345678")
+
+    def test_dispatch_invoices_create_debitors_error(self):
+        # Failing to create the debitor account does not stop the invoices
+        stand_in = PrismeStandIn(StandInConfig(error_rate=1))
+        with PrismeStandInServer(stand_in) as server:
+            PrismeClient.instance = PrismeClient(server.wsdl_url, auth={})
+            try:
+                self.form.submit()
+                self.form.save()
+                report = dispatch_invoices(create_debitors=True)
+            finally:
+                PrismeClient.instance = None
+        self.assertEqual((report.forms, report.debitors_created), (1, 0))
+        self.assertEqual(stand_in.stats.requests, 2)
+        self.assertFalse(PrismeDebitor.objects.exists())
+
+    def test_create_debitor(self):
+        stand_in = PrismeStandIn()
+        with PrismeStandInServer(stand_in) as server:
+            PrismeClient.instance = PrismeClient(server.wsdl_url, auth={})
+            try:
+                # The CVR number of the form by default
+                debitor = self.form.create_debitor()
+            finally:
+                PrismeClient.instance = None
+        self.assertEqual((debitor.cvr, debitor.account_num), ("12345678", 12345678))
+        self.assertEqual(stand_in.debitors, {"12345678": True})
+        form = self._create_harbor_dues_form(shipping_agent=None)
+        with self.assertRaisesMessage(ValueError, "Form has no CVR number"):
+            form.create_debitor()
+
+    def test_prisme_client_wsdl_cache(self):
+        with TemporaryDirectory() as directory, PrismeStandInServer() as server:
+            wsdl_cache = {"path": os.path.join(directory, "wsdl.sqlite"), "timeout": 60}
+            client = PrismeClient(
+                server.wsdl_url, auth={}, wsdl_cache=wsdl_cache, pool_size=4
+            )
+            self.assertIsNone(client.startup_time)
+            self.assertIsNotNone(client.warm_up())
+            self.assertFalse(client.wsdl_cached)
+            self.assertEqual(
+                client.client.transport.session.get_adapter(server.url)._pool_maxsize,
+                4,
+            )
+            # A new client (e.g. in the next process) uses the cached WSDL
+            client = PrismeClient(server.wsdl_url, auth={}, wsdl_cache=wsdl_cache)
+            client.warm_up()
+            self.assertTrue(client.wsdl_cached)
+            self.assertEqual(
+                client.client.get_type("tns:GWSRequestXMLDCFUJ").name,
+                "GWSRequestXMLDCFUJ",
+            )
+
+    def test_prisme_client_session(self):
+        client = PrismeClient(
+            "http://prisme.example/wsdl",
+            auth={"basic": {"username": "user", "domain": "ad", "password": "secret"}},
+            proxy={"socks": "proxy.example:1080"},
+        )
+        session = client.create_session()
+        self.assertEqual(
+            session.proxies,
+            {
+                "http": "socks5://proxy.example:1080",
+                "https": "socks5://proxy.example:1080",
+            },
+        )
+        self.assertEqual(session.auth, ("user@ad", "secret"))
+        # No proxy unless a socks proxy is configured
+        client = PrismeClient("http://prisme.example/wsdl", auth={}, proxy={})
+        self.assertEqual(client.create_session().proxies, {})
+
+    @override_settings(PRISME={**settings.PRISME, "mock": False, "wsdl": ""})
+    def test_send_invoices_warm_up_failure(self):
+        # Failing to construct the client does not stop the command, and the
+        # form is kept for the next attempt
+        PrismeClient.instance = None
+        self.form.submit()
+        self.form.save()
+        stdout = StringIO()
+        call_command("send_invoices", verbosity=2, stdout=stdout)
+        PrismeClient.instance = None
+        self.assertNotIn("Prisme client ready", stdout.getvalue())
+        self.assertIn("Invoiced 0 of 1 forms (1 failed)", stdout.getvalue())
+        self.assertTrue(InvoiceOutboxItem.objects.filter(form=self.form).exists())
+
+
+class InvoiceThreadsTest(InvoiceTestMixin, CommittedDataTestMixin, TransactionTestCase):
+    @override_settings(PRISME={**settings.PRISME, "mock": True})
+    def test_dispatch_invoices_in_threads(self):
+        PrismeClient.instance = None
+        self.form.submit()
+        self.form.save()
+        other = self._create_harbor_dues_form()
+        report = dispatch_invoices(batch_size=1, threads=2)
+        self.assertEqual((report.forms, report.invoiced), (2, 2))
+        self.assertQuerySetEqual(
+            HarborDuesForm.objects.filter(
+                status=Status.INVOICED, invoice_claimed_at=None
+            ).order_by("pk"),
+            [self.form.pk, other.pk],
+            transform=lambda form: form.pk,
+        )
@@ -0,0 +1,220 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime, timedelta, timezone
+from unittest.mock import patch
+
+from django.conf import settings
+from django.contrib.messages import get_messages
+from django.core import mail
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.urls import reverse
+
+from havneafgifter import mail_jobs
+from havneafgifter.mail_jobs import (
+    claim_jobs,
+    enqueue_mail,
+    get_mail_class,
+    keep_alive,
+    requeue_lost_jobs,
+    run_mail_job,
+    run_worker,
+)
+from havneafgifter.mails import OnSubmitForReviewReceipt
+from havneafgifter.models import MailJob, MailJobStatus
+from havneafgifter.tests.mixins import CommittedDataTestMixin, HarborDuesFormTestMixin
+
+
+class MailJobTestMixin(HarborDuesFormTestMixin):
+    def _enqueue(self) -> MailJob:
+        return enqueue_mail(
+            OnSubmitForReviewReceipt,
+            self.harbor_dues_form,
+            self.shipping_agent_user,
+        )
+
+
+@patch("havneafgifter.mails.save_receipt_pdf")
+@patch("havneafgifter.mails.get_receipt_pdf", return_value=b"%PDF")
+class TestMailJobs(MailJobTestMixin, TestCase):
+
+    def test_run(self, mock_get_receipt_pdf, mock_save_receipt_pdf):
+        job = self._enqueue()
+        self.assertEqual(job.status, MailJobStatus.PENDING)
+        self.assertEqual(job.mail_class, "OnSubmitForReviewReceipt")
+        self.assertEqual(claim_jobs(10), [job.pk])
+        # Claimed jobs are not claimed again
+        self.assertEqual(claim_jobs(10), [])
+        job = MailJob.objects.get(pk=job.pk)
+        self.assertEqual(job.status, MailJobStatus.RUNNING)
+        self.assertEqual(job.attempts, 1)
+
+        self.assertEqual(run_mail_job(job.pk), MailJobStatus.SUCCEEDED)
+        job = MailJob.objects.get(pk=job.pk)
+        self.assertEqual(job.message, "An email receipt was successfully sent.")
+        self.assertIsNotNone(job.finished)
+        self.assertEqual(len(mail.outbox), 1)
+        mock_save_receipt_pdf.assert_called_once()
+        self.assertEqual(
+            str(job), f"OnSubmitForReviewReceipt for {job.form_id}: succeeded"
+        )
+
+    @patch("havneafgifter.mails.EmailMessage.send", return_value=0)
+    def test_run_not_sent(self, mock_send, mock_get_receipt_pdf, mock_save_receipt_pdf):
+        job = self._enqueue()
+        claim_jobs(10)
+        self.assertEqual(run_mail_job(job.pk), MailJobStatus.FAILED)
+        job = MailJob.objects.get(pk=job.pk)
+        self.assertEqual(job.message, "Error when sending email")
+
+    @override_settings(MAIL_JOBS={**settings.MAIL_JOBS, "max_attempts": 2})
+    def test_run_error(self, mock_get_receipt_pdf, mock_save_receipt_pdf):
+        mock_get_receipt_pdf.side_effect = ValueError("Rendering failed")
+        job = self._enqueue()
+        claim_jobs(10)
+        # Failing jobs are retried after a delay ...
+        self.assertEqual(run_mail_job(job.pk), MailJobStatus.PENDING)
+        job = MailJob.objects.get(pk=job.pk)
+        self.assertEqual(job.error, "Rendering failed")
+        self.assertIsNone(job.message)
+        self.assertEqual(
+            job.next_attempt_at - job.finished,
+            timedelta(seconds=settings.MAIL_JOBS["retry_delay"]),
+        )
+        self.assertEqual(claim_jobs(10), [])
+        MailJob.objects.filter(pk=job.pk).update(next_attempt_at=job.finished)
+        # ... until they have been attempted `max_attempts` times
+        self.assertEqual(claim_jobs(10), [job.pk])
+        self.assertEqual(run_mail_job(job.pk), MailJobStatus.FAILED)
+        job = MailJob.objects.get(pk=job.pk)
+        self.assertEqual(job.message, "Error when sending email")
+        self.assertEqual(len(mail.outbox), 0)
+
+    @override_settings(MAIL_JOBS={**settings.MAIL_JOBS, "max_attempts": 2})
+    def test_requeue_lost_jobs(self, mock_get_receipt_pdf, mock_save_receipt_pdf):
+        job = self._enqueue()
+        claim_jobs(10)
+        self.assertEqual(requeue_lost_jobs(60), 0)
+        long_ago = datetime.now(timezone.utc) - timedelta(minutes=2)
+        MailJob.objects.filter(pk=job.pk).update(started=long_ago, heartbeat=long_ago)
+        # A job with a recent heartbeat is not lost, however long it runs
+        self.assertEqual(keep_alive([job.pk]), 1)
+        self.assertEqual(requeue_lost_jobs(60), 0)
+        MailJob.objects.filter(pk=job.pk).update(heartbeat=long_ago)
+        self.assertEqual(requeue_lost_jobs(60), 1)
+        self.assertEqual(MailJob.objects.get(pk=job.pk).status, MailJobStatus.PENDING)
+        claim_jobs(10)
+        # Jobs claimed before heartbeats were recorded
+        MailJob.objects.filter(pk=job.pk).update(started=long_ago, heartbeat=None)
+        self.assertEqual(requeue_lost_jobs(60), 1)
+        self.assertEqual(MailJob.objects.get(pk=job.pk).status, MailJobStatus.FAILED)
+
+    def test_get_mail_class(self, mock_get_receipt_pdf, mock_save_receipt_pdf):
+        self.assertIs(
+            get_mail_class("OnSubmitForReviewReceipt"), OnSubmitForReviewReceipt
+        )
+        with self.assertRaises(ValueError):
+            get_mail_class("EmailMessage")
+
+    def test_messages(self, mock_get_receipt_pdf, mock_save_receipt_pdf):
+        job = self._enqueue()
+        url = reverse(
+            "havneafgifter:receipt_detail_html",
+            kwargs={"pk": self.harbor_dues_form.pk},
+        )
+        self.client.force_login(self.shipping_agent_user)
+        # While the job is pending
+        response = self.client.get(url)
+        self.assertEqual(
+            [str(message) for message in get_messages(response.wsgi_request)],
+            ["The email is being sent."],
+        )
+        # When the job is done, its outcome is shown once
+        claim_jobs(10)
+        run_mail_job(job.pk)
+        response = self.client.get(url)
+        self.assertEqual(
+            [str(message) for message in get_messages(response.wsgi_request)],
+            ["An email receipt was successfully sent."],
+        )
+        response = self.client.get(url)
+        self.assertEqual(list(get_messages(response.wsgi_request)), [])
+
+
+@patch("havneafgifter.mails.save_receipt_pdf")
+@patch("havneafgifter.mails.get_receipt_pdf", return_value=b"%PDF")
+class TestMailWorker(MailJobTestMixin, CommittedDataTestMixin, TransactionTestCase):
+    def test_run_worker(self, mock_get_receipt_pdf, mock_save_receipt_pdf):
+        job = self._enqueue()
+        self.assertEqual(run_worker(2, poll_interval=0.01, timeout=600, once=True), 1)
+        # The job was run (and its outcome saved) by a worker process
+        job = MailJob.objects.get(pk=job.pk)
+        self.assertEqual(job.attempts, 1)
+        self.assertNotEqual(job.status, MailJobStatus.RUNNING)
+        self.assertIsNotNone(job.finished)
+
+    @patch.object(mail_jobs, "process_pool", side_effect=ThreadPoolExecutor)
+    def test_run_worker_crash(
+        self, mock_process_pool, mock_get_receipt_pdf, mock_save_receipt_pdf
+    ):
+        job = self._enqueue()
+        run_in_process = mail_jobs._run_in_process
+        crashed = []
+
+        def crash_once(pk):
+            if not crashed:
+                crashed.append(pk)
+                raise BrokenProcessPool("Worker crashed")
+            return run_in_process(pk)
+
+        with patch.object(mail_jobs, "_run_in_process", side_effect=crash_once):
+            count = run_worker(1, poll_interval=0.01, timeout=600, once=True)
+        # The job is run again, by a new pool
+        self.assertEqual(count, 2)
+        self.assertEqual(mock_process_pool.call_count, 2)
+        job = MailJob.objects.get(pk=job.pk)
+        self.assertEqual(job.status, MailJobStatus.SUCCEEDED)
+        self.assertEqual(job.attempts, 2)
+        self.assertEqual(len(mail.outbox), 1)
+
+    @patch.object(mail_jobs, "process_pool", side_effect=ThreadPoolExecutor)
+    def test_run_worker_keeps_slow_jobs(
+        self, mock_process_pool, mock_get_receipt_pdf, mock_save_receipt_pdf
+    ):
+        job = self._enqueue()
+        run_in_process = mail_jobs._run_in_process
+        checked = threading.Event()
+        requeued = []
+
+        def check(timeout):
+            requeued.append(requeue_lost_jobs(timeout))
+            checked.set()
+            return requeued[-1]
+
+        def slow(pk):
+            # The job runs for longer than the timeout while the worker looks
+            # for lost jobs
+            checked.clear()
+            long_ago = datetime.now(timezone.utc) - timedelta(minutes=2)
+            MailJob.objects.filter(pk=pk).update(started=long_ago, heartbeat=long_ago)
+            self.assertTrue(checked.wait(5))
+            return run_in_process(pk)
+
+        with patch.object(mail_jobs, "_run_in_process", side_effect=slow):
+            with patch.object(mail_jobs, "requeue_lost_jobs", side_effect=check):
+                count = run_worker(2, poll_interval=0.01, timeout=60, once=True)
+        # The job is not run again, as it is still running in this worker
+        self.assertEqual(sum(requeued), 0)
+        self.assertEqual(count, 1)
+        job = MailJob.objects.get(pk=job.pk)
+        self.assertEqual(job.status, MailJobStatus.SUCCEEDED)
+        self.assertEqual(job.attempts, 1)
+        self.assertEqual(len(mail.outbox), 1)
+
+    def test_run_worker_polls(self, mock_get_receipt_pdf, mock_save_receipt_pdf):
+        with patch.object(
+            mail_jobs.time, "sleep", side_effect=[None, KeyboardInterrupt]
+        ) as mock_sleep:
+            with self.assertRaises(KeyboardInterrupt):
+                run_worker(1, poll_interval=0.01, timeout=600)
+        self.assertEqual(mock_sleep.call_count, 2)
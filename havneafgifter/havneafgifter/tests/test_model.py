@@ -5,13 +5,17 @@ from unittest.mock import patch
 from django.contrib.auth.models import Group
 from django.core.exceptions import ValidationError
 from django.core.management import call_command
-from django.db import IntegrityError
+from django.db import IntegrityError, connection, transaction
 from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from unittest_parametrize import ParametrizedTestCase, parametrize
 
+from havneafgifter.calculation import calculate_taxes
 from havneafgifter.models import (
     CruiseTaxForm,
+    Disembarkment,
     DisembarkmentSite,
+    DisembarkmentTaxRate,
     HarborDuesForm,
     Municipality,
     Port,
@@ -20,6 +24,7 @@ from havneafgifter.models import (
     ShippingAgent,
     ShipType,
     Status,
+    TariffVersion,
     TaxRates,
     User,
     UserType,
@@ -27,6 +32,7 @@ from havneafgifter.models import (
     imo_validator_bool,
 )
 from havneafgifter.receipts import CruiseTaxFormReceipt, HarborDuesFormReceipt
+from havneafgifter.tariffs import get_tariff_index
 from havneafgifter.tests.mixins import HarborDuesFormTestMixin
 
 
@@ -179,6 +185,69 @@ class ModelTest(ParametrizedTestCase, HarborDuesFormTestMixin, TestCase):
         instance.vessel_type = vessel_type
         self.assertEqual(instance.tax_per_gross_ton, expected_tax_per_gross_ton)
 
+    def test_tax_result_is_shared(self):
+        instance = CruiseTaxForm.objects.get(pk=self.cruise_tax_form.pk)
+        with patch(
+            "havneafgifter.calculation.calculate_taxes",
+            wraps=calculate_taxes,
+        ) as mock_calculate_taxes:
+            instance.calculate_tax(save=False)
+            instance.tax_per_gross_ton
+            instance.invoice_lines
+            instance.get_receipt().get_context_data()
+        mock_calculate_taxes.assert_called_once()
+
+    def test_tax_result_follows_input_fields(self):
+        instance = HarborDuesForm.objects.get(pk=self.harbor_dues_form.pk)
+        result = instance.get_tax_result()
+        self.assertIs(instance.get_tax_result(), result)
+        instance.gross_tonnage += 1
+        self.assertIsNot(instance.get_tax_result(), result)
+        self.assertGreater(instance.get_tax_result().harbour_tax, result.harbour_tax)
+        # Recalculation can also be forced
+        result = instance.get_tax_result()
+        self.assertIsNot(instance.get_tax_result(refresh=True), result)
+
+    def test_tax_result_follows_disembarkments_and_tariffs(self):
+        instance = CruiseTaxForm.objects.get(pk=self.cruise_tax_form.pk)
+        result = instance.get_tax_result()
+        disembarkment = Disembarkment.objects.create(
+            cruise_tax_form=instance,
+            number_of_passengers=10,
+            disembarkment_site=DisembarkmentSite.objects.first(),
+        )
+        self.assertIsNot(instance.get_tax_result(), result)
+        result = instance.get_tax_result()
+        self.assertIn(
+            disembarkment.get_tax_input(),
+            [line.disembarkment for line in result.disembarkment_tax_lines],
+        )
+        self.assertIs(instance.get_tax_result(), result)
+        Disembarkment.objects.filter(pk=disembarkment.pk).update(
+            number_of_passengers=20
+        )
+        self.assertIsNot(instance.get_tax_result(), result)
+        result = instance.get_tax_result()
+        TariffVersion.bump()
+        self.assertIsNot(instance.get_tax_result(), result)
+
+    def test_calculate_tax_if_changed(self):
+        instance = CruiseTaxForm.objects.get(pk=self.cruise_tax_form.pk)
+        self.assertTrue(instance.calculate_tax_if_changed())
+        self.assertFalse(instance.calculate_tax_if_changed())
+        # Disembarkments saved elsewhere are noticed by the same instance
+        Disembarkment.objects.create(
+            cruise_tax_form_id=instance.pk,
+            number_of_passengers=10,
+            disembarkment_site=DisembarkmentSite.objects.first(),
+        )
+        self.assertTrue(instance.calculate_tax_if_changed())
+        self.assertEqual(
+            CruiseTaxForm.objects.get(pk=instance.pk).tax_fingerprint,
+            instance.get_tax_fingerprint(),
+        )
+        self.assertFalse(instance.calculate_tax_if_changed())
+
 
 class TestUser(ParametrizedTestCase, HarborDuesFormTestMixin, TestCase):
     @classmethod
@@ -713,7 +782,8 @@ class TestHarborDuesForm(ParametrizedTestCase, HarborDuesFormTestMixin, TestCase
         with patch.object(
             HarborDuesForm, "check_cvr", wraps=HarborDuesForm.check_cvr
         ) as mock_check_cvr:
-            self.ship_user.save()
+            with self.captureOnCommitCallbacks(execute=True):
+                self.ship_user.save()
             mock_check_cvr.assert_called()
         form = HarborDuesForm.objects.get(pk=form.pk)
         self.assertEqual(form.status, Status.MISSING_CVR)
@@ -723,7 +793,8 @@ class TestHarborDuesForm(ParametrizedTestCase, HarborDuesFormTestMixin, TestCase
         with patch.object(
             HarborDuesForm, "check_cvr", wraps=HarborDuesForm.check_cvr
         ) as mock_check_cvr:
-            self.ship_user.save()
+            with self.captureOnCommitCallbacks(execute=True):
+                self.ship_user.save()
             mock_check_cvr.assert_called()
         form = HarborDuesForm.objects.get(pk=form.pk)
         self.assertEqual(form.status, Status.NEW)
@@ -740,8 +811,9 @@ class TestHarborDuesForm(ParametrizedTestCase, HarborDuesFormTestMixin, TestCase
         with patch.object(
             HarborDuesForm, "check_cvr", wraps=HarborDuesForm.check_cvr
         ) as mock_check_cvr:
-            self.ship_user.delete()
-            self.assertFalse(User.objects.filter(pk=user_pk).exists())
+            with self.captureOnCommitCallbacks(execute=True):
+                self.ship_user.delete()
+                self.assertFalse(User.objects.filter(pk=user_pk).exists())
             mock_check_cvr.assert_called()
         form = HarborDuesForm.objects.get(pk=form.pk)
         self.assertEqual(form.status, Status.MISSING_CVR)
@@ -750,10 +822,11 @@ class TestHarborDuesForm(ParametrizedTestCase, HarborDuesFormTestMixin, TestCase
         with patch.object(
             HarborDuesForm, "check_cvr", wraps=HarborDuesForm.check_cvr
         ) as mock_check_cvr:
-            self.ship_user = User.objects.create(
-                username=user_username, organization="Mary", cvr="12345678"
-            )
-            self.ship_user.groups.add(Group.objects.get(name="Ship"))
+            with self.captureOnCommitCallbacks(execute=True):
+                self.ship_user = User.objects.create(
+                    username=user_username, organization="Mary", cvr="12345678"
+                )
+                self.ship_user.groups.add(Group.objects.get(name="Ship"))
             mock_check_cvr.assert_called()
         form = HarborDuesForm.objects.get(pk=form.pk)
         self.assertEqual(form.status, Status.NEW)
@@ -769,7 +842,8 @@ class TestHarborDuesForm(ParametrizedTestCase, HarborDuesFormTestMixin, TestCase
         with patch.object(
             HarborDuesForm, "check_cvr", wraps=HarborDuesForm.check_cvr
         ) as mock_check_cvr:
-            self.ship_user.groups.remove(ship_group)
+            with self.captureOnCommitCallbacks(execute=True):
+                self.ship_user.groups.remove(ship_group)
             mock_check_cvr.assert_called()
         form = HarborDuesForm.objects.get(pk=form.pk)
         self.assertEqual(form.status, Status.MISSING_CVR)
@@ -778,7 +852,8 @@ class TestHarborDuesForm(ParametrizedTestCase, HarborDuesFormTestMixin, TestCase
         with patch.object(
             HarborDuesForm, "check_cvr", wraps=HarborDuesForm.check_cvr
         ) as mock_check_cvr:
-            self.ship_user.groups.add(ship_group)
+            with self.captureOnCommitCallbacks(execute=True):
+                self.ship_user.groups.add(ship_group)
             mock_check_cvr.assert_called()
         form = HarborDuesForm.objects.get(pk=form.pk)
         self.assertEqual(form.status, Status.NEW)
@@ -787,18 +862,20 @@ class TestHarborDuesForm(ParametrizedTestCase, HarborDuesFormTestMixin, TestCase
         form = HarborDuesForm.objects.create(
             **{**self.harbor_dues_form_data, "gross_tonnage": 20000}
         )
-        self.shipping_agent.cvr = "12345678"
-        self.shipping_agent.save()
-        self.ship_user.cvr = None
-        self.ship_user.save()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.shipping_agent.cvr = "12345678"
+            self.shipping_agent.save()
+            self.ship_user.cvr = None
+            self.ship_user.save()
         self.assertEqual(form.status, Status.NEW)
 
         # Remove shipping agent cvr so ship doesn't find it
         with patch.object(
             HarborDuesForm, "check_cvr", wraps=HarborDuesForm.check_cvr
         ) as mock_check_cvr:
-            self.shipping_agent.cvr = None
-            self.shipping_agent.save()
+            with self.captureOnCommitCallbacks(execute=True):
+                self.shipping_agent.cvr = None
+                self.shipping_agent.save()
             mock_check_cvr.assert_called()
         form = HarborDuesForm.objects.get(pk=form.pk)
         self.assertEqual(form.status, Status.MISSING_CVR)
@@ -807,8 +884,9 @@ class TestHarborDuesForm(ParametrizedTestCase, HarborDuesFormTestMixin, TestCase
         with patch.object(
             HarborDuesForm, "check_cvr", wraps=HarborDuesForm.check_cvr
         ) as mock_check_cvr:
-            self.shipping_agent.cvr = "12345678"
-            self.shipping_agent.save()
+            with self.captureOnCommitCallbacks(execute=True):
+                self.shipping_agent.cvr = "12345678"
+                self.shipping_agent.save()
             mock_check_cvr.assert_called()
         form = HarborDuesForm.objects.get(pk=form.pk)
         self.assertEqual(form.status, Status.NEW)
@@ -817,10 +895,11 @@ class TestHarborDuesForm(ParametrizedTestCase, HarborDuesFormTestMixin, TestCase
         form = HarborDuesForm.objects.create(
             **{**self.harbor_dues_form_data, "gross_tonnage": 20000}
         )
-        self.shipping_agent.cvr = "12345678"
-        self.shipping_agent.save()
-        self.ship_user.cvr = None
-        self.ship_user.save()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.shipping_agent.cvr = "12345678"
+            self.shipping_agent.save()
+            self.ship_user.cvr = None
+            self.ship_user.save()
         self.assertEqual(form.status, Status.NEW)
 
         # Delete shipping agent so we can't find him by IMO
@@ -828,10 +907,11 @@ class TestHarborDuesForm(ParametrizedTestCase, HarborDuesFormTestMixin, TestCase
         with patch.object(
             HarborDuesForm, "check_cvr", wraps=HarborDuesForm.check_cvr
         ) as mock_check_cvr:
-            self.shipping_agent.delete()
-            self.assertFalse(
-                ShippingAgent.objects.filter(pk=shipping_agent_pk).exists()
-            )
+            with self.captureOnCommitCallbacks(execute=True):
+                self.shipping_agent.delete()
+                self.assertFalse(
+                    ShippingAgent.objects.filter(pk=shipping_agent_pk).exists()
+                )
             mock_check_cvr.assert_called()
         form = HarborDuesForm.objects.get(pk=form.pk)
         self.assertEqual(form.status, Status.MISSING_CVR)
@@ -840,15 +920,123 @@ class TestHarborDuesForm(ParametrizedTestCase, HarborDuesFormTestMixin, TestCase
         with patch.object(
             HarborDuesForm, "check_cvr", wraps=HarborDuesForm.check_cvr
         ) as mock_check_cvr:
-            self.shipping_agent = ShippingAgent.objects.create(
-                name="Agent", email="shipping@example.org", cvr="12345678"
-            )
-            form.shipping_agent = self.shipping_agent
-            form.save()
+            with self.captureOnCommitCallbacks(execute=True):
+                self.shipping_agent = ShippingAgent.objects.create(
+                    name="Agent", email="shipping@example.org", cvr="12345678"
+                )
+                form.shipping_agent = self.shipping_agent
+                form.save()
             mock_check_cvr.assert_called()
         form = HarborDuesForm.objects.get(pk=form.pk)
         self.assertEqual(form.status, Status.NEW)
 
+    def test_check_cvr_only_affects_matching_forms(self):
+        # A NEW form without a CVR, which is not related to the ship user
+        other_form = HarborDuesForm.objects.create(
+            **{**self.harbor_dues_form_data, "vessel_imo": "1234567"}
+        )
+        HarborDuesForm.objects.filter(pk=other_form.pk).update(status=Status.NEW)
+
+        # Remove the CVR of the ship user
+        with self.captureOnCommitCallbacks(execute=True):
+            self.ship_user.cvr = None
+            self.ship_user.save()
+        for form in (
+            HarborDuesForm.objects.get(pk=self.harbor_dues_form.pk),
+            CruiseTaxForm.objects.get(pk=self.cruise_tax_form.pk),
+        ):
+            with self.subTest(form=form):
+                self.assertEqual(form.status, Status.MISSING_CVR)
+                self.assertEqual(
+                    form.history.first().history_change_reason,
+                    Status.MISSING_CVR.label,
+                )
+        other_form = HarborDuesForm.objects.get(pk=other_form.pk)
+        self.assertEqual(other_form.status, Status.NEW)
+
+    def test_changed_fields_are_tracked_in_memory(self):
+        form = HarborDuesForm.objects.get(pk=self.harbor_dues_form.pk)
+        with self.assertNumQueries(0):
+            self.assertEqual(form.get_changed_fields(), set())
+            form.vessel_imo = "1234567"
+            self.assertEqual(form.get_changed_fields(), {"vessel_imo"})
+            self.assertEqual(form.get_changed_fields(["vessel_name"]), set())
+        form.save(update_fields=["vessel_imo"])
+        self.assertEqual(form.get_changed_fields(), set())
+        # Fields not saved remain changed
+        form.shipping_agent = None
+        form.save(update_fields=["vessel_name"])
+        self.assertEqual(form.get_changed_fields(), {"shipping_agent"})
+
+    def test_changed_fields_skip_deferred_fields(self):
+        form = HarborDuesForm.objects.only("pk", "vessel_name").get(
+            pk=self.harbor_dues_form.pk
+        )
+        with self.assertNumQueries(0):
+            self.assertEqual(form.get_changed_fields(), set())
+            self.assertIsNone(form.get_saved_value("vessel_imo"))
+        form.vessel_imo = "1234567"
+        self.assertEqual(form.get_changed_fields(), {"vessel_imo"})
+
+    def test_check_cvr_is_deferred_and_coalesced(self):
+        ship_group = Group.objects.get(name="Ship")
+        with patch.object(
+            HarborDuesForm, "check_cvr", wraps=HarborDuesForm.check_cvr
+        ) as mock_check_cvr:
+            with self.captureOnCommitCallbacks(execute=True):
+                self.ship_user.cvr = None
+                self.ship_user.save()
+                self.ship_user.groups.remove(ship_group)
+                self.ship_user.groups.add(ship_group)
+                self.shipping_agent.cvr = 12345678
+                self.shipping_agent.save()
+                mock_check_cvr.assert_not_called()
+            # One check of all affected forms, when the transaction commits
+            mock_check_cvr.assert_called_once_with(
+                vessel_imos={self.ship_user.username},
+                shipping_agent_ids={self.shipping_agent.pk},
+                pks=set(),
+            )
+        form = HarborDuesForm.objects.get(pk=self.harbor_dues_form.pk)
+        self.assertEqual(form.status, Status.NEW)
+
+    def test_check_cvr_is_coalesced_across_savepoints(self):
+        with patch.object(
+            HarborDuesForm, "check_cvr", wraps=HarborDuesForm.check_cvr
+        ) as mock_check_cvr:
+            with self.captureOnCommitCallbacks(execute=True):
+                # E.g. an import saving each row in a savepoint of its own
+                with transaction.atomic():
+                    self.ship_user.cvr = None
+                    self.ship_user.save()
+                with transaction.atomic():
+                    self.shipping_agent.cvr = 12345678
+                    self.shipping_agent.save()
+            mock_check_cvr.assert_called_once_with(
+                vessel_imos={self.ship_user.username},
+                shipping_agent_ids={self.shipping_agent.pk},
+                pks=set(),
+            )
+
+    def test_check_cvr_is_discarded_on_rollback(self):
+        with patch.object(
+            HarborDuesForm, "check_cvr", wraps=HarborDuesForm.check_cvr
+        ) as mock_check_cvr:
+            with self.captureOnCommitCallbacks(execute=True):
+                with self.assertRaises(ValueError):
+                    with transaction.atomic():
+                        self.ship_user.cvr = None
+                        self.ship_user.save()
+                        raise ValueError()
+                with transaction.atomic():
+                    self.shipping_agent.cvr = 12345678
+                    self.shipping_agent.save()
+            mock_check_cvr.assert_called_once_with(
+                vessel_imos=set(),
+                shipping_agent_ids={self.shipping_agent.pk},
+                pks=set(),
+            )
+
 
 class TestCruiseTaxForm(HarborDuesFormTestMixin, TestCase):
     def test_has_port_of_call(self):
@@ -861,6 +1049,42 @@ class TestCruiseTaxForm(HarborDuesFormTestMixin, TestCase):
         self.assertIsNotNone(self.cruise_tax_form.pax_tax)
         self.assertIsNotNone(self.cruise_tax_form.disembarkment_tax)
 
+    def test_calculate_tax_queries_do_not_depend_on_disembarkments(self):
+        tax_rates = TaxRates.objects.create(pax_tax_rate=Decimal("10"))
+        sites = list(DisembarkmentSite.objects.all()[:10])
+        DisembarkmentTaxRate.objects.create(
+            tax_rates=tax_rates,
+            municipality=sites[0].municipality,
+            disembarkment_tax_rate=Decimal("3"),
+        )
+        get_tariff_index()
+
+        def count_queries():
+            instance = CruiseTaxForm.objects.get(pk=self.cruise_tax_form.pk)
+            with CaptureQueriesContext(connection) as context:
+                instance.calculate_tax(save=True, force_recalculation=True)
+            return len(context)
+
+        Disembarkment.objects.create(
+            cruise_tax_form=self.cruise_tax_form,
+            disembarkment_site=sites[0],
+            number_of_passengers=10,
+        )
+        queries = count_queries()
+        for site in sites[1:]:
+            Disembarkment.objects.create(
+                cruise_tax_form=self.cruise_tax_form,
+                disembarkment_site=site,
+                number_of_passengers=10,
+            )
+        self.assertEqual(count_queries(), queries)
+        self.assertEqual(
+            Disembarkment.objects.get(
+                cruise_tax_form=self.cruise_tax_form, disembarkment_site=sites[0]
+            ).disembarkment_tax,
+            Decimal("30"),
+        )
+
     def test_total_tax(self):
         # We go through the HDF pointer to verify the longer chain of logic
         self.assertEqual(self.cruise_tax_form.harborduesform_ptr.total_tax, 0)
@@ -946,3 +1170,35 @@ class TestTaxRates(TestCase):
 
         self.assertTrue(new_good_tax_rate.is_within_editing_deadline())
         self.assertFalse(new_bad_tax_rate.is_within_editing_deadline())
+
+    def test_end_datetimes_follow_start_datetimes(self):
+        def utc(*args):
+            return datetime(*args, tzinfo=timezone.utc)
+
+        first = TaxRates.objects.create(start_datetime=None)
+        last = TaxRates.objects.create(start_datetime=utc(2025, 3, 1))
+        save = patch.object(TaxRates, "save", autospec=True, wraps=TaxRates.save)
+        with save as mock_save:
+            middle = TaxRates.objects.create(start_datetime=utc(2025, 2, 1))
+            # The other tax rates are updated without being saved
+            mock_save.assert_called_once()
+        self.assertEqual(
+            list(TaxRates.objects.values_list("pk", "end_datetime")),
+            [
+                (first.pk, utc(2025, 2, 1)),
+                (middle.pk, utc(2025, 3, 1)),
+                (last.pk, None),
+            ],
+        )
+        # Moving a tax rate moves the end of the previous one
+        middle.start_datetime = utc(2025, 1, 1)
+        middle.save()
+        self.assertEqual(
+            list(TaxRates.objects.values_list("pk", "end_datetime")),
+            [
+                (first.pk, utc(2025, 1, 1)),
+                (middle.pk, utc(2025, 3, 1)),
+                (last.pk, None),
+            ],
+        )
+        self.assertEqual(TaxRates.update_end_datetimes(), 0)
@@ -0,0 +1,146 @@
+from datetime import date
+from decimal import Decimal
+from io import StringIO
+
+from django.core.management import call_command
+from django.test import TestCase, TransactionTestCase
+
+from havneafgifter.models import (
+    CruiseTaxForm,
+    Disembarkment,
+    DisembarkmentSite,
+    DisembarkmentTaxRate,
+    HarborDuesForm,
+    PortTaxRate,
+    Status,
+    TaxRates,
+)
+from havneafgifter.recalculation import recalculate_taxes
+from havneafgifter.tests.mixins import CommittedDataTestMixin, HarborDuesFormTestMixin
+
+
+class RecalculationTestMixin(HarborDuesFormTestMixin):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        tax_rates = TaxRates.objects.create(pax_tax_rate=Decimal("10"))
+        PortTaxRate.objects.create(
+            tax_rates=tax_rates,
+            gt_start=0,
+            port_tax_rate=Decimal("0.5"),
+            round_gross_ton_up_to=100,
+        )
+        cls.disembarkment_site = DisembarkmentSite.objects.first()
+        DisembarkmentTaxRate.objects.create(
+            tax_rates=tax_rates,
+            municipality=cls.disembarkment_site.municipality,
+            disembarkment_tax_rate=Decimal("3"),
+        )
+        cls.cruise_tax_form.number_of_passengers = 20
+        cls.cruise_tax_form.save()
+        cls.disembarkment = Disembarkment.objects.create(
+            cruise_tax_form=cls.cruise_tax_form,
+            number_of_passengers=15,
+            disembarkment_site=cls.disembarkment_site,
+        )
+
+    def _stored_taxes(self):
+        return {
+            form.pk: (form.harbour_tax, form.pax_tax, form.disembarkment_tax)
+            for form in CruiseTaxForm.objects.all()
+        } | {
+            form.pk: (form.harbour_tax,)
+            for form in HarborDuesForm.objects.filter(cruisetaxform__isnull=True)
+        }
+
+
+class RecalculationTest(RecalculationTestMixin, TestCase):
+    def test_dry_run_does_not_save(self):
+        before = self._stored_taxes()
+        report = recalculate_taxes(dry_run=True, chunk_size=2)
+        self.assertTrue(report.dry_run)
+        self.assertEqual(report.forms, HarborDuesForm.objects.count())
+        self.assertGreater(report.changed_forms, 0)
+        # 20 passengers at 10 kr. and 15 disembarking at 3 kr.
+        self.assertEqual(report.delta["pax_tax"], Decimal("200"))
+        self.assertEqual(report.delta["disembarkment_tax"], Decimal("45"))
+        self.assertEqual(self._stored_taxes(), before)
+
+    def test_recalculate(self):
+        report = recalculate_taxes(chunk_size=2)
+        self.assertFalse(report.dry_run)
+        self.assertEqual(report.changed_forms, HarborDuesForm.objects.count())
+        for form in HarborDuesForm.objects.filter(cruisetaxform__isnull=True):
+            self.assertEqual(
+                form.harbour_tax,
+                form.calculate_harbour_tax(save=False)["harbour_tax"],
+            )
+        form = CruiseTaxForm.objects.get(pk=self.cruise_tax_form.pk)
+        self.assertEqual(
+            form.harbour_tax, form.calculate_harbour_tax(save=False)["harbour_tax"]
+        )
+        self.assertEqual(form.pax_tax, Decimal("200"))
+        self.assertEqual(form.disembarkment_tax, Decimal("45"))
+        self.disembarkment.refresh_from_db()
+        self.assertEqual(self.disembarkment.disembarkment_tax, Decimal("45"))
+        self.assertEqual(self.disembarkment.used_disembarkment_tax_rate, Decimal("3"))
+        # Nothing changes on a second run
+        report = recalculate_taxes()
+        self.assertEqual(report.changed_forms, 0)
+        self.assertEqual(report.total_delta, Decimal(0))
+
+    def test_filter_by_status(self):
+        report = recalculate_taxes(statuses=[Status.DRAFT])
+        self.assertEqual(report.forms, 2)
+        self.assertIsNotNone(
+            HarborDuesForm.objects.get(pk=self.harbor_dues_draft_form.pk).harbour_tax
+        )
+        self.assertIsNone(
+            HarborDuesForm.objects.get(pk=self.harbor_dues_form.pk).harbour_tax
+        )
+
+    def test_filter_by_arrival_and_port(self):
+        report = recalculate_taxes(
+            arrival_from=date(2020, 1, 1),
+            arrival_to=date(2020, 1, 1),
+            ports=[self.port],
+            dry_run=True,
+        )
+        self.assertEqual(
+            report.forms, HarborDuesForm.objects.filter(port_of_call=self.port).count()
+        )
+        self.assertEqual(recalculate_taxes(arrival_to=date(2019, 12, 31)).forms, 0)
+
+    def test_filter_by_queryset(self):
+        report = recalculate_taxes(
+            CruiseTaxForm.objects.filter(pk=self.cruise_tax_form.pk)
+        )
+        self.assertEqual(report.forms, 1)
+        self.assertEqual(report.changed_forms, 1)
+
+    def test_command(self):
+        stdout = StringIO()
+        call_command(
+            "recalculate_taxes",
+            "--dry-run",
+            "--status",
+            Status.NEW,
+            "--from",
+            "2020-01-01",
+            stdout=stdout,
+        )
+        self.assertIn("Would change 3 of 3 forms", stdout.getvalue())
+
+
+class RecalculationProcessesTest(
+    RecalculationTestMixin, CommittedDataTestMixin, TransactionTestCase
+):
+    def test_recalculate_in_processes(self):
+        expected = recalculate_taxes(dry_run=True)
+        report = recalculate_taxes(chunk_size=2, processes=2)
+        self.assertEqual(report.forms, expected.forms)
+        self.assertEqual(report.changed_forms, expected.changed_forms)
+        self.assertEqual(report.delta, expected.delta)
+        form = CruiseTaxForm.objects.get(pk=self.cruise_tax_form.pk)
+        self.assertEqual(form.pax_tax, Decimal("200"))
+        self.assertEqual(form.disembarkment_tax, Decimal("45"))
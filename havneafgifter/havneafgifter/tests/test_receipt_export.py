@@ -0,0 +1,200 @@
+import zipfile
+from io import BytesIO, StringIO
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from unittest.mock import PropertyMock, patch
+
+from django.core.files.storage import FileSystemStorage
+from django.core.management import CommandError, call_command
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.urls import reverse
+from django.utils import translation
+
+from havneafgifter.models import HarborDuesForm, Status
+from havneafgifter.receipt_export import (
+    iter_export_forms,
+    iter_receipt_zip,
+    iter_stored_receipts,
+)
+from havneafgifter.receipts import (
+    Receipt,
+    _pdf_cache,
+    clear_receipt_cache,
+    get_receipt_fingerprint,
+    save_receipt_pdf,
+)
+from havneafgifter.tests.mixins import CommittedDataTestMixin, HarborDuesFormTestMixin
+
+
+@override_settings(
+    RECEIPT_EXPORT={"workers": 1, "max_zip_forms": 100, "max_merged_forms": 2}
+)
+class TestReceiptExport(HarborDuesFormTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        storage = FileSystemStorage(location=self.enterContext(TemporaryDirectory()))
+        self.enterContext(patch("havneafgifter.receipts.pdf_storage", storage))
+        self.enterContext(patch("havneafgifter.receipt_export.pdf_storage", storage))
+        self.mock_pdf = self.enterContext(
+            patch.object(
+                Receipt, "pdf", new_callable=PropertyMock, return_value=b"%PDF"
+            )
+        )
+        _pdf_cache.clear()
+
+    def _get_forms(self, **filters):
+        return HarborDuesForm.objects.filter(**filters).order_by("pk")
+
+    def _read_zip(self, content: bytes) -> dict:
+        with zipfile.ZipFile(BytesIO(content)) as archive:
+            return {name: archive.read(name) for name in archive.namelist()}
+
+    def test_iter_export_forms(self):
+        forms = list(iter_export_forms(self._get_forms()))
+        self.assertEqual(
+            [form.pk for form in forms], [form.pk for form in self._get_forms()]
+        )
+        # Cruise tax forms are loaded as such
+        self.assertIn(self.cruise_tax_form, forms)
+        self.assertIs(
+            type(forms[forms.index(self.cruise_tax_form)]),
+            type(self.cruise_tax_form),
+        )
+
+    def test_zip(self):
+        forms = self._get_forms(status=Status.NEW)
+        content = b"".join(
+            iter_receipt_zip(iter_stored_receipts(iter_export_forms(forms), 1))
+        )
+        self.assertEqual(
+            self._read_zip(content),
+            {f"{form.form_id}.pdf": b"%PDF" for form in forms},
+        )
+
+    def test_zip_reuses_stored_pdf(self):
+        save_receipt_pdf(self.harbor_dues_form, b"%PDF-stored")
+        _pdf_cache.clear()
+        self.mock_pdf.reset_mock()
+        forms = self._get_forms(pk=self.harbor_dues_form.pk)
+        content = b"".join(
+            iter_receipt_zip(iter_stored_receipts(iter_export_forms(forms), 1))
+        )
+        self.assertEqual(
+            self._read_zip(content),
+            {f"{self.harbor_dues_form.form_id}.pdf": b"%PDF-stored"},
+        )
+        self.mock_pdf.assert_not_called()
+
+    def test_view_zip(self):
+        self.client.force_login(self.tax_authority_user)
+        with patch("havneafgifter.receipt_export.process_pool") as mock_process_pool:
+            response = self.client.get(
+                reverse("havneafgifter:receipt_export", kwargs={"format": "zip"}),
+                {
+                    "vessel_name": self.harbor_dues_form.vessel_name,
+                    "status": Status.NEW,
+                },
+            )
+            self.assertEqual(response["Content-Type"], "application/zip")
+            self.assertIn("attachment", response["Content-Disposition"])
+            names = set(self._read_zip(b"".join(response.streaming_content)))
+        # Rendered in the request, rather than by a pool of processes
+        mock_process_pool.assert_not_called()
+        expected = HarborDuesForm.filter_user_permissions(
+            self._get_forms(
+                vessel_name__icontains=self.harbor_dues_form.vessel_name,
+                status=Status.NEW,
+            ),
+            self.tax_authority_user,
+            "view",
+        )
+        self.assertEqual(names, {f"{form.form_id}.pdf" for form in expected})
+
+    def test_view_pdf(self):
+        self.client.force_login(self.tax_authority_user)
+        url = reverse("havneafgifter:receipt_export", kwargs={"format": "pdf"})
+        response = self.client.get(url, {"id": self.harbor_dues_form.pk})
+        self.assertEqual(response["Content-Type"], "application/pdf")
+        self.assertTrue(b"".join(response.streaming_content).startswith(b"%PDF"))
+        # Merged PDFs are limited to `max_merged_forms` forms
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 400)
+        self.assertIn(b"ZIP file", response.content)
+
+    def test_view_limit(self):
+        # Exports of the view are rendered in the request, so they are limited
+        # to `max_zip_forms` forms
+        self.client.force_login(self.tax_authority_user)
+        for export_format in ("zip", "pdf"):
+            with self.subTest(export_format=export_format):
+                with override_settings(
+                    RECEIPT_EXPORT={"max_zip_forms": 1, "max_merged_forms": 100}
+                ):
+                    response = self.client.get(
+                        reverse(
+                            "havneafgifter:receipt_export",
+                            kwargs={"format": export_format},
+                        )
+                    )
+                self.assertEqual(response.status_code, 400)
+                self.assertIn(b"Narrow down the filters", response.content)
+
+    def test_view_errors(self):
+        self.client.force_login(self.tax_authority_user)
+        response = self.client.get(
+            reverse("havneafgifter:receipt_export", kwargs={"format": "zip"}),
+            {"id": -1},
+        )
+        self.assertEqual(response.status_code, 404)
+        response = self.client.get(
+            reverse("havneafgifter:receipt_export", kwargs={"format": "tar"})
+        )
+        self.assertEqual(response.status_code, 404)
+
+    def test_command(self):
+        output = Path(self.enterContext(TemporaryDirectory())) / "receipts.zip"
+        call_command(
+            "export_receipts",
+            f"id={self.harbor_dues_form.pk}",
+            output=str(output),
+            stdout=StringIO(),
+        )
+        self.assertEqual(
+            self._read_zip(output.read_bytes()),
+            {f"{self.harbor_dues_form.form_id}.pdf": b"%PDF"},
+        )
+        with self.assertRaises(CommandError):
+            call_command("export_receipts", "colour=red", output=str(output))
+        with self.assertRaises(CommandError):
+            call_command("export_receipts", "id=abc", output=str(output))
+
+
+class TestReceiptExportWorkers(
+    HarborDuesFormTestMixin, CommittedDataTestMixin, TransactionTestCase
+):
+    def test_zip_in_processes(self):
+        self.addCleanup(clear_receipt_cache)
+        # More forms than the workers are ahead of the form yielded
+        forms = HarborDuesForm.objects.order_by("pk")
+        self.assertGreater(forms.count(), 2 * 2)
+        with translation.override("da"):
+            receipts = list(iter_stored_receipts(iter_export_forms(forms), 2))
+            fingerprints = [get_receipt_fingerprint(form) for form, _ in receipts]
+        self.assertEqual([form.pk for form, _ in receipts], [form.pk for form in forms])
+        # Stored by the worker processes, in the language of the export
+        self.assertEqual(
+            [name for _, name in receipts],
+            [
+                f"preview/{form.pk}/{fingerprint}.pdf"
+                for (form, _), fingerprint in zip(receipts, fingerprints)
+            ],
+        )
+        with translation.override("en"):
+            self.assertNotEqual(
+                get_receipt_fingerprint(receipts[0][0]), fingerprints[0]
+            )
+        with zipfile.ZipFile(BytesIO(b"".join(iter_receipt_zip(receipts)))) as archive:
+            self.assertEqual(
+                archive.namelist(), [f"{form.form_id}.pdf" for form, _ in receipts]
+            )
+            self.assertTrue(archive.read(archive.namelist()[0]).startswith(b"%PDF"))
@@ -1,17 +1,33 @@
+import os
+import threading
+from io import StringIO
+from tempfile import TemporaryDirectory
 from unittest.mock import Mock, PropertyMock, patch
 
+import weasyprint
+from django.core.files.storage import FileSystemStorage
+from django.core.management import call_command
 from django.http import HttpRequest
 from django.template import Context, RequestContext, Template
-from django.test import SimpleTestCase, TestCase
+from django.test import SimpleTestCase, TestCase, override_settings
 from unittest_parametrize import ParametrizedTestCase, parametrize
 
-from havneafgifter.models import ShipType
+from havneafgifter.models import CruiseTaxForm, HarborDuesForm, Nationality, ShipType
 from havneafgifter.receipts import (
     _PDF_BASE_TEMPLATE,
     CruiseTaxFormReceipt,
     Engine,
     HarborDuesFormReceipt,
+    LocalAssetFetcher,
+    PDFAssetError,
+    PDFRenderer,
     Receipt,
+    _pdf_cache,
+    get_pdf_renderer,
+    get_receipt_fingerprint,
+    get_receipt_pdf,
+    get_stored_receipt_pdf,
+    save_receipt_pdf,
 )
 from havneafgifter.tests.mixins import HarborDuesFormTestMixin
 
@@ -23,6 +39,11 @@ class _PDFMixin:
 
 
 class TestReceipt(ParametrizedTestCase, _PDFMixin, SimpleTestCase):
+    def setUp(self):
+        super().setUp()
+        # Load the receipt stylesheet before `Engine.get_template` is mocked
+        get_pdf_renderer()
+
     @parametrize(
         "request,expected_context_type",
         [
@@ -87,6 +108,96 @@ class TestReceipt(ParametrizedTestCase, _PDFMixin, SimpleTestCase):
         )
 
 
+class TestPDFRenderer(SimpleTestCase):
+    def test_get_pdf_renderer(self):
+        renderer = get_pdf_renderer()
+        self.assertIs(get_pdf_renderer(), renderer)
+        # Each thread has its own renderer
+        renderers = []
+        thread = threading.Thread(target=lambda: renderers.append(get_pdf_renderer()))
+        thread.start()
+        thread.join()
+        self.assertIsNot(renderers[0], renderer)
+
+    def test_render(self):
+        renderer = PDFRenderer()
+        with patch("havneafgifter.receipts.weasyprint.HTML") as mock_html:
+            renderer.render("<p>Receipt</p>")
+            renderer.render("<p>Receipt</p>")
+        self.assertEqual(mock_html.call_count, 2)
+        # The font configuration and parsed stylesheets are reused
+        for call in mock_html.return_value.render.call_args_list:
+            self.assertIs(call.kwargs["font_config"], renderer.font_config)
+            self.assertIs(call.kwargs["stylesheets"], renderer.stylesheets)
+
+    def test_render_missing_asset(self):
+        with self.assertRaises(PDFAssetError):
+            PDFRenderer().render('<img src="https://example.com/logo.png">')
+
+    def test_render_unreadable_asset(self):
+        # Other errors of the fetcher are raised as a `PDFAssetError` as well
+        renderer = PDFRenderer()
+        path = os.path.join(self.enterContext(TemporaryDirectory()), "logo.png")
+        with patch.object(renderer.url_fetcher, "find", return_value=path):
+            with self.assertRaises(PDFAssetError) as context:
+                renderer.render('<img src="https://example.com/static/logo.png">')
+        self.assertIsInstance(context.exception.__cause__.__cause__, OSError)
+
+
+class TestLocalAssetFetcher(SimpleTestCase):
+    def setUp(self):
+        super().setUp()
+        self.static_root = self.enterContext(TemporaryDirectory())
+        with open(os.path.join(self.static_root, "logo.png"), "wb") as file:
+            file.write(b"PNG")
+        self.enterContext(
+            override_settings(
+                STATIC_ROOT=self.static_root,
+                PDF_ASSET_URLS={"https://cdn.example.com/logo.png": "logo.png"},
+            )
+        )
+        self.fetcher = LocalAssetFetcher()
+
+    def _fetch(self, url: str) -> bytes:
+        with weasyprint.urls.fetch(self.fetcher, url) as response:
+            self.assertEqual(response.content_type, "image/png")
+            return response.read()
+
+    def test_fetch_static(self):
+        for url in (
+            "file:///static/logo.png",
+            "https://talippoq.aka.gl/static/logo.png",
+            "https://cdn.example.com/logo.png",
+        ):
+            with self.subTest(url=url):
+                self.assertEqual(self._fetch(url), b"PNG")
+
+    def test_fetch_cached(self):
+        self.assertEqual(self._fetch("file:///static/logo.png"), b"PNG")
+        os.remove(os.path.join(self.static_root, "logo.png"))
+        self.assertEqual(self._fetch("file:///static/logo.png"), b"PNG")
+
+    def test_fetch_static_finders(self):
+        # Static files which are not collected
+        body = self.fetcher.fetch("file:///static/logo_aka.png").read()
+        self.assertTrue(body.startswith(b"\x89PNG"))
+
+    def test_fetch_data(self):
+        response = self.fetcher.fetch("data:text/plain;base64,SGVq")
+        self.assertEqual(response.read(), b"Hej")
+
+    def test_fetch_fails(self):
+        for url in (
+            "https://example.com/logo.png",
+            "file:///etc/passwd",
+            "file:///static/../../etc/passwd",
+            "file:///static/missing.png",
+        ):
+            with self.subTest(url=url):
+                with self.assertRaises(PDFAssetError):
+                    self.fetcher.fetch(url)
+
+
 class TestHarborDuesFormReceipt(HarborDuesFormTestMixin, _PDFMixin, TestCase):
     def setUp(self):
         super().setUp()
@@ -147,3 +258,117 @@ class TestCruiseTaxFormReceiptWithoutPortOfCall(
 
     def test_renders_pdf(self):
         self.assert_content_is_pdf(self.instance.pdf)
+
+
+class TestReceiptPDFCache(HarborDuesFormTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        _pdf_cache.clear()
+
+    def test_renders_once(self):
+        form = CruiseTaxForm.objects.get(pk=self.cruise_tax_form.pk)
+        with patch.object(
+            CruiseTaxFormReceipt, "pdf", new_callable=PropertyMock
+        ) as mock_pdf:
+            mock_pdf.return_value = b"%PDF-1"
+            self.assertEqual(get_receipt_pdf(form), b"%PDF-1")
+            save_receipt_pdf(form, get_receipt_pdf(form))
+            mock_pdf.assert_called_once()
+            self.assertEqual(form.pdf_fingerprint, get_receipt_fingerprint(form))
+            # Another process reads the stored PDF
+            _pdf_cache.clear()
+            form = CruiseTaxForm.objects.get(pk=form.pk)
+            self.assertEqual(get_receipt_pdf(form), b"%PDF-1")
+            mock_pdf.assert_called_once()
+            # Changing the form renders it again
+            mock_pdf.return_value = b"%PDF-2"
+            form.vessel_name = "Argo"
+            self.assertEqual(get_receipt_pdf(form), b"%PDF-2")
+            self.assertEqual(mock_pdf.call_count, 2)
+
+    @patch.object(HarborDuesFormReceipt, "pdf", new_callable=PropertyMock)
+    def test_save_receipt_pdf(self, mock_pdf):
+        mock_pdf.return_value = b"%PDF"
+        form = self.harbor_dues_form
+        # Rendered if not given
+        save_receipt_pdf(form)
+        mock_pdf.assert_called_once()
+        self.assertEqual(form.pdf.read(), b"%PDF")
+        # Not stored again while current
+        with patch.object(form, "save") as mock_save:
+            save_receipt_pdf(form)
+            mock_save.assert_not_called()
+
+    @patch("havneafgifter.receipts.PDF_CACHE_SIZE", 1)
+    @patch.object(HarborDuesFormReceipt, "pdf", new_callable=PropertyMock)
+    def test_cache_size(self, mock_pdf):
+        mock_pdf.return_value = b"%PDF"
+        get_receipt_pdf(self.harbor_dues_form)
+        form = CruiseTaxForm.objects.get(pk=self.cruise_tax_form.pk)
+        with patch.object(CruiseTaxFormReceipt, "pdf", new_callable=PropertyMock):
+            get_receipt_pdf(form)
+        # The least recently used PDF is forgotten
+        self.assertEqual(list(_pdf_cache), [(form.pk, get_receipt_fingerprint(form))])
+
+    @patch.object(HarborDuesFormReceipt, "pdf", new_callable=PropertyMock)
+    def test_stored_pdf_unreadable(self, mock_pdf):
+        mock_pdf.return_value = b"%PDF"
+        form = self.harbor_dues_form
+        form.pdf.name = "missing.pdf"
+        form.pdf_fingerprint = get_receipt_fingerprint(form)
+        # Rendered again
+        self.assertEqual(get_receipt_pdf(form), b"%PDF")
+        mock_pdf.assert_called_once()
+
+    @patch.object(HarborDuesFormReceipt, "pdf", new_callable=PropertyMock)
+    def test_stored_receipt_pdf(self, mock_pdf):
+        mock_pdf.return_value = b"%PDF"
+        storage = FileSystemStorage(location=self.enterContext(TemporaryDirectory()))
+        self.enterContext(patch("havneafgifter.receipts.pdf_storage", storage))
+        form = self.harbor_dues_form
+        # A current `form.pdf` missing from the storage is not used
+        form.pdf.name = "missing.pdf"
+        form.pdf_fingerprint = get_receipt_fingerprint(form)
+        name, fingerprint, _ = get_stored_receipt_pdf(form)
+        self.assertEqual(name, f"preview/{form.pk}/{fingerprint}.pdf")
+        self.assertEqual(storage.open(name).read(), b"%PDF")
+        # A preview stored by another process after checking for it is kept
+        exists = storage.exists
+        checked = []
+
+        def exists_after_check(name):
+            checked.append(name)
+            return len(checked) > 1 and exists(name)
+
+        with patch.object(storage, "exists", side_effect=exists_after_check):
+            self.assertEqual(get_stored_receipt_pdf(form)[0], name)
+        self.assertEqual(
+            storage.listdir(f"preview/{form.pk}")[1], [f"{fingerprint}.pdf"]
+        )
+
+    @patch.object(HarborDuesFormReceipt, "pdf", new_callable=PropertyMock)
+    def test_clear_receipt_cache_stored(self, mock_pdf):
+        mock_pdf.return_value = b"%PDF"
+        storage = FileSystemStorage(location=self.enterContext(TemporaryDirectory()))
+        self.enterContext(patch("havneafgifter.receipts.pdf_storage", storage))
+        form = self.harbor_dues_form
+        get_stored_receipt_pdf(form)
+        save_receipt_pdf(form)
+        stdout = StringIO()
+        call_command("clear_receipt_cache", stored=True, stdout=stdout)
+        self.assertEqual(stdout.getvalue(), "Deleted 1 receipt previews\n")
+        self.assertEqual(storage.listdir("preview"), ([], []))
+        # The stored receipt is no longer used as a preview
+        form = HarborDuesForm.objects.get(pk=form.pk)
+        self.assertIsNone(form.pdf_fingerprint)
+        name, _, _ = get_stored_receipt_pdf(form)
+        self.assertTrue(name.startswith(f"preview/{form.pk}/"))
+
+    def test_fingerprint(self):
+        form = CruiseTaxForm.objects.get(pk=self.cruise_tax_form.pk)
+        fingerprint = get_receipt_fingerprint(form)
+        self.assertEqual(get_receipt_fingerprint(form), fingerprint)
+        form.passengers_by_country.create(
+            nationality=Nationality.DENMARK, number_of_passengers=5
+        )
+        self.assertNotEqual(get_receipt_fingerprint(form), fingerprint)
@@ -0,0 +1,165 @@
+import json
+import os
+import tempfile
+from datetime import datetime, timezone
+from decimal import Decimal
+from io import StringIO
+
+from django.core.management import call_command
+from django.test import TestCase
+
+from havneafgifter.models import (
+    CruiseTaxForm,
+    Disembarkment,
+    DisembarkmentSite,
+    DisembarkmentTaxRate,
+    HarborDuesForm,
+    Municipality,
+    PortTaxRate,
+    ShipType,
+    TaxRates,
+)
+from havneafgifter.simulation import (
+    FormColumns,
+    calculate_tax_columns,
+    candidate_index,
+    simulate,
+)
+from havneafgifter.tariffs import get_tariff_index
+from havneafgifter.tests.mixins import HarborDuesFormTestMixin
+
+
+class SimulationTest(HarborDuesFormTestMixin, TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.tax_rates = TaxRates.objects.create(pax_tax_rate=Decimal("10"))
+        cls.port_tax_rate = PortTaxRate.objects.create(
+            tax_rates=cls.tax_rates,
+            gt_start=0,
+            port_tax_rate=Decimal("0.5"),
+            round_gross_ton_up_to=100,
+        )
+        cls.disembarkment_site = DisembarkmentSite.objects.filter(
+            municipality=Municipality.KUJALLEQ
+        ).first()
+        cls.disembarkment_tax_rate = DisembarkmentTaxRate.objects.create(
+            tax_rates=cls.tax_rates,
+            municipality=Municipality.KUJALLEQ,
+            disembarkment_tax_rate=Decimal("3"),
+        )
+        cls.cruise_tax_form.number_of_passengers = 20
+        cls.cruise_tax_form.save()
+        Disembarkment.objects.create(
+            cruise_tax_form=cls.cruise_tax_form,
+            number_of_passengers=15,
+            disembarkment_site=cls.disembarkment_site,
+        )
+
+    def test_tax_columns_match_model(self):
+        columns = FormColumns.load(HarborDuesForm.objects.all())
+        taxes = calculate_tax_columns(get_tariff_index(), columns)
+        for row_number, pk in enumerate(columns.pk):
+            form = HarborDuesForm.objects.get(pk=pk)
+            with self.subTest(form=form):
+                self.assertEqual(
+                    taxes.harbour_tax[row_number],
+                    form.calculate_harbour_tax(save=False)["harbour_tax"] or Decimal(0),
+                )
+        cruise_tax_form = CruiseTaxForm.objects.get(pk=self.cruise_tax_form.pk)
+        row_number = columns.pk.index(cruise_tax_form.pk)
+        self.assertEqual(
+            taxes.pax_tax[row_number],
+            cruise_tax_form.calculate_passenger_tax(save=False)["passenger_tax"],
+        )
+        self.assertEqual(
+            taxes.disembarkment_tax,
+            [
+                cruise_tax_form.calculate_disembarkment_tax(save=False)[
+                    "disembarkment_tax"
+                ]
+            ],
+        )
+
+    def test_unchanged_tariff(self):
+        result = simulate(get_tariff_index())
+        self.assertEqual(result.forms, 3)
+        self.assertEqual(result.changed_forms, 0)
+        self.assertEqual(result.total.delta, Decimal(0))
+
+    def test_candidate_replacing_tariff(self):
+        self.tax_rates.pax_tax_rate = Decimal("20")
+        port_tax_rate = PortTaxRate(
+            gt_start=0, port_tax_rate=Decimal("1"), round_gross_ton_up_to=100
+        )
+        disembarkment_tax_rate = DisembarkmentTaxRate(
+            disembarkment_site=self.disembarkment_site,
+            municipality=Municipality.KUJALLEQ,
+            disembarkment_tax_rate=Decimal("4"),
+        )
+        result = simulate(
+            candidate_index(self.tax_rates, [port_tax_rate], [disembarkment_tax_rate]),
+            FormColumns.load(CruiseTaxForm.objects.filter(pk=self.cruise_tax_form.pk)),
+        )
+        # Harbour tax: 31 days at (1 - 0.5) * 100 GT
+        # Passenger tax: 20 passengers at (20 - 10)
+        # Disembarkment tax: 15 passengers at (4 - 3)
+        self.assertEqual(result.total.delta, Decimal(1550 + 200 + 15))
+        self.assertEqual(result.by_port["Nordhavn"].delta, Decimal(1765))
+        self.assertEqual(result.by_vessel_type["Cruise ship"].delta, Decimal(1765))
+        self.assertEqual(result.by_municipality["Kujalleq"].delta, Decimal(15))
+        # The current tariff is untouched
+        self.tax_rates.refresh_from_db()
+        self.assertEqual(get_tariff_index().periods[0].tax_rates.pax_tax_rate, 10)
+
+    def test_candidate_adding_tariff(self):
+        candidate = candidate_index(
+            TaxRates(
+                pax_tax_rate=Decimal("0"),
+                start_datetime=datetime(2020, 1, 16, tzinfo=timezone.utc),
+            ),
+            [],
+            [],
+        )
+        self.assertEqual(len(candidate.periods), 2)
+        self.assertEqual(
+            candidate.periods[0].end_datetime,
+            datetime(2020, 1, 16, tzinfo=timezone.utc),
+        )
+        self.assertIsNone(get_tariff_index().periods[0].end_datetime)
+        result = simulate(
+            candidate,
+            FormColumns.load(CruiseTaxForm.objects.filter(pk=self.cruise_tax_form.pk)),
+        )
+        # No harbour tax from January 16th
+        self.assertLess(result.by_port["Nordhavn"].delta, 0)
+
+    def test_command(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "candidate.json")
+            with open(path, "w") as file:
+                json.dump(
+                    [
+                        {
+                            "model": "havneafgifter.taxrates",
+                            "pk": self.tax_rates.pk,
+                            "fields": {"pax_tax_rate": "20"},
+                        },
+                        {
+                            "model": "havneafgifter.porttaxrate",
+                            "fields": {
+                                "tax_rates": self.tax_rates.pk,
+                                "vessel_type": ShipType.CRUISE,
+                                "gt_start": 0,
+                                "port_tax_rate": "0.5",
+                                "round_gross_ton_up_to": 100,
+                            },
+                        },
+                    ],
+                    file,
+                )
+            stdout = StringIO()
+            call_command("simulate_tariff", path, stdout=stdout)
+        output = stdout.getvalue()
+        self.assertIn("2 of 3 forms change", output)
+        self.assertIn("Kujalleq", output)
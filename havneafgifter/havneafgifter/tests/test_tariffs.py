@@ -0,0 +1,269 @@
+from datetime import datetime, timezone
+from decimal import Decimal
+from importlib import import_module
+from unittest.mock import patch
+
+from django.apps import apps
+from django.db.models import Q
+from django.test import TestCase
+
+from havneafgifter.models import (
+    EffectivePortTaxRate,
+    Port,
+    PortTaxRate,
+    ShipType,
+    TariffVersion,
+    TaxRates,
+)
+from havneafgifter.tariffs import TariffIndex, get_tariff_index
+
+
+class TariffIndexTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.port1 = Port.objects.create(name="Test1")
+        cls.port2 = Port.objects.create(name="Test2")
+        cls.tax_rates1 = TaxRates.objects.create(start_datetime=None)
+        cls.tax_rates2 = TaxRates.objects.create(
+            start_datetime=datetime(2025, 1, 1, tzinfo=timezone.utc)
+        )
+        cls.tax_rates3 = TaxRates.objects.create(
+            start_datetime=datetime(2025, 2, 1, tzinfo=timezone.utc)
+        )
+        for tax_rates in (cls.tax_rates1, cls.tax_rates2, cls.tax_rates3):
+            tax_rates.refresh_from_db()
+        # Overlapping bands, specific and wildcard ports and vessel types
+        for port, vessel_type, gt_start, gt_end, rate in (
+            (None, None, 0, None, "0.7"),
+            (None, ShipType.CRUISE, 0, 30_000, "1.1"),
+            (None, ShipType.CRUISE, 30_000, None, "2.2"),
+            (cls.port1, ShipType.CRUISE, 0, 30_000, "0"),
+            (cls.port1, ShipType.CRUISE, 30_000, None, "1.1"),
+            (cls.port2, None, 1_000, 5_000, "3.3"),
+            (cls.port2, ShipType.FISHER, 2_000, 2_000, "4.4"),
+            (None, ShipType.FISHER, 4_000, 6_000, "5.5"),
+        ):
+            PortTaxRate.objects.create(
+                tax_rates=cls.tax_rates1,
+                port=port,
+                vessel_type=vessel_type,
+                gt_start=gt_start,
+                gt_end=gt_end,
+                port_tax_rate=Decimal(rate),
+            )
+        PortTaxRate.objects.create(
+            tax_rates=cls.tax_rates2,
+            port=None,
+            vessel_type=None,
+            gt_start=100,
+            gt_end=None,
+            port_tax_rate=Decimal("1.4"),
+        )
+
+    def test_get_port_tax_rate_matches_orm(self):
+        index = TariffIndex.load()
+        for tax_rates, period in zip(
+            (self.tax_rates1, self.tax_rates2, self.tax_rates3), index.periods
+        ):
+            self.assertEqual(period.tax_rates, tax_rates)
+            for port in (None, self.port1, self.port2):
+                for vessel_type in (None, *ShipType.values):
+                    for gross_ton in (
+                        0,
+                        99,
+                        100,
+                        999,
+                        1_000,
+                        1_999,
+                        2_000,
+                        2_001,
+                        4_000,
+                        5_000,
+                        5_001,
+                        6_001,
+                        29_999,
+                        30_000,
+                        30_001,
+                        1_000_000,
+                    ):
+                        with self.subTest(
+                            tax_rates=tax_rates,
+                            port=port,
+                            vessel_type=vessel_type,
+                            gross_ton=gross_ton,
+                        ):
+                            self.assertEqual(
+                                period.get_port_tax_rate(
+                                    port.pk if port else None, vessel_type, gross_ton
+                                ),
+                                tax_rates.get_port_tax_rate(
+                                    port, vessel_type, gross_ton  # type: ignore
+                                ),
+                            )
+
+    def test_effective_port_tax_rates_match_orm(self):
+        gross_tons = (0, 999, 1_000, 2_000, 2_001, 5_001, 6_001, 30_000, 1_000_000)
+        grid = [
+            (port, vessel_type, gross_ton)
+            for port in (self.port1, self.port2)
+            for vessel_type in ShipType.values
+            for gross_ton in gross_tons
+        ]
+        expected = [
+            self.tax_rates1.get_port_tax_rate(port, vessel_type, gross_ton)
+            for port, vessel_type, gross_ton in grid
+        ]
+        EffectivePortTaxRate.regenerate(self.tax_rates1)
+        # Adjacent segments with the same rate are merged
+        self.assertEqual(
+            list(
+                self.tax_rates1.effective_port_tax_rates.filter(
+                    port=self.port1, vessel_type=ShipType.CRUISE
+                )
+                .order_by("gt_start")
+                .values_list("gt_start", "gt_end", "port_tax_rate__port_tax_rate")
+            ),
+            [(0, 30_000, Decimal("0")), (30_001, None, Decimal("1.1"))],
+        )
+        for (port, vessel_type, gross_ton), port_tax_rate in zip(grid, expected):
+            with self.subTest(port=port, vessel_type=vessel_type, gross_ton=gross_ton):
+                self.assertEqual(
+                    self.tax_rates1.get_port_tax_rate(port, vessel_type, gross_ton),
+                    port_tax_rate,
+                )
+        # A rate is looked up in a single query
+        with self.assertNumQueries(1):
+            self.tax_rates1.get_port_tax_rate(self.port1, ShipType.CRUISE, 30_000)
+
+    def test_regenerate_all(self):
+        count = EffectivePortTaxRate.regenerate_all()
+        self.assertEqual(count, EffectivePortTaxRate.objects.count())
+        # The rows of every table are replaced, not duplicated
+        self.assertEqual(EffectivePortTaxRate.regenerate_all(), count)
+        self.assertEqual(EffectivePortTaxRate.objects.count(), count)
+        self.assertTrue(self.tax_rates2.effective_port_tax_rates.exists())
+        effective_port_tax_rate = self.tax_rates1.effective_port_tax_rates.get(
+            port=self.port1, vessel_type=ShipType.CRUISE, gt_start=0
+        )
+        self.assertEqual(
+            str(effective_port_tax_rate),
+            f"{self.tax_rates1}, Test1, {ShipType.CRUISE}, 0 t - 30000 t",
+        )
+
+    def test_port_tax_rate_changes_regenerate(self):
+        EffectivePortTaxRate.regenerate_all()
+        with self.captureOnCommitCallbacks(execute=True):
+            port_tax_rate = PortTaxRate.objects.create(
+                tax_rates=self.tax_rates1,
+                port=self.port2,
+                vessel_type=ShipType.FREIGHTER,
+                gt_start=0,
+                gt_end=None,
+                port_tax_rate=Decimal("9.9"),
+            )
+            # The outdated rows are not used until regenerated
+            self.assertFalse(self.tax_rates1.effective_port_tax_rates.exists())
+            self.assertTrue(self.tax_rates2.effective_port_tax_rates.exists())
+            self.assertEqual(
+                self.tax_rates1.get_port_tax_rate(self.port2, ShipType.FREIGHTER, 0),
+                port_tax_rate,
+            )
+        # Regenerated once the transaction is committed
+        self.assertTrue(
+            self.tax_rates1.effective_port_tax_rates.filter(
+                port_tax_rate=port_tax_rate
+            ).exists()
+        )
+        with self.captureOnCommitCallbacks(execute=True):
+            port_tax_rate.delete()
+        self.assertTrue(self.tax_rates1.effective_port_tax_rates.exists())
+        # The general rate applies again
+        self.assertEqual(
+            self.tax_rates1.get_port_tax_rate(self.port2, ShipType.FREIGHTER, 0).pk,
+            PortTaxRate.objects.get(
+                tax_rates=self.tax_rates1, port=None, vessel_type=None
+            ).pk,
+        )
+
+    def test_new_port_regenerates(self):
+        EffectivePortTaxRate.regenerate_all()
+        with patch.object(
+            EffectivePortTaxRate, "regenerate", wraps=EffectivePortTaxRate.regenerate
+        ) as mock_regenerate:
+            with self.captureOnCommitCallbacks(execute=True):
+                port = Port.objects.create(name="Test3")
+                Port.objects.create(name="Test4")
+        # Regenerated once for both ports
+        self.assertEqual(mock_regenerate.call_count, TaxRates.objects.count())
+        for tax_rates in (self.tax_rates1, self.tax_rates2):
+            self.assertTrue(tax_rates.effective_port_tax_rates.filter(port=port))
+
+    def test_regenerate_in_migration(self):
+        migration = import_module(
+            "havneafgifter.migrations.0055_regenerate_effectiveporttaxrate"
+        )
+        EffectivePortTaxRate.regenerate_all()
+        fields = ("tax_rates", "port", "vessel_type", "gt_start", "gt_end")
+        expected = list(
+            EffectivePortTaxRate.objects.order_by(*fields).values_list(
+                *fields, "port_tax_rate"
+            )
+        )
+        EffectivePortTaxRate.objects.all().delete()
+        migration.regenerate_effective_port_tax_rates(apps, None)
+        self.assertEqual(
+            list(
+                EffectivePortTaxRate.objects.order_by(*fields).values_list(
+                    *fields, "port_tax_rate"
+                )
+            ),
+            expected,
+        )
+
+    def test_get_periods_matches_orm(self):
+        index = TariffIndex.load()
+        for start, end in (
+            (datetime(2024, 6, 1), datetime(2024, 6, 2)),
+            (datetime(2024, 12, 15), datetime(2025, 1, 1)),
+            (datetime(2025, 1, 1), datetime(2025, 1, 1)),
+            (datetime(2024, 12, 15), datetime(2025, 2, 15)),
+            (datetime(2025, 2, 1), datetime(2025, 3, 1)),
+            (datetime(2026, 1, 1), datetime(2026, 2, 1)),
+        ):
+            start = start.replace(tzinfo=timezone.utc)
+            end = end.replace(tzinfo=timezone.utc)
+            with self.subTest(start=start, end=end):
+                self.assertListEqual(
+                    [period.tax_rates for period in index.get_periods(start, end)],
+                    list(
+                        TaxRates.objects.filter(
+                            Q(start_datetime__isnull=True) | Q(start_datetime__lte=end),
+                            Q(end_datetime__isnull=True) | Q(end_datetime__gte=start),
+                        )
+                    ),
+                )
+
+    def test_index_is_reused_until_tariffs_change(self):
+        index = get_tariff_index()
+        self.assertIs(get_tariff_index(), index)
+        self.assertEqual(index.version, TariffVersion.current())
+        port_tax_rate = PortTaxRate.objects.create(
+            tax_rates=self.tax_rates3,
+            port=None,
+            vessel_type=None,
+            gt_start=0,
+            gt_end=None,
+            port_tax_rate=Decimal("9.9"),
+        )
+        rebuilt = get_tariff_index()
+        self.assertIsNot(rebuilt, index)
+        self.assertEqual(
+            rebuilt.periods[2].get_port_tax_rate(None, ShipType.CRUISE, 10),
+            port_tax_rate,
+        )
+
+    def test_index_is_rebuilt_on_version_change_from_other_process(self):
+        index = get_tariff_index()
+        # Simulate another process changing the tariffs
+        TariffVersion.bump()
+        self.assertIsNot(get_tariff_index(), index)
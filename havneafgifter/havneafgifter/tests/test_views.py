@@ -1,6 +1,7 @@
 from datetime import datetime, timedelta
 from decimal import Decimal
-from unittest.mock import ANY, Mock, patch
+from tempfile import TemporaryDirectory
+from unittest.mock import ANY, Mock, PropertyMock, patch
 from urllib.parse import urlencode
 from zoneinfo import ZoneInfo
 
@@ -9,8 +10,10 @@ from django.conf import settings
 from django.contrib import messages
 from django.contrib.auth.models import AnonymousUser, Group
 from django.core.exceptions import PermissionDenied
+from django.core.files.storage import FileSystemStorage
 from django.core.mail import EmailMessage
 from django.core.management import call_command
+from django.db import DatabaseError, connection
 from django.db.models import Q
 from django.http import (
     HttpResponse,
@@ -19,6 +22,7 @@ from django.http import (
     HttpResponseRedirect,
 )
 from django.test import RequestFactory, TestCase
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 from django.utils.translation import gettext_lazy as _
 from django_tables2.rows import BoundRows
@@ -36,6 +40,7 @@ from havneafgifter.models import (
     Disembarkment,
     DisembarkmentSite,
     DisembarkmentTaxRate,
+    EffectivePortTaxRate,
     HarborDuesForm,
     Municipality,
     Nationality,
@@ -51,6 +56,11 @@ from havneafgifter.models import (
     UserType,
     Vessel,
 )
+from havneafgifter.receipts import (
+    HarborDuesFormReceipt,
+    _pdf_cache,
+    clear_receipt_cache,
+)
 from havneafgifter.tests.mixins import HarborDuesFormTestMixin
 from havneafgifter.views import (
     HandleNotificationMailMixin,
@@ -805,22 +815,7 @@ class TestHarborDuesFormCreateView(
         message must be displayed to the user submitting the form.
         """
         # Arrange
-        # data = copy.copy(self.harbor_dues_form_data_pk)
-        data = {f"base-{k}": v for k, v in self.harbor_dues_form_data_pk.items()}
-        data = {
-            "passengers-TOTAL_FORMS": 1,
-            "passengers-INITIAL_FORMS": 0,
-            "passengers-MIN_NUM_FORMS": 0,
-            "passengers-MAX_NUM_FORMS": 1000,
-            "disembarkment-TOTAL_FORMS": 1,
-            "disembarkment-INITIAL_FORMS": 0,
-            "disembarkment-MIN_NUM_FORMS": 0,
-            "disembarkment-MAX_NUM_FORMS": 1000,
-            **data,
-        }
-        data["base-status"] = status
-        # If there's port in the post data there is no no_port_of_call in the post data
-        del data["base-no_port_of_call"]
+        data = self._get_post_data(status)
         user = User.objects.get(username=username)
 
         self.client.force_login(user)
@@ -851,6 +846,39 @@ class TestHarborDuesFormCreateView(
                 # Assert that we receive a 403 error response
                 self.assertIsInstance(response, HttpResponseForbidden)
 
+    def test_form_is_saved_with_mail_jobs(self):
+        # If the mail jobs cannot be saved, neither is the submitted form
+        forms = HarborDuesForm.objects.count()
+        self.client.force_login(self.shipping_agent_user)
+        with patch(
+            "havneafgifter.view_mixins.enqueue_mail",
+            side_effect=DatabaseError("Could not save mail job"),
+        ):
+            with self.assertRaises(DatabaseError):
+                self.client.post(
+                    reverse("havneafgifter:harbor_dues_form_create"),
+                    data=self._get_post_data(Status.NEW.value),
+                )
+        self.assertEqual(HarborDuesForm.objects.count(), forms)
+
+    def _get_post_data(self, status: str) -> dict:
+        data = {f"base-{k}": v for k, v in self.harbor_dues_form_data_pk.items()}
+        data = {
+            "passengers-TOTAL_FORMS": 1,
+            "passengers-INITIAL_FORMS": 0,
+            "passengers-MIN_NUM_FORMS": 0,
+            "passengers-MAX_NUM_FORMS": 1000,
+            "disembarkment-TOTAL_FORMS": 1,
+            "disembarkment-INITIAL_FORMS": 0,
+            "disembarkment-MIN_NUM_FORMS": 0,
+            "disembarkment-MAX_NUM_FORMS": 1000,
+            **data,
+        }
+        data["base-status"] = status
+        # If there's port in the post data there is no no_port_of_call in the post data
+        del data["base-no_port_of_call"]
+        return data
+
     def _assert_response(
         self,
         username: str,
@@ -926,6 +954,30 @@ class TestReceiptDetailView(ParametrizedTestCase, HarborDuesFormTestMixin, TestC
         self.view.get(self.request_factory.get(""))
         self.assertIsNone(self.view.get_object())
 
+    def test_get_only_writes_when_input_changes(self):
+        def get_updates():
+            request = self.request_factory.get("")
+            request.user = self.user
+            with CaptureQueriesContext(connection) as context:
+                self.view.get(request)
+            return [
+                query["sql"]
+                for query in context.captured_queries
+                if query["sql"].startswith("UPDATE")
+            ]
+
+        self.view.kwargs = {"pk": self.cruise_tax_form.pk}
+        # The first view calculates and saves the taxes
+        self.assertNotEqual(get_updates(), [])
+        # Viewing again does not write anything
+        self.assertEqual(get_updates(), [])
+        # Changing the input causes the taxes to be recalculated
+        CruiseTaxForm.objects.filter(pk=self.cruise_tax_form.pk).update(
+            number_of_passengers=123
+        )
+        self.assertNotEqual(get_updates(), [])
+        self.assertEqual(get_updates(), [])
+
 
 class TestPreviewPDFView(HarborDuesFormTestMixin, TestCase):
     @classmethod
@@ -946,6 +998,74 @@ class TestPreviewPDFView(HarborDuesFormTestMixin, TestCase):
         response = self.view.get(self.request_factory.get(""))
         self.assertIsInstance(response, HttpResponseNotFound)
 
+    def test_get_uses_stored_pdf(self):
+        storage = FileSystemStorage(location=self.enterContext(TemporaryDirectory()))
+        self.enterContext(patch("havneafgifter.views.pdf_storage", storage))
+        self.enterContext(patch("havneafgifter.receipts.pdf_storage", storage))
+        mock_pdf = self.enterContext(
+            patch.object(
+                HarborDuesFormReceipt,
+                "pdf",
+                new_callable=PropertyMock,
+                return_value=b"%PDF",
+            )
+        )
+        clear_receipt_cache()
+        self.view.kwargs = {"pk": self.harbor_dues_form.pk}
+        response = self.view.get(self.request_factory.get(""))
+        self.assertEqual(b"".join(response.streaming_content), b"%PDF")
+        etag = response["ETag"]
+        # Served from storage, without rendering the PDF again
+        _pdf_cache.clear()
+        response = self.view.get(self.request_factory.get(""))
+        self.assertEqual(b"".join(response.streaming_content), b"%PDF")
+        mock_pdf.assert_called_once()
+        # Not sent to clients having the current PDF
+        response = self.view.get(
+            self.request_factory.get("", headers={"If-None-Match": etag})
+        )
+        self.assertEqual(response.status_code, 304)
+        response = self.view.get(
+            self.request_factory.get(
+                "", headers={"If-Modified-Since": response["Last-Modified"]}
+            )
+        )
+        self.assertEqual(response.status_code, 304)
+        # Changes to the form are previewed at once
+        HarborDuesForm.objects.filter(pk=self.harbor_dues_form.pk).update(
+            vessel_name="Argo"
+        )
+        response = self.view.get(
+            self.request_factory.get("", headers={"If-None-Match": etag})
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
+        self.assertEqual(mock_pdf.call_count, 2)
+        # Only the current preview is kept
+        self.assertEqual(
+            len(storage.listdir(f"preview/{self.harbor_dues_form.pk}")[1]), 1
+        )
+        self.assertEqual(clear_receipt_cache(), 1)
+
+    @patch.object(
+        HarborDuesFormReceipt, "pdf", new_callable=PropertyMock, return_value=b"%PDF"
+    )
+    def test_get_preview_deleted(self, mock_pdf):
+        # The preview is replaced by a concurrent request before it is opened
+        storage = FileSystemStorage(location=self.enterContext(TemporaryDirectory()))
+        self.enterContext(patch("havneafgifter.views.pdf_storage", storage))
+        self.enterContext(patch("havneafgifter.receipts.pdf_storage", storage))
+        self.enterContext(patch.object(storage, "open", side_effect=FileNotFoundError))
+        clear_receipt_cache()
+        self.view.kwargs = {"pk": self.harbor_dues_form.pk}
+        response = self.view.get(self.request_factory.get(""))
+        self.assertEqual(b"".join(response.streaming_content), b"%PDF")
+        etag = response["ETag"]
+        response = self.view.get(
+            self.request_factory.get("", headers={"If-None-Match": etag})
+        )
+        self.assertEqual(response.status_code, 304)
+
 
 class TestHarborDuesFormListView(HarborDuesFormTestMixin, TestCase):
     @classmethod
@@ -2755,10 +2875,11 @@ class TestTaxRateFormView(HarborDuesFormTestMixin, TestCase):
 
         self.assertEqual(PortTaxRate.objects.count(), 10)
 
-        post_request_response = self.client.post(
-            self.edit_url,
-            data=value_dict_to_post,
-        )
+        with self.captureOnCommitCallbacks(execute=True):
+            post_request_response = self.client.post(
+                self.edit_url,
+                data=value_dict_to_post,
+            )
 
         # Check for redirect
         self.assertEqual(post_request_response.status_code, 302)
@@ -2784,6 +2905,17 @@ class TestTaxRateFormView(HarborDuesFormTestMixin, TestCase):
         # And the db?
         self.assertEqual(313373.00, PortTaxRate.objects.last().port_tax_rate)
 
+        # Were the effective rates regenerated?
+        self.assertEqual(
+            313373.00,
+            self.tax_rate.get_port_tax_rate(self.port1, "FISHER", 0).port_tax_rate,
+        )
+        self.assertTrue(
+            EffectivePortTaxRate.objects.filter(
+                tax_rates=self.tax_rate, port=self.port1, vessel_type="FISHER"
+            ).exists()
+        )
+
     def test_bisembarkment_tax_rate_formset_change(self):
         original_response_dict = self.response_to_datafields_dict(
             self.client.get(self.edit_url).content.decode("utf-8")
@@ -2957,6 +3089,30 @@ class TestTaxRateFormView(HarborDuesFormTestMixin, TestCase):
         )
         self.assertEqual(after_request_dict["start_datetime"], "3033-10-05 17:33:00")
 
+    def test_simulate(self):
+        CruiseTaxForm.objects.create(
+            **{
+                **self.cruise_tax_form_data,
+                "datetime_of_arrival": self._local_datetime(2234, 1, 1),
+                "datetime_of_departure": self._local_datetime(2234, 1, 2),
+                "number_of_passengers": 10,
+            }
+        )
+        data = self.response_to_datafields_dict(
+            self.client.get(self.edit_url).content.decode("utf-8")
+        )
+        data["pax_tax_rate"] = "84"
+        data["simulate"] = "1"
+        response = self.client.post(self.edit_url, data=data)
+        self.assertEqual(response.status_code, 200)
+        simulation = response.context["simulation"]
+        # 10 passengers, rate raised from 42 to 84
+        self.assertEqual(simulation.changed_forms, 1)
+        self.assertEqual(simulation.total.delta, Decimal("420"))
+        # Nothing is saved
+        self.tax_rate.refresh_from_db()
+        self.assertEqual(self.tax_rate.pax_tax_rate, Decimal("42"))
+
     def test_get_object_permission(self):
         self.client.force_login(self.ship_user)
         response = self.client.get(
@@ -13,6 +13,7 @@ from havneafgifter.views import (
     PostLoginView,
     PreviewPDFView,
     ReceiptDetailView,
+    ReceiptExportView,
     RootView,
     SignupVesselView,
     StatisticsView,
@@ -97,6 +98,11 @@ urlpatterns: List[URLResolver | URLPattern] = [
         PreviewPDFView.as_view(),
         name="receipt_detail_pdf",
     ),
+    path(
+        "blanket/eksport/<str:format>/",
+        ReceiptExportView.as_view(),
+        name="receipt_export",
+    ),
     path("blanket/statistik/", StatisticsView.as_view(), name="statistik"),
     path("sats/", TaxRateListView.as_view(), name="tax_rate_list"),
     path("sats/<int:pk>/", TaxRateDetailView.as_view(), name="tax_rate_details"),
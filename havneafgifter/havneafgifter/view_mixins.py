@@ -3,10 +3,19 @@ from django.contrib import messages
 from django.http import HttpResponse, HttpResponseRedirect
 from django.urls import reverse
 from django.utils.http import urlencode
+from django.utils.translation import gettext_lazy as _
 from django.views.generic import FormView
 
+from havneafgifter.mail_jobs import enqueue_mail
 from havneafgifter.mails import NotificationMail
-from havneafgifter.models import CruiseTaxForm, HarborDuesForm, User, UserType
+from havneafgifter.models import (
+    CruiseTaxForm,
+    HarborDuesForm,
+    MailJob,
+    MailJobStatus,
+    User,
+    UserType,
+)
 
 
 class HavneafgiftView:
@@ -58,6 +67,42 @@ class HandleNotificationMailMixin:
             ),
         )
 
+    def queue_notification_mail(
+        self,
+        mail_class: type[NotificationMail],
+        form: HarborDuesForm | CruiseTaxForm,
+    ) -> MailJob:
+        # Leave rendering the receipt and sending the mail to the mail worker.
+        # The user is told the outcome by `add_mail_job_messages`.
+        return enqueue_mail(mail_class, form, self.request.user)  # type: ignore
+
+    def add_mail_job_messages(self, request, form: HarborDuesForm | None = None):
+        # Tell the user about their finished mail jobs (for `form`, if given),
+        # once each, and that the mails of `form` are still being sent
+        jobs = MailJob.objects.filter(user=request.user, reported=False)
+        if form is not None:
+            jobs = jobs.filter(form=form)
+        reported = []
+        pending = False
+        for job in jobs:
+            if job.done:
+                messages.add_message(
+                    request,
+                    (
+                        messages.SUCCESS
+                        if job.status == MailJobStatus.SUCCEEDED
+                        else messages.ERROR
+                    ),
+                    job.message or "",
+                )
+                reported.append(job.pk)
+            else:
+                pending = True
+        if reported:
+            MailJob.objects.filter(pk__in=reported).update(reported=True)
+        if pending and form is not None:
+            messages.info(request, _("The email is being sent."))
+
 
 class GetFormView(FormView):
     def get(self, request, *args, **kwargs):
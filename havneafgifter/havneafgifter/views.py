@@ -1,5 +1,6 @@
 from datetime import datetime
 from decimal import Decimal
+from io import BytesIO
 
 from csp_helpers.mixins import CSPViewMixin
 from dateutil.relativedelta import relativedelta
@@ -10,6 +11,7 @@ from django.contrib.auth.mixins import LoginRequiredMixin
 from django.contrib.auth.models import Group
 from django.contrib.auth.views import LoginView as DjangoLoginView
 from django.core.exceptions import PermissionDenied
+from django.db import transaction
 from django.db.models import (
     Case,
     Count,
@@ -23,9 +25,19 @@ from django.db.models import (
 )
 from django.db.models.functions import Coalesce
 from django.forms import inlineformset_factory, model_to_dict
-from django.http import Http404, HttpResponse, HttpResponseForbidden
+from django.http import (
+    FileResponse,
+    Http404,
+    HttpResponse,
+    HttpResponseForbidden,
+    StreamingHttpResponse,
+)
 from django.shortcuts import redirect
 from django.urls import reverse, reverse_lazy
+from django.utils import timezone
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.decorators import method_decorator
+from django.utils.http import http_date
 from django.utils.translation import gettext_lazy as _
 from django.views.generic import DetailView, RedirectView
 from django.views.generic.edit import CreateView, DeleteView, UpdateView
@@ -71,11 +83,26 @@ from havneafgifter.models import (
     User,
     UserType,
     Vessel,
+    pdf_storage,
+)
+from havneafgifter.receipt_export import (
+    EXPORT_FORMATS,
+    iter_export_forms,
+    iter_merged_pdf,
+    iter_receipt_zip,
+    iter_stored_receipts,
+)
+from havneafgifter.receipts import (
+    get_receipt_fingerprint,
+    get_receipt_pdf,
+    get_stored_receipt_pdf,
 )
 from havneafgifter.responses import (
+    HavneafgifterResponseBadRequest,
     HavneafgifterResponseForbidden,
     HavneafgifterResponseNotFound,
 )
+from havneafgifter.simulation import candidate_index, simulate
 from havneafgifter.tables import (
     HarborDuesFormFilter,
     HarborDuesFormTable,
@@ -117,6 +144,9 @@ class SignupVesselView(
             self.request,
             _("Please sign in using the IMO number as username"),
         )
+        # Sent at once rather than by the mail worker, as there is no form (and
+        # receipt) to go with it, and the new user is not logged in to be told
+        # the outcome later
         self.handle_notification_mail(OnNewUserMail, self.object)
         return response
 
@@ -237,6 +267,8 @@ class HarborDuesFormCreateView(
         response = super().get(request, *args, **kwargs)
         return self.prevent_response_caching(response)
 
+    # The form is saved together with its mail jobs, or not at all
+    @method_decorator(transaction.atomic)
     def post(self, request, *args, **kwargs):
         base_form = self.get_base_form(
             instance=self.get_object(),
@@ -302,10 +334,8 @@ class HarborDuesFormCreateView(
                             passenger_formset,
                             disembarkment_formset,
                         )
-                        self.handle_notification_mail(
-                            OnSubmitForReviewMail, self.object
-                        )
-                        self.handle_notification_mail(
+                        self.queue_notification_mail(OnSubmitForReviewMail, self.object)
+                        self.queue_notification_mail(
                             OnSubmitForReviewReceipt, self.object
                         )
                     elif status == Status.DRAFT:
@@ -319,7 +349,7 @@ class HarborDuesFormCreateView(
                         self.request.user.user_type == UserType.SHIP
                         and self.object.shipping_agent
                     ):
-                        self.handle_notification_mail(OnSendToAgentMail, self.object)
+                        self.queue_notification_mail(OnSendToAgentMail, self.object)
                     return self.get_redirect_for_form(
                         "havneafgifter:receipt_detail_html",
                         self.object,
@@ -514,7 +544,9 @@ class HarborDuesFormDeleteView(
         return super().post(request, *args, **kwargs)
 
 
-class ReceiptDetailView(LoginRequiredMixin, HavneafgiftView, DetailView):
+class ReceiptDetailView(
+    LoginRequiredMixin, HandleNotificationMailMixin, HavneafgiftView, DetailView
+):
     def get(self, request, *args, **kwargs):
         form = self.get_object()
         if form is None:
@@ -525,7 +557,8 @@ class ReceiptDetailView(LoginRequiredMixin, HavneafgiftView, DetailView):
         if not form.has_permission(request.user, "view"):
             raise PermissionDenied
 
-        form.calculate_tax(save=True)
+        form.calculate_tax_if_changed()
+        self.add_mail_job_messages(request, form)
         receipt = form.get_receipt(
             base="havneafgifter/base_default.html", request=request
         )
@@ -549,15 +582,35 @@ class PreviewPDFView(ReceiptDetailView):
             return HavneafgifterResponseNotFound(
                 request, f"No form found for ID {self.kwargs.get(self.pk_url_kwarg)}"
             )
-        else:
-            receipt = form.get_receipt()
-        return HttpResponse(
-            receipt.pdf,
-            content_type="application/pdf",
+        # Served from `pdf_storage`, where the PDF is kept for as long as the
+        # form (and the receipt templates) are unchanged
+        try:
+            name, fingerprint, modified = get_stored_receipt_pdf(form)
+            file = pdf_storage.open(name, "rb")
+        except FileNotFoundError:
+            # Replaced by a newer preview in the meantime, by a concurrent
+            # request after a change to the form
+            fingerprint = get_receipt_fingerprint(form)
+            modified = timezone.now()
+            file = BytesIO(get_receipt_pdf(form))
+        etag = f'"{fingerprint}"'
+        response = get_conditional_response(
+            request, etag=etag, last_modified=int(modified.timestamp())
         )
+        if response is None:
+            response = FileResponse(file, content_type="application/pdf")
+        else:
+            file.close()
+        response["ETag"] = etag
+        response["Last-Modified"] = http_date(modified.timestamp())
+        # Allow the browser to keep the PDF, but ask whether it has changed
+        patch_cache_control(response, private=True, no_cache=True)
+        return response
 
 
-class HarborDuesFormListView(LoginRequiredMixin, HavneafgiftView, SingleTableView):
+class HarborDuesFormListView(
+    LoginRequiredMixin, HandleNotificationMailMixin, HavneafgiftView, SingleTableView
+):
     table_class = HarborDuesFormTable
     context_object_name = "harbordues"
 
@@ -586,12 +639,65 @@ class HarborDuesFormListView(LoginRequiredMixin, HavneafgiftView, SingleTableVie
             return HarborDuesForm.objects.none()
 
     def get_context_data(self, **context):
+        self.add_mail_job_messages(self.request)
         context = super().get_context_data(**context)
         context["form"] = self.filterset.form
         context["count"] = self.get_queryset().count()
         return context
 
 
+class ReceiptExportView(HarborDuesFormListView):
+    """Streams the receipts of the forms in the list (using the same filters),
+    as a ZIP file or as a single PDF."""
+
+    def get(self, request, *args, **kwargs):
+        export_format = self.kwargs["format"]
+        if export_format not in EXPORT_FORMATS:
+            raise Http404
+        queryset = self.get_queryset()
+        count = queryset.count()
+        if count == 0:
+            return HavneafgifterResponseNotFound(
+                request, _("No forms match the filters")
+            )
+        # The receipts are rendered in this request, which must finish before
+        # the request times out
+        zip_limit = settings.RECEIPT_EXPORT["max_zip_forms"]
+        if count > zip_limit:
+            return HavneafgifterResponseBadRequest(
+                request,
+                _(
+                    "Too many forms to export at once (at most %(limit)d). "
+                    "Narrow down the filters."
+                )
+                % {"limit": zip_limit},
+            )
+        if export_format == "pdf":
+            limit = settings.RECEIPT_EXPORT["max_merged_forms"]
+            if count > limit:
+                return HavneafgifterResponseBadRequest(
+                    request,
+                    _(
+                        "Too many forms to merge into a single PDF (at most "
+                        "%(limit)d). Export them as a ZIP file instead."
+                    )
+                    % {"limit": limit},
+                )
+            response = StreamingHttpResponse(
+                iter_merged_pdf(iter_export_forms(queryset)),
+                content_type="application/pdf",
+            )
+        else:
+            response = StreamingHttpResponse(
+                iter_receipt_zip(iter_stored_receipts(iter_export_forms(queryset), 1)),
+                content_type="application/zip",
+            )
+        response["Content-Disposition"] = (
+            f'attachment; filename="receipts.{export_format}"'
+        )
+        return response
+
+
 class TaxRateListView(LoginRequiredMixin, SingleTableView):
     table_class = TaxRateTable
 
@@ -627,6 +733,11 @@ class TaxRateDetailView(LoginRequiredMixin, DetailView):
                     F("vessel_type").asc(nulls_first=True),
                     F("port").asc(nulls_first=True),
                 ),
+                "effective_port_tax_rates": (
+                    self.object.effective_port_tax_rates.select_related(
+                        "port", "port_tax_rate"
+                    ).order_by("port__name", "vessel_type", "gt_start")
+                ),
                 "disembarkment_tax_rates": self.object.disembarkment_tax_rates.order_by(
                     F("municipality").asc(nulls_first=True),
                     F("disembarkment_site").asc(nulls_first=True),
@@ -1026,6 +1137,9 @@ class TaxRateFormView(LoginRequiredMixin, UpdateView):
                 self.request.POST or None, instance=self.object
             )
 
+    # The effective port tax rates are regenerated once, when the tariff and
+    # all its rates are saved
+    @method_decorator(transaction.atomic)
     def form_valid(self, form, formset1, formset2):
         self.object = form.save()
 
@@ -1044,6 +1158,32 @@ class TaxRateFormView(LoginRequiredMixin, UpdateView):
             )
         )
 
+    def form_simulate(self, form, formset1, formset2):
+        # Show the revenue impact of the submitted (but unsaved) tax rates
+        def instances(formset):
+            return [
+                item.instance
+                for item in formset.forms
+                if item.cleaned_data and not item.cleaned_data.get("DELETE")
+            ]
+
+        simulation = simulate(
+            candidate_index(form.instance, instances(formset1), instances(formset2))
+        )
+        return self.render_to_response(
+            self.get_context_data(
+                form=form,
+                port_formset=formset1,
+                disembarkmentrate_formset=formset2,
+                simulation=simulation,
+                simulation_groups=[
+                    (_("Port"), simulation.by_port),
+                    (_("Vessel type"), simulation.by_vessel_type),
+                    (_("Municipality"), simulation.by_municipality),
+                ],
+            )
+        )
+
     def post(self, request, *args, **kwargs):
         self.object = self.get_object()
 
@@ -1055,6 +1195,8 @@ class TaxRateFormView(LoginRequiredMixin, UpdateView):
         formset2 = self.get_disembarkmentrate_formset()
 
         if form.is_valid() and formset1.is_valid() and formset2.is_valid():
+            if "simulate" in request.POST:
+                return self.form_simulate(form, formset1, formset2)
             return self.form_valid(form, formset1, formset2)
         else:
             return self.form_invalid(form, formset1, formset2)
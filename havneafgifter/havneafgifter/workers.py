@@ -0,0 +1,37 @@
+from concurrent.futures import ProcessPoolExecutor
+
+from django.conf import settings
+from django.db import connections
+
+
+def process_pool(max_workers: int | None = None) -> ProcessPoolExecutor:
+    """Return a process pool whose workers have Django set up and talk to the same
+    databases as the calling process.
+
+    Database connections are closed first, and the workers are started at once,
+    so forked workers do not inherit (and share) the sockets of the calling
+    process.
+    """
+    connections.close_all()
+    database_names = {
+        alias: database["NAME"] for alias, database in settings.DATABASES.items()
+    }
+    pool = ProcessPoolExecutor(
+        max_workers=max_workers,
+        initializer=_setup_worker,
+        initargs=(database_names,),
+    )
+    # Start the workers now, while the connections are closed. Forked on the
+    # first `submit`, they would inherit the connections opened in the meantime.
+    pool.submit(int).result()
+    return pool
+
+
+def _setup_worker(database_names: dict[str, str]) -> None:
+    import django
+
+    django.setup()
+    # Under `spawn`/`forkserver`, the worker reads the settings from scratch, and
+    # would not know about e.g. the test database
+    for alias, name in database_names.items():
+        connections.settings[alias]["NAME"] = name
@@ -6,6 +6,8 @@ from unittest.mock import MagicMock, patch
 
 from django.test import TestCase
 
+from havneafgifter.instrumentation import Instrumentation
+
 
 class MetricsTest(TestCase):
     def test_health_check_storage(self):
@@ -33,3 +35,22 @@ class MetricsTest(TestCase):
         resp = self.client.get("/metrics/health/database")
         self.assertEqual(resp.status_code, 500)
         self.assertEqual(resp.content, b"ERROR")
+
+    def test_invoicing_metrics(self):
+        instrumentation = Instrumentation()
+        for _ in range(2):
+            with instrumentation.span("receipt_pdf"):
+                pass
+        instrumentation.count("invoiced", 2)
+        with self.assertLogs("havneafgifter.instrumentation", "INFO") as logs:
+            instrumentation.flush()
+        self.assertIn("receipt_pdf 2 x", logs.output[0])
+        instrumentation.count("invoiced")
+        instrumentation.flush()
+
+        resp = self.client.get("/metrics/invoicing")
+        self.assertEqual(resp.status_code, 200)
+        content = resp.content.decode()
+        self.assertIn('havneafgifter_stage_count{stage="receipt_pdf"} 2\n', content)
+        self.assertIn('havneafgifter_stage_seconds_max{stage="receipt_pdf"}', content)
+        self.assertIn('havneafgifter_events_total{event="invoiced"} 3\n', content)
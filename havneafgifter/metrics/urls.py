@@ -7,9 +7,11 @@ from django.urls import path
 from metrics.views import (  # isort: skip
     health_check_database,
     health_check_storage,
+    invoicing_metrics,
 )
 
 urlpatterns = [
     path("health/storage", health_check_storage, name="health_check_storage"),
     path("health/database", health_check_database, name="health_check_database"),
+    path("invoicing", invoicing_metrics, name="invoicing_metrics"),
 ]
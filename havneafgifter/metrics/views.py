@@ -9,6 +9,8 @@ from django.conf import settings
 from django.db import connection
 from django.http import HttpResponse
 
+from havneafgifter.models import MetricKind, StageMetric
+
 log = logging.getLogger(__name__)
 
 
@@ -44,3 +46,25 @@ def health_check_database(request):
     except Exception:
         log.exception("Database health check failed")
         return HttpResponse("ERROR", status=500)
+
+
+def invoicing_metrics(request):
+    # Stage timings and counters of the invoicing, as recorded by
+    # `havneafgifter.instrumentation`, in the Prometheus text format
+    lines = []
+    for metric in StageMetric.objects.order_by("kind", "name"):
+        if metric.kind == MetricKind.SPAN:
+            labels = f'{{stage="{metric.name}"}}'
+            lines += [
+                f"havneafgifter_stage_count{labels} {metric.count}",
+                f"havneafgifter_stage_seconds_total{labels} {metric.total_seconds}",
+                f"havneafgifter_stage_seconds_max{labels} {metric.max_seconds}",
+            ]
+        else:
+            lines.append(
+                f'havneafgifter_events_total{{event="{metric.name}"}} {metric.count}'
+            )
+    return HttpResponse(
+        "".join(f"{line}\n" for line in lines),
+        content_type="text/plain; version=0.0.4",
+    )
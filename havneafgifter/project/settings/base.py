@@ -39,6 +39,19 @@ DATA_UPLOAD_MAX_MEMORY_SIZE = 20 * 1024 * 1024
 STORAGE_ROOT = "/storage/"
 STORAGE_PDF = os.path.join(STORAGE_ROOT, "pdf")
 
+RECEIPT_EXPORT = {
+    # Number of processes rendering the receipts of an export by the
+    # `export_receipts` command (the export view renders them in the request)
+    "workers": int(os.environ.get("RECEIPT_EXPORT_WORKERS", 2)),
+    # Exports by the export view must be done within the request timeout of
+    # gunicorn (120 seconds), so they are limited to this many forms. Larger
+    # exports are done by the `export_receipts` command.
+    "max_zip_forms": int(os.environ.get("RECEIPT_EXPORT_MAX_ZIP_FORMS", 200)),
+    # Merged PDFs are laid out as a whole before anything is sent, so they are
+    # limited to fewer forms (by the `export_receipts` command as well)
+    "max_merged_forms": int(os.environ.get("RECEIPT_EXPORT_MAX_MERGED_FORMS", 50)),
+}
+
 APPROVER_NO_PORT_OF_CALL = os.environ.get(
     "APPROVER_NO_PORT_OF_CALL", "Royal Arctic Line A/S"
 )
@@ -19,3 +19,18 @@ EMAIL_SENDER = os.environ.get("EMAIL_SENDER", "noreply@nanoq.gl")
 EMAIL_ADDRESS_SKATTESTYRELSEN = os.environ.get("EMAIL_ADDRESS_SKATTESTYRELSEN")
 # Use correct email sender for password reset.
 DEFAULT_FROM_EMAIL = EMAIL_SENDER
+
+MAIL_JOBS = {
+    # Number of processes rendering receipts and sending notification mails
+    "workers": int(os.environ.get("MAIL_WORKERS", 2)),
+    # Seconds between looking for new mail jobs
+    "poll_interval": float(os.environ.get("MAIL_WORKER_POLL_INTERVAL", 1)),
+    # Running mail jobs whose worker has not recorded a heartbeat for this many
+    # seconds are assumed to be lost (e.g. by a killed worker), and are run again
+    "timeout": int(os.environ.get("MAIL_JOB_TIMEOUT", 600)),
+    # Seconds before attempting a failed mail job again, doubled after each
+    # attempt
+    "retry_delay": int(os.environ.get("MAIL_JOB_RETRY_DELAY", 60)),
+    # Give up after this many attempts
+    "max_attempts": int(os.environ.get("MAIL_JOB_MAX_ATTEMPTS", 3)),
+}
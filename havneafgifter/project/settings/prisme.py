@@ -1,4 +1,5 @@
 import os
+import tempfile
 
 PRISME = {
     "customer_group": os.environ.get("PRISME_CUSTOMER_GROUP", "000000"),
@@ -23,6 +24,17 @@ PRISME = {
         }
     },
     "proxy": {"socks": os.environ.get("PRISME_SOCKS", None)},
+    "wsdl_cache": {
+        # Parsing the WSDL is much faster than fetching it (and its schemas)
+        "path": os.environ.get(
+            "PRISME_WSDL_CACHE",
+            os.path.join(tempfile.gettempdir(), "prisme-wsdl-cache.sqlite"),
+        ),
+        # Refetch the WSDL after this many seconds
+        "timeout": int(os.environ.get("PRISME_WSDL_CACHE_TIMEOUT", 86400)),
+    },
+    # Number of connections to Prisme kept alive
+    "pool_size": int(os.environ.get("PRISME_POOL_SIZE", 10)),
     "mock": os.environ.get("PRISME_MOCK", False),
     "type_account": {
         "by_owner": {
@@ -36,6 +48,20 @@ PRISME = {
         "passenger_tax": os.environ.get("PRISME_TYPE_ACCOUNT_PASSENGER_TAX", 0),
         "landing_tax": os.environ.get("PRISME_TYPE_ACCOUNT_LANDING_TAX", 0),
     },
+    "retry": {
+        # Delay (in seconds) before retrying a failed invoice, doubled after
+        # every failed attempt, up to `max_delay`
+        "base_delay": int(os.environ.get("PRISME_RETRY_BASE_DELAY", 300)),
+        "max_delay": int(os.environ.get("PRISME_RETRY_MAX_DELAY", 86400)),
+        # Give up after this many attempts
+        "max_attempts": int(os.environ.get("PRISME_RETRY_MAX_ATTEMPTS", 10)),
+        # Prisme error codes that retrying will not fix (comma separated)
+        "permanent_error_codes": [
+            int(code)
+            for code in os.environ.get("PRISME_PERMANENT_ERROR_CODES", "").split(",")
+            if code.strip()
+        ],
+    },
     "override_due_date": os.environ.get("OVERRIDE_DUE_DATE", None),
     "override_date": os.environ.get("OVERRIDE_DATE", None),
 }
@@ -29,3 +29,7 @@ STATICFILES_FINDERS = [
     "django.contrib.staticfiles.finders.AppDirectoriesFinder",
     "compressor.finders.CompressorFinder",
 ]
+
+# URLs of assets which receipt PDFs may refer to (e.g. on a CDN), and the static
+# files to use instead, as the PDFs are rendered without network access
+PDF_ASSET_URLS: dict[str, str] = {}